@@ -0,0 +1,155 @@
+"""Measure the throughput of the stop-and-go capture loop without hardware.
+
+Runs the same loop as :py:func:`robot2cam_calibration.get_correspondences`
+(move, wait for the robot to stop, pair a frame time with the robot pose and
+hand the frame to the capture pipeline) against a
+:py:class:`robot2cam_calibration.robots.SimulatedRobotServer` for each of
+several latencies. The camera is replaced by a frame time one frame period
+after the stop and grid detection by a sleep, so the results show the cost of
+the robot side of capturing. Run from the repository root with::
+
+    python benchmarks/capture_throughput.py
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+# run from a checkout, the package is next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+import robot2cam_calibration.pipeline as pipeline
+import robot2cam_calibration.robots as robots
+import robot2cam_calibration.synchronize as synchronize
+
+
+def main():
+    """Run the benchmark from the commandline. Run with `-h` for more info."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the capture loop against a simulated robot")
+    parser.add_argument("--points", type=int,
+                        help="The number of points to capture at",
+                        default=20)
+    parser.add_argument("--latencies", type=float, nargs='+',
+                        help="The robot latencies (s) to compare",
+                        default=[0, 0.004, 0.016])
+    parser.add_argument("--velocity", type=float,
+                        help="The joint velocity (rad/s)",
+                        default=1.0)
+    parser.add_argument("--spread", type=float,
+                        help="How far (rad) each joint of the points is "
+                             "spread around the home position",
+                        default=0.2)
+    parser.add_argument("--frame_period", type=float,
+                        help="The camera frame period (s)",
+                        default=1 / 30)
+    parser.add_argument("--processing", type=float,
+                        help="The time (s) to find the grid in each frame",
+                        default=0.05)
+    parser.add_argument("--workers", type=int,
+                        help="The number of capture pipeline threads",
+                        default=2)
+    args = parser.parse_args()
+
+    points = (np.asarray(robots.HOME) + np.random.RandomState(0).uniform(
+        -args.spread, args.spread, (args.points, 6))).tolist()
+    print('{} points, {:.3f} s processing per frame'.format(
+        len(points), args.processing))
+    print('{:>10} {:>10} {:>10} {:>10} {:>12} {:>10}'.format(
+        'latency s', 'points/s', 'move s', 'settle s', 'state Hz',
+        'skew ms'))
+    for latency in args.latencies:
+        report(latency, *capture(points, latency, args.velocity,
+                                 args.frame_period, args.processing,
+                                 args.workers))
+
+
+def capture(points, latency, velocity, frame_period, processing, workers):
+    """Run the capture loop over the points with a simulated robot.
+
+    Args:
+        points (list of lists): The joint positions to capture at
+        latency (float): The latency (s) of the simulated robot
+        velocity (float): The joint velocity (rad/s)
+        frame_period (float): The camera frame period (s)
+        processing (float): The time (s) to find the grid in each frame
+        workers (int): The number of capture pipeline threads
+
+    Returns: A tuple, (float, the total time, float, the mean time from
+        commanding each move until the robot was found stopped, float, the
+        mean time from the end of the motion until it was found stopped,
+        float, the rate robot states were received at, np.ndarray, the pose
+        skew of each point)
+    """
+    with robots.SimulatedRobotServer(latency=latency) as server, \
+            robots.SimulatedRobot(*server.address) as robot, \
+            robot.pose_stream() as pose_stream, \
+            pipeline.CapturePipeline(workers) as capture_pipeline:
+        synchronizer = synchronize.Synchronizer(pose_stream)
+        skews = []
+        moves = []
+        settles = []
+        start = time.time()
+        for joints in points:
+            commanded = synchronize.clock()
+            stopped_time = robot.move_and_wait(joints, velocity)
+            moves.append(stopped_time - commanded)
+            # the simulated motion ends at the goal after its duration
+            started, duration = server.motion()
+            settles.append(stopped_time - (started + duration))
+            frame_time = stopped_time + frame_period
+            while synchronize.clock() < frame_time:
+                time.sleep(0.001)
+            _, skew = synchronizer.pair(frame_time)
+            skews.append(skew)
+            capture_pipeline.submit(time.sleep, processing)
+        capture_pipeline.join()
+        elapsed = time.time() - start
+        states = robot.stream.lines
+    return (elapsed, np.mean(moves), np.mean(settles), states / elapsed,
+            np.array(skews))
+
+
+def report(latency, elapsed, move, settle, state_rate, skews):
+    """Print one row of the benchmark table.
+
+    Args:
+        latency (float): The robot latency
+        elapsed (float): The total capture time
+        move (float): The mean time from command to stop
+        settle (float): The mean time from the end of motion to stop
+        state_rate (float): The rate robot states were received at
+        skews (np.ndarray): The pose skew of each point
+    """
+    print('{:>10.3f} {:>10.2f} {:>10.3f} {:>10.3f} {:>12.1f} {:>10.2f}'.format(
+        latency, len(skews) / elapsed, move, settle, state_rate,
+        1000 * skews.mean()))
+
+
+if __name__ == '__main__':
+    main()
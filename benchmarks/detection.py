@@ -0,0 +1,136 @@
+"""Compare the speed and accuracy of the grid detection paths.
+
+Runs the original full resolution chessboard search and the pyramid search
+(see :py:func:`robot2cam_calibration.targets.pyramid_corners`) over a
+folder of images and reports the time per image and how far the refined
+corners of the pyramid search are from those of the full resolution search.
+By default this uses the images from the UR example, run from the repository
+root with::
+
+    python benchmarks/detection.py
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import argparse
+import glob
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+# run from a checkout, the package is next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+import robot2cam_calibration.targets as targets
+
+
+def main():
+    """Run the benchmark from the commandline. Run with `-h` for more info."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark chessboard detection")
+    parser.add_argument("--folder", type=str,
+                        help="The folder of images to detect grids in",
+                        default=os.path.join("examples", "UR_with_Grid",
+                                             "result"))
+    parser.add_argument("-r", "--rows", type=int,
+                        help="the number of inner corners vertically",
+                        default=7)
+    parser.add_argument("-c", "--columns", type=int,
+                        help="the number of inner corners horizontally",
+                        default=8)
+    parser.add_argument("--sizes", type=int, nargs='+',
+                        help="The detection sizes to compare",
+                        default=[1280, 640])
+    parser.add_argument("--window", type=int,
+                        help="The refinement half window size",
+                        default=11)
+    args = parser.parse_args()
+
+    images = [cv2.imread(name, cv2.IMREAD_GRAYSCALE) for name in
+              sorted(glob.glob(os.path.join(args.folder, '*.png')))]
+    if not images:
+        raise ValueError('no images found in {}'.format(args.folder))
+    pattern_size = (args.rows, args.columns)
+
+    reference, reference_time = detect_all(images, pattern_size, None,
+                                           args.window)
+    print('{} images of {}x{}'.format(len(images), images[0].shape[1],
+                                      images[0].shape[0]))
+    print('{:>12} {:>10} {:>8} {:>8} {:>12} {:>12}'.format(
+        'size', 's/image', 'speedup', 'found', 'mean err px',
+        'max err px'))
+    report('full', reference, reference_time, reference, reference_time)
+    for size in args.sizes:
+        corners, elapsed = detect_all(images, pattern_size, size,
+                                      args.window)
+        report(size, corners, elapsed, reference, reference_time)
+
+
+def detect_all(images, pattern_size, detection_size, window):
+    """Find and refine the corners in every image.
+
+    Args:
+        images (list of numpy.ndarray): The grayscale images
+        pattern_size (tuple): The number of interior corners (rows, cols)
+        detection_size (int): The largest dimension to search at, or None for
+            full resolution
+        window (int): The refinement half window size
+
+    Returns: A tuple, (list of numpy.ndarray of refined corners or None where
+        the grid was not found, float, the mean time per image in seconds)
+    """
+    results = []
+    start = time.time()
+    for image in images:
+        corners = targets.pyramid_corners(image, pattern_size,
+                                          detection_size)
+        if corners is not None:
+            corners = targets.refine_corners(image, corners, window)
+        results.append(corners)
+    return results, (time.time() - start) / len(images)
+
+
+def report(label, corners, elapsed, reference, reference_time):
+    """Print one row of the benchmark table.
+
+    Args:
+        label: The name of the row
+        corners (list of numpy.ndarray): The corners found in each image
+        elapsed (float): The mean time per image
+        reference (list of numpy.ndarray): The full resolution corners
+        reference_time (float): The mean full resolution time per image
+    """
+    errors = [np.linalg.norm((found - expected).reshape(-1, 2), axis=1)
+              for found, expected in zip(corners, reference)
+              if found is not None and expected is not None]
+    errors = np.concatenate(errors) if errors else np.array([np.nan])
+    print('{:>12} {:>10.4f} {:>8.2f} {:>8} {:>12.4f} {:>12.4f}'.format(
+        label, elapsed, reference_time / elapsed,
+        sum(x is not None for x in corners), errors.mean(), errors.max()))
+
+
+if __name__ == '__main__':
+    main()
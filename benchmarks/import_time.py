@@ -0,0 +1,164 @@
+"""Measure how long the commandline tools take to start.
+
+Each command is run with ``--help`` in a fresh interpreter several times and
+the fastest run is reported, next to an empty interpreter and one which only
+imports numpy for reference. The heavy or hardware dependencies each module
+loads on import are listed, so a module level import of scipy, opencv or a
+robot or camera SDK shows up here before it slows down every command. With
+``--budget`` the benchmark fails if a command takes longer than the budget
+to start. Before timing, each module is imported ahead of the package's
+functions to check they are still bound to the functions, not the modules of
+the same name. Run from the repository root with::
+
+    python benchmarks/import_time.py
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# The modules behind the solver commands, which should start without the
+# hardware SDKs
+MODULES = ['compute_transformations', 'check_transformation',
+           'uncertainty', 'bundle_adjustment', 'align_streams',
+           'kuka_convert']
+
+# Dependencies worth knowing about when they are loaded on import
+HEAVY = ['scipy.optimize', 'scipy.sparse', 'cv2', 'ur_cb2', 'flycapture2',
+         'robot2cam_calibration.camera']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports a module, then checks the package functions, calling
+# check_transformation on the example
+EXPORTS_CHECK = """
+import robot2cam_calibration.{module}
+import robot2cam_calibration as package
+for name in package.__all__:
+    function = getattr(package, name)
+    assert callable(function), '{{}} is {{!r}}'.format(name, function)
+example = 'examples/UR_with_Grid/'
+package.check_transformation(
+    example + 'transformation.json', example + 'correspondences.json', '',
+    '', example + 'calibration.json', render=False)
+"""
+
+
+def main():
+    """Run the benchmark from the commandline. Run with `-h` for more info."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the start up time of the commands")
+    parser.add_argument("--modules", type=str, nargs='+',
+                        help="The modules to start",
+                        default=MODULES)
+    parser.add_argument("--repeats", type=int,
+                        help="How many times to start each command",
+                        default=5)
+    parser.add_argument("--budget", type=float,
+                        help="Fail if a command takes longer than this (s) "
+                             "to start",
+                        default=None)
+    args = parser.parse_args()
+
+    for module in args.modules + ['get_images']:
+        check_exports(module)
+
+    print('{:>26} {:>10}  {}'.format('command', 'start s', 'loads'))
+    for name, code in (('python', 'pass'), ('numpy', 'import numpy')):
+        print('{:>26} {:>10.3f}'.format(
+            name, fastest([sys.executable, '-c', code], args.repeats)))
+    over = []
+    for module in args.modules:
+        name = 'robot2cam_calibration.' + module
+        elapsed = fastest([sys.executable, '-m', name, '--help'],
+                          args.repeats)
+        print('{:>26} {:>10.3f}  {}'.format(
+            module, elapsed, ', '.join(loaded(name)) or '-'))
+        if args.budget is not None and elapsed > args.budget:
+            over.append(module)
+    if over:
+        sys.exit('over the {} s budget: {}'.format(args.budget,
+                                                    ', '.join(over)))
+
+
+def fastest(command, repeats):
+    """Time the fastest of several runs of a command.
+
+    Args:
+        command (list of str): The command to run
+        repeats (int): How many times to run it
+
+    Returns: float, the shortest wall time (s) of the runs
+
+    Raises:
+        RuntimeError: The command failed
+    """
+    best = float('inf')
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeats):
+            start = time.time()
+            if subprocess.call(command, stdout=devnull, cwd=ROOT) != 0:
+                raise RuntimeError('{} failed'.format(' '.join(command)))
+            best = min(best, time.time() - start)
+    return best
+
+
+def check_exports(module):
+    """Check the package functions can be called after importing a module.
+
+    Args:
+        module (str): The module of the package to import first
+
+    Raises:
+        RuntimeError: A package function could not be called
+    """
+    with open(os.devnull, 'w') as devnull:
+        if subprocess.call([sys.executable, '-c',
+                            EXPORTS_CHECK.format(module=module)],
+                           stdout=devnull, cwd=ROOT) != 0:
+            raise RuntimeError('the package functions are broken by '
+                               'importing {}'.format(module))
+
+
+def loaded(module):
+    """Find which of :py:data:`HEAVY` a module loads when imported.
+
+    Args:
+        module (str): The module to import
+
+    Returns: list of str, the heavy modules it loaded
+    """
+    code = ('import sys\n'
+            'import {}\n'
+            'print(" ".join(name for name in {!r} if name in sys.modules))'
+            ).format(module, HEAVY)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return output.decode().split()
+
+
+if __name__ == '__main__':
+    main()
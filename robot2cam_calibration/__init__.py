@@ -1,4 +1,68 @@
-from get_correspondences import get_correspondences
-from get_images import get_images_poses
-from compute_transformations import compute_transformation
-from check_transformation import check_transformation
\ No newline at end of file
+"""Calibrate the transformation between a robot and a camera.
+
+The functions below are imported from their modules on first use (see
+:pep:`562`), so each command only loads what it needs: computing a
+calibration does not need the robot or camera SDKs, opencv's GUI or a camera
+to be installed.
+"""
+import importlib
+import sys
+import types
+
+# the module each public function is defined in
+_EXPORTS = {
+    'get_correspondences': 'get_correspondences',
+    'get_images_poses': 'get_images',
+    'compute_transformation': 'compute_transformations',
+    'check_transformation': 'check_transformation',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    """Import a public function from its module the first time it is used.
+
+    Args:
+        name (str): The attribute being looked up
+
+    Returns: The function
+
+    Raises:
+        AttributeError: The name is not a public function of the package
+    """
+    if name not in _EXPORTS:
+        raise AttributeError("module '{}' has no attribute '{}'".format(
+            __name__, name))
+    module = importlib.import_module(__name__ + '.' + _EXPORTS[name])
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
+
+
+class _Package(types.ModuleType):
+    """The package module, which keeps its functions bound to the package.
+
+    Importing a module sets it as an attribute of the package, which for
+    get_correspondences and check_transformation would hide the function of
+    the same name, so the function is set instead.
+    """
+    def __setattr__(self, name, value):
+        if (isinstance(value, types.ModuleType) and
+                _EXPORTS.get(name) == name and
+                value.__name__ == __name__ + '.' + name):
+            value = getattr(value, name)
+        super(_Package, self).__setattr__(name, value)
+
+
+if sys.version_info >= (3, 5):
+    sys.modules[__name__].__class__ = _Package
+
+if sys.version_info < (3, 7):
+    # module level __getattr__ is not supported, import everything up front
+    for _name in __all__:
+        __getattr__(_name)
@@ -0,0 +1,439 @@
+"""A file to turn a recorded tracker and robot stream into correspondences.
+
+The tracker (ex: EBT) and the robot (ex: KUKA-RSI) are recorded as two
+independently timestamped streams (see :py:mod:`stream_recorder`). To pair
+them, the offset between the two clocks is estimated by matching the angular
+speed of the tracked object to the angular speed of the robot, which is the
+same whatever the unknown camera and tool transformations are. The robot pose
+is then interpolated (SLERP for rotation) at every tracker sample, samples
+taken while the robot was moving are discarded, and each stop of the robot is
+averaged into a single correspondence, written in the same form as
+robot2cam-record-ur so that it can be passed straight to robot2cam-compute.
+
+Everything is done with whole-array operations, so logs of several hours
+convert in seconds.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import argparse
+import datetime
+import json
+
+import numpy as np
+
+import robot2cam_calibration.rotations as rotations
+from robot2cam_calibration.stream_recorder import read_log
+from robot2cam_calibration.synchronize import interpolate_poses
+
+
+def main():
+    """
+    Exposes :py:func:`align_log` to the commandline. Run with arg `-h` for
+    more info.
+    """
+    parser = argparse.ArgumentParser(
+        description="Pair the tracker and robot poses of a stream log "
+                    "(robot2cam-record-stream) into a correspondences file")
+
+    parser.add_argument("--log", type=str,
+                        help="The stream log to read",
+                        required=True)
+
+    parser.add_argument("--out", type=str,
+                        help="The correspondences file to write",
+                        default="correspondences.json")
+
+    parser.add_argument("--tracker", type=str,
+                        help="The name of the tracker stream in the log",
+                        default="EBT")
+
+    parser.add_argument("--robot", type=str,
+                        help="The name of the robot stream in the log",
+                        default="KUKA")
+
+    parser.add_argument("--offset", type=float,
+                        help="The robot clock minus the tracker clock in "
+                             "seconds. Estimated from the motion if not "
+                             "given.",
+                        default=None)
+
+    parser.add_argument("--max_offset", type=float,
+                        help="The largest clock offset (s) to search for",
+                        default=1.0)
+
+    parser.add_argument("--max_speed", type=float,
+                        help="The fastest the robot may move (mm/s) for a "
+                             "sample to be kept",
+                        default=1.0)
+
+    parser.add_argument("--max_angular_speed", type=float,
+                        help="The fastest the robot may rotate (rad/s) for a "
+                             "sample to be kept",
+                        default=0.005)
+
+    parser.add_argument("--min_still", type=float,
+                        help="The shortest stop (s) which makes a "
+                             "correspondence",
+                        default=0.5)
+
+    args = parser.parse_args()
+
+    align_log(
+        log=args.log,
+        file_out=args.out,
+        tracker=args.tracker,
+        robot=args.robot,
+        offset=args.offset,
+        max_offset=args.max_offset,
+        max_speed=args.max_speed,
+        max_angular_speed=args.max_angular_speed,
+        min_still=args.min_still
+    )
+
+
+def align_log(log, file_out, tracker='EBT', robot='KUKA', offset=None,
+              max_offset=1.0, max_speed=1.0, max_angular_speed=0.005,
+              min_still=0.5):
+    """Read a stream log and write the correspondences found in it.
+
+    Args:
+        log (str): The stream log, see :py:mod:`stream_recorder`
+        file_out (str): The correspondences file to write
+        tracker (str): The name of the tracker stream, its poses are the
+                       camera to target transformations
+        robot (str): The name of the robot stream, its poses are the tcp to
+                     robot base transformations
+        offset (float): The robot clock minus the tracker clock in seconds,
+                        None to estimate it
+        max_offset (float): The largest clock offset (s) to search for
+        max_speed (float): The fastest the robot may move (mm/s) for a sample
+                           to be kept
+        max_angular_speed (float): The fastest the robot may rotate (rad/s)
+                                   for a sample to be kept
+        min_still (float): The shortest stop (s) which makes a
+                           correspondence
+
+    Returns: The correspondences as a dictionary
+
+    Raises:
+        ValueError: A stream is missing from the log or has no converter
+    """
+    _, streams = read_log(log)
+    tracker_times, tracker_poses = stream_poses(tracker, streams)
+    robot_times, robot_poses = stream_poses(robot, streams)
+    print('read {} tracker and {} robot samples'.format(
+        len(tracker_times), len(robot_times)))
+
+    correspondences = align(tracker_times, tracker_poses, robot_times,
+                            robot_poses, offset, max_offset, max_speed,
+                            max_angular_speed, min_still)
+    with open(file_out, 'w') as correspondences_file:
+        json.dump(correspondences, correspondences_file, indent=4)
+    print('{} correspondences written to {}'.format(
+        len(correspondences['tcp2robot']), file_out))
+    return correspondences
+
+
+def align(tracker_times, tracker_poses, robot_times, robot_poses,
+          offset=None, max_offset=1.0, max_speed=1.0,
+          max_angular_speed=0.005, min_still=0.5, max_gap=0.25, keep=0.5):
+    """Pair two timestamped pose streams into correspondences, one for each
+    stop of the robot.
+
+    Args:
+        tracker_times (n array): The increasing times of the tracker samples
+        tracker_poses (nx6 array): The camera to target poses
+        robot_times (m array): The increasing times of the robot samples
+        robot_poses (mx6 array): The tcp to robot base poses
+        offset (float): The robot clock minus the tracker clock in seconds,
+                        None to estimate it
+        max_offset (float): The largest clock offset (s) to search for
+        max_speed (float): The fastest the robot may move (mm/s) for a sample
+                           to be kept
+        max_angular_speed (float): The fastest the robot may rotate (rad/s)
+                                   for a sample to be kept
+        min_still (float): The shortest stop (s) which makes a
+                           correspondence
+        max_gap (float): The longest time (s) without a kept tracker sample
+                         within a single stop
+        keep (float): The fraction of each stop, around its middle, which is
+                      averaged
+
+    Returns: A dict with 'tcp2robot' and 'camera2grid', lists of poses, and
+        details of the alignment
+    """
+    tracker_times = np.asarray(tracker_times, dtype=float)
+    tracker_poses = np.asarray(tracker_poses, dtype=float)
+    robot_times = np.asarray(robot_times, dtype=float)
+    robot_poses = np.asarray(robot_poses, dtype=float)
+
+    correlation = None
+    if offset is None:
+        offset, correlation = estimate_clock_offset(
+            tracker_times, tracker_poses, robot_times, robot_poses,
+            max_offset)
+        print('estimated clock offset {:.4f} s (correlation {:.2f})'.format(
+            offset, correlation))
+
+    times = tracker_times + offset
+    inside = (times >= robot_times[0]) & (times <= robot_times[-1])
+    speed, angular_speed = pose_speeds(robot_times, robot_poses, times)
+    still = inside & (speed <= max_speed) & \
+        (angular_speed <= max_angular_speed)
+    starts, ends = still_segments(tracker_times, still, min_still, max_gap)
+    print('found {} stops'.format(len(starts)))
+
+    # average the middle of each stop
+    lengths = ends - starts
+    trim = np.floor(lengths * (1 - keep) / 2).astype(int)
+    starts, ends = starts + trim, ends - trim
+    robot_at_tracker = interpolate_poses(robot_times, robot_poses, times)
+    tcp2robot = average_segments(robot_at_tracker, starts, ends)
+    camera2grid = average_segments(tracker_poses, starts, ends)
+    total = np.r_[0, np.cumsum(tracker_times)]
+    sample_times = (total[ends] - total[starts]) / (ends - starts)
+
+    return {"time": str(datetime.datetime.now()),
+            "tcp2robot": tcp2robot.tolist(),
+            "camera2grid": camera2grid.tolist(),
+            "sample time": sample_times.tolist(),
+            "alignment": {"clock offset": offset,
+                          "offset correlation": correlation,
+                          "tracker samples": len(tracker_times),
+                          "robot samples": len(robot_times),
+                          "still samples": int(np.count_nonzero(still)),
+                          "averaged samples": int(np.sum(ends - starts)),
+                          "max speed": max_speed,
+                          "max angular speed": max_angular_speed}}
+
+
+def stream_poses(name, streams):
+    """Find the poses of a named stream of a stream log.
+
+    Args:
+        name (str): The name of the stream
+        streams (dict): The streams, as returned by
+                        :py:func:`stream_recorder.read_log`
+
+    Returns: A tuple, (n np.ndarray, the times of the valid samples, nx6
+        np.ndarray, the poses, x,y,z,axis-angle in mm and radians)
+
+    Raises:
+        ValueError: The stream is missing or has no converter
+    """
+    if name not in streams:
+        raise ValueError('there is no stream {} in the log, only {}'.format(
+            name, ', '.join(sorted(streams))))
+    if name not in CONVERTERS:
+        raise ValueError('there is no converter for stream {}, only '
+                         '{}'.format(name, ', '.join(sorted(CONVERTERS))))
+    valid, poses = CONVERTERS[name](streams[name]['values'])
+    return streams[name]['time'][valid], poses[valid]
+
+
+def ebt_poses(values):
+    """Convert samples from Edge Based Tracking into poses.
+
+    Args:
+        values (nx19 array): The EBT fields, see
+                             :py:data:`stream_recorder.EBT_FIELDS`
+
+    Returns: A tuple, (n np.ndarray of bool, whether the object was tracked,
+        nx6 np.ndarray, the poses in mm)
+    """
+    values = np.asarray(values, dtype=float)
+    mats = values[:, 2:18].reshape(-1, 4, 4)
+    poses = rotations.mat2pose(mats)
+    # EBT reports meters
+    poses[:, :3] *= 1000
+    return values[:, 0] == 1, poses
+
+
+def kuka_poses(values):
+    """Convert KUKA X,Y,Z,A,B,C samples into poses.
+
+    Args:
+        values (nx6 array): The positions in mm and Z,Y,X euler angles in
+                            degrees
+
+    Returns: A tuple, (n np.ndarray of bool, all True, nx6 np.ndarray, the
+        poses)
+    """
+    values = np.asarray(values, dtype=float)
+    poses = np.empty(values.shape)
+    poses[:, :3] = values[:, :3]
+    poses[:, 3:] = rotations.mat2rotvec(
+        rotations.euler2mat(values[:, 3:], degrees=True))
+    return np.ones(len(values), dtype=bool), poses
+
+
+CONVERTERS = {'EBT': ebt_poses, 'KUKA': kuka_poses}
+
+
+def pose_speeds(sample_times, sample_poses, times, window=0.1):
+    """The linear and angular speed of a pose stream at arbitrary times.
+
+    Speeds are central differences over the window, from interpolated poses,
+    so they do not depend on how evenly the stream was sampled.
+
+    Args:
+        sample_times (n array): The increasing times of the samples
+        sample_poses (nx6 array): The poses
+        times (m array): The times at which to find the speed
+        window (float): The time (s) to difference over
+
+    Returns: A tuple, (m np.ndarray, the linear speed, m np.ndarray, the
+        angular speed in radians per second)
+    """
+    times = np.asarray(times, dtype=float)
+    before = interpolate_poses(sample_times, sample_poses, times - window / 2)
+    after = interpolate_poses(sample_times, sample_poses, times + window / 2)
+    speed = np.linalg.norm(after[:, :3] - before[:, :3], axis=1) / window
+    dot = np.abs(np.sum(rotations.rotvec2quat(before[:, 3:]) *
+                        rotations.rotvec2quat(after[:, 3:]), axis=1))
+    angular_speed = 2 * np.arccos(np.clip(dot, 0, 1)) / window
+    return speed, angular_speed
+
+
+def estimate_clock_offset(tracker_times, tracker_poses, robot_times,
+                          robot_poses, max_offset=1.0, step=0.01):
+    """Estimate the robot clock minus the tracker clock.
+
+    The angular speed of the tracked object and of the robot tool are the
+    same, so the offset is the shift which best correlates the two.
+
+    Args:
+        tracker_times (n array): The increasing times of the tracker samples
+        tracker_poses (nx6 array): The camera to target poses
+        robot_times (m array): The increasing times of the robot samples
+        robot_poses (mx6 array): The tcp to robot base poses
+        max_offset (float): The largest offset (s) to search for
+        step (float): The resolution (s) the speeds are compared at, the
+                      result is refined below this
+
+    Returns: A tuple, (float, the offset, float, the correlation of the
+        angular speeds at that offset, 1 for a perfect match)
+
+    Raises:
+        ValueError: The streams do not overlap or the robot never rotates
+    """
+    lags = int(np.ceil(max_offset / step))
+    start = max(tracker_times[0], robot_times[0])
+    end = min(tracker_times[-1], robot_times[-1])
+    if end - start < 4 * max_offset:
+        raise ValueError('the streams do not overlap for long enough to '
+                         'estimate the clock offset')
+    steps = int((end - start) / step)
+    grid = start + step * np.arange(steps)
+    tracker_speed = pose_speeds(tracker_times, tracker_poses, grid,
+                                2 * step)[1]
+    robot_speed = pose_speeds(robot_times, robot_poses,
+                              start + step * np.arange(-lags, steps + lags),
+                              2 * step)[1]
+    tracker_speed = tracker_speed - tracker_speed.mean()
+    if not np.any(tracker_speed) or np.ptp(robot_speed) == 0:
+        raise ValueError('the robot must rotate to estimate the clock '
+                         'offset, pass it instead')
+
+    # robot_speed[k:k + steps] is the robot at grid + (k - lags) * step. As
+    # the tracker speed has zero mean, only the norm of each robot window
+    # needs centering, which is done with running sums.
+    products = np.correlate(robot_speed, tracker_speed, 'valid')
+    sums = np.r_[0, np.cumsum(robot_speed)]
+    squares = np.r_[0, np.cumsum(robot_speed ** 2)]
+    window_sums = sums[steps:] - sums[:-steps]
+    variances = squares[steps:] - squares[:-steps] - window_sums ** 2 / steps
+    correlation = products / np.maximum(
+        np.sqrt(np.maximum(variances, 0)) * np.linalg.norm(tracker_speed),
+        1e-12)
+
+    best = int(np.argmax(correlation))
+    shift = 0.0
+    if 0 < best < 2 * lags:
+        # fit a parabola through the peak for sub-step resolution
+        left, middle, right = correlation[best - 1:best + 2]
+        curvature = left - 2 * middle + right
+        if curvature < 0:
+            shift = 0.5 * (left - right) / curvature
+    return float((best - lags + shift) * step), float(correlation[best])
+
+
+def still_segments(times, still, min_duration=0.5, max_gap=0.25):
+    """Find the runs of still samples.
+
+    Args:
+        times (n array): The increasing sample times
+        still (n array of bool): Whether each sample was taken while still
+        min_duration (float): The shortest run (s) to keep
+        max_gap (float): The longest time (s) between samples within a run
+
+    Returns: A tuple, (k np.ndarray, the index of the first sample of each
+        run, k np.ndarray, one past the index of the last sample)
+    """
+    times = np.asarray(times, dtype=float)
+    index = np.flatnonzero(still)
+    if not len(index):
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    breaks = np.flatnonzero((np.diff(index) > 1) |
+                            (np.diff(times[index]) > max_gap)) + 1
+    starts = index[np.r_[0, breaks]]
+    ends = index[np.r_[breaks - 1, len(index) - 1]] + 1
+    long_enough = times[ends - 1] - times[starts] >= min_duration
+    return starts[long_enough], ends[long_enough]
+
+
+def average_segments(poses, starts, ends):
+    """Average runs of poses.
+
+    Positions are averaged directly and rotations are averaged as
+    quaternions, which is accurate for the small spread within a stop.
+
+    Args:
+        poses (nx6 array): The poses
+        starts (k array): The index of the first pose of each run
+        ends (k array): One past the index of the last pose of each run,
+                        the runs must be in order and not overlap
+
+    Returns: kx6 np.ndarray of the average poses
+    """
+    poses = np.asarray(poses, dtype=float)
+    if not len(starts):
+        return np.empty((0, 6))
+    counts = ends - starts
+    run_starts = np.r_[0, np.cumsum(counts)[:-1]]
+    index = np.repeat(starts - run_starts, counts) + np.arange(counts.sum())
+    quats = rotations.rotvec2quat(poses[index, 3:])
+    # flip quaternions onto the same hemisphere as the first of their run
+    reference = np.repeat(quats[run_starts], counts, axis=0)
+    quats *= np.where(np.sum(quats * reference, axis=1) < 0, -1, 1)[:, None]
+
+    result = np.empty((len(starts), 6))
+    result[:, :3] = np.add.reduceat(poses[index, :3], run_starts) / \
+        counts[:, None]
+    result[:, 3:] = rotations.quat2rotvec(np.add.reduceat(quats, run_starts))
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+"""A file to compute the calibrations of many cells in one run.
+
+A manifest lists the correspondence files to solve, each with its own
+options for :py:func:`compute_transformations.compute_transformation`. The
+jobs are spread over a pool of processes, forked from one interpreter with
+scipy already loaded, and a job which runs past its time budget is stopped
+so it can not hold up the rest. Each job writes its transformation file and
+a log of its output, and a summary row is printed as each job finishes and
+written to a csv file at the end.
+
+The manifest is a json file::
+
+    {
+        "defaults": {"iter": 100, "timeout": 600},
+        "jobs": [
+            {"name": "cell-01",
+             "correspondences": "cell-01/correspondences.json"},
+            {"name": "cell-02",
+             "correspondences": "cell-02/correspondences.json",
+             "out": "cell-02/transformation.json",
+             "consensus": true, "timeout": 120}
+        ]
+    }
+
+The options are named as the arguments of ``robot2cam-compute`` (see
+:py:data:`OPTIONS`). Paths are relative to the manifest and a job's
+transformation is written next to its correspondences unless `out` is given.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import argparse
+import collections
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import robot2cam_calibration.compute_transformations as compute
+
+# The manifest options, their compute_transformation arguments and defaults,
+# which are those of robot2cam-compute. Each job solves in one process, as the
+# jobs already use every CPU.
+OPTIONS = collections.OrderedDict([
+    ('cam2rob', ('cam2rob_guess', [0, 0, 1000, 0, 0, 0])),
+    ('tcp2target', ('tcp2target_guess', [0, 0, 0, 0, 0, 0])),
+    ('max_cam2rob', ('max_cam2rob_deviation', 2000)),
+    ('max_tcp2target', ('max_tcp2target_deviation', 500)),
+    ('iter', ('iterations', 250)),
+    ('minimizer', ('minimizer', 'SLSQP')),
+    ('uncertainty', ('uncertainty', None)),
+    ('resamples', ('resamples', 200)),
+    ('consensus', ('consensus', False)),
+    ('hypotheses', ('hypotheses', 500)),
+    ('threshold', ('threshold', None)),
+    ('workers', ('workers', 1)),
+])
+
+SUMMARY_FIELDS = ['name', 'status', 'seconds', 'error', 'inliers',
+                  'outliers', 'out', 'detail']
+
+
+def main():
+    """
+    Exposes :py:func:`run_batch` to the commandline. Run with arg `-h` for
+    more info.
+    """
+    parser = argparse.ArgumentParser(
+        description="Compute the camera to robot transformations of many "
+                    "cells listed in a manifest")
+
+    parser.add_argument("--manifest", type=str,
+                        help="The json manifest of jobs, see batch.py",
+                        required=True)
+
+    parser.add_argument("--workers", type=int,
+                        help="The number of jobs to solve at once. Defaults "
+                             "to the number of CPUs.",
+                        default=None)
+
+    parser.add_argument("--timeout", type=float,
+                        help="The time budget (s) of a job which does not "
+                             "set its own. Defaults to no limit.",
+                        default=None)
+
+    parser.add_argument("--summary", type=str,
+                        help="The csv file to write the summary to. "
+                             "Defaults to the manifest name with "
+                             "_summary.csv.",
+                        default=None)
+
+    args = parser.parse_args()
+
+    rows = run_batch(
+        manifest=args.manifest,
+        workers=args.workers,
+        timeout=args.timeout,
+        summary=args.summary
+    )
+    failed = [row['name'] for row in rows if row['status'] != 'done']
+    if failed:
+        sys.exit('{} of {} jobs did not finish: {}'.format(
+            len(failed), len(rows), ', '.join(failed)))
+
+
+def run_batch(manifest, workers=None, timeout=None, summary=None,
+              poll=0.05):
+    """Solve every job of a manifest.
+
+    Args:
+        manifest (str): The json manifest of jobs
+        workers (int): The number of jobs to solve at once, None for one per
+                       CPU
+        timeout (float): The time budget (s) of a job which does not set its
+                         own, None for no limit
+        summary (str): The csv file to write the summary to, None for the
+                       manifest name with _summary.csv
+        poll (float): How often (s) to check on the running jobs
+
+    Returns: A list of dictionaries, the summary row of each job in the order
+        they finished, see :py:data:`SUMMARY_FIELDS`
+    """
+    jobs = read_manifest(manifest, timeout)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if summary is None:
+        summary = os.path.splitext(manifest)[0] + '_summary.csv'
+    # loaded once here so the forked jobs do not each import it
+    from scipy import optimize  # noqa: F401
+
+    print('solving {} jobs with {} workers'.format(len(jobs), workers))
+    print_row(dict(zip(SUMMARY_FIELDS, SUMMARY_FIELDS)))
+    pending = collections.deque(jobs)
+    running = []
+    rows = []
+    while pending or running:
+        while pending and len(running) < workers:
+            running.append(start_job(pending.popleft()))
+        time.sleep(poll)
+        still_running = []
+        for job, process, receiver, started in running:
+            elapsed = time.time() - started
+            if receiver.poll():
+                try:
+                    status, detail = receiver.recv()
+                except EOFError:
+                    process.join()
+                    status, detail = 'failed', 'exited with code {}'.format(
+                        process.exitcode)
+            elif job['timeout'] is not None and elapsed > job['timeout']:
+                process.terminate()
+                status, detail = 'timeout', 'stopped after {:.0f} s'.format(
+                    elapsed)
+            else:
+                still_running.append((job, process, receiver, started))
+                continue
+            process.join()
+            receiver.close()
+            row = summary_row(job, status, detail, elapsed)
+            print_row(row)
+            rows.append(row)
+        running = still_running
+
+    with open(summary, 'w') as summary_file:
+        writer = csv.DictWriter(summary_file, SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print('{} of {} jobs done, summary written to {}'.format(
+        sum(row['status'] == 'done' for row in rows), len(rows), summary))
+    return rows
+
+
+def read_manifest(manifest, timeout=None):
+    """Read and check the jobs of a manifest.
+
+    Args:
+        manifest (str): The json manifest of jobs
+        timeout (float): The time budget (s) of a job which does not set its
+                         own, None for no limit
+
+    Returns: A list of dictionaries, each job's 'name', 'correspondences',
+        'out', 'log', 'timeout' and the 'options' to pass to
+        :py:func:`compute_transformations.compute_transformation`
+
+    Raises:
+        ValueError: The manifest has no jobs, a job has no correspondences
+                    or an unknown option, or two jobs write the same file
+    """
+    with open(manifest, 'r') as manifest_file:
+        manifest_dictionary = json.load(manifest_file)
+    folder = os.path.dirname(os.path.abspath(manifest))
+    defaults = manifest_dictionary.get('defaults', {})
+    entries = manifest_dictionary.get('jobs', [])
+    if not entries:
+        raise ValueError('{} has no jobs'.format(manifest))
+
+    jobs = []
+    outs = set()
+    for number, entry in enumerate(entries):
+        settings = dict(defaults)
+        settings.update(entry)
+        if 'correspondences' not in settings:
+            raise ValueError('job {} has no correspondences'.format(number))
+        correspondences = os.path.join(folder, settings.pop(
+            'correspondences'))
+        out = settings.pop('out', None)
+        if out is None:
+            out = os.path.join(os.path.dirname(correspondences),
+                               'transformation.json')
+        out = os.path.join(folder, out)
+        if out in outs:
+            raise ValueError('more than one job writes {}'.format(out))
+        outs.add(out)
+        name = settings.pop('name', entry['correspondences'])
+        job_timeout = settings.pop('timeout', timeout)
+
+        jobs.append({'name': name,
+                     'correspondences': correspondences,
+                     'out': out,
+                     'log': os.path.splitext(out)[0] + '.log',
+                     'timeout': job_timeout,
+                     'options': compute_arguments(settings, name)})
+    return jobs
+
+
+def compute_arguments(options, name):
+    """Convert job options to the arguments of
+    :py:func:`compute_transformations.compute_transformation`.
+
+    Args:
+        options (dict): The options, named as in :py:data:`OPTIONS`
+        name (str): The name of the job, for errors
+
+    Returns: A dictionary of the keyword arguments, with the defaults of the
+        options which are not given
+
+    Raises:
+        ValueError: There is an unknown option
+    """
+    unknown = set(options) - set(OPTIONS)
+    if unknown:
+        raise ValueError('job {} has unknown options: {}'.format(
+            name, ', '.join(sorted(unknown))))
+    return dict((argument, options.get(option, default))
+                for option, (argument, default) in OPTIONS.items())
+
+
+def start_job(job):
+    """Start solving a job in a new process.
+
+    Args:
+        job (dict): The job, see :py:func:`read_manifest`
+
+    Returns: A tuple, (dict, the job, multiprocessing.Process, the process
+        solving it, multiprocessing.Connection, where the process sends its
+        result, float, when it was started)
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_solve_job, args=(job, sender))
+    process.start()
+    # only the job holds the sending end, so its exit is seen as an EOF
+    sender.close()
+    return job, process, receiver, time.time()
+
+
+def _solve_job(job, sender):
+    """Solve one job in a worker process and send back how it went.
+
+    The output of the solve goes to the job's log.
+
+    Args:
+        job (dict): The job, see :py:func:`read_manifest`
+        sender (multiprocessing.Connection): Where to send the result, a
+            tuple of the status, 'done' or 'failed', and the result
+            dictionary or the error
+    """
+    with open(job['log'], 'w') as log:
+        sys.stdout = sys.stderr = log
+        try:
+            result = compute.compute_transformation(
+                job['correspondences'], job['out'], **job['options'])
+        except Exception as exception:
+            traceback.print_exc()
+            sender.send(('failed', '{}: {}'.format(
+                type(exception).__name__, exception)))
+        else:
+            sender.send(('done', result))
+    sender.close()
+
+
+def summary_row(job, status, detail, elapsed):
+    """Summarize how a job went.
+
+    Args:
+        job (dict): The job, see :py:func:`read_manifest`
+        status (str): 'done', 'failed' or 'timeout'
+        detail (dict or str): The result dictionary of a finished job,
+                              otherwise what went wrong
+        elapsed (float): How long (s) the job ran
+
+    Returns: A dictionary with the :py:data:`SUMMARY_FIELDS`
+    """
+    row = {'name': job['name'], 'status': status,
+           'seconds': round(elapsed, 2), 'error': '', 'inliers': '',
+           'outliers': '', 'out': job['out'], 'detail': ''}
+    if status != 'done':
+        row['detail'] = detail
+        return row
+    minimization = detail.get('minimization', {})
+    error = minimization.get(
+        'error', minimization.get('best result', {}).get('error'))
+    if error is not None:
+        row['error'] = float(error)
+    row['inliers'] = len(detail.get('inliers', []))
+    row['outliers'] = len(detail.get('outliers', []))
+    return row
+
+
+def print_row(row):
+    """Print one row of the summary table.
+
+    Args:
+        row (dict): The row, see :py:func:`summary_row`
+    """
+    error = row['error']
+    if isinstance(error, float):
+        error = '{:.4g}'.format(error)
+    print('{:<24} {:<8} {:>8} {:>10} {:>8} {:>8}  {}'.format(
+        row['name'], row['status'], row['seconds'], error, row['inliers'],
+        row['outliers'], row['detail'] or row['out']))
+
+
+if __name__ == '__main__':
+    main()
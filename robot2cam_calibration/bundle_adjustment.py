@@ -0,0 +1,418 @@
+"""A file to refine a calibration by minimizing the reprojection error of every
+grid corner.
+
+:py:mod:`compute_transformations` works from one camera to grid pose per
+image, which throws away how well each pose was actually observed. Here every
+detected corner (recorded by `robot2cam-record-ur` as `corners` and
+`object_points`) is projected through the robot pose and the camera to robot
+and tcp to target transformations, and the pixel error is minimized directly.
+The camera intrinsics can optionally be refined at the same time.
+
+Each corner only depends on the transformation (and intrinsics) of the camera
+which saw it and on the shared tcp to target transformation, so the problem is
+solved with a sparse least squares solver whose memory and time grow linearly
+with the number of corners.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import argparse
+import datetime
+import json
+import os
+
+import numpy as np
+
+import robot2cam_calibration.calibrations as camera_calibrations
+import robot2cam_calibration.rotations as rotations
+
+# The number of intrinsic parameters per camera: fx, fy, cx, cy, k1, k2, p1,
+# p2, k3
+INTRINSIC_SIZE = 9
+
+
+def main():
+    """
+    Exposes :py:func:`refine_transformation` to the commandline. Run with arg
+    `-h` for more info.
+    """
+    parser = argparse.ArgumentParser(
+        description="Refine a camera to robot transformation by minimizing "
+                    "the reprojection error of every grid corner")
+
+    parser.add_argument("--correspondences", type=str,
+                        help='The correspondences file, with corners, as '
+                             'written by robot2cam-record-ur.',
+                        default="correspondences.json")
+
+    parser.add_argument("--transformation", type=str,
+                        help='The transformation to refine, as written by '
+                             'robot2cam-compute.',
+                        default="transformation.json")
+
+    parser.add_argument("--calibration", type=str, nargs='+',
+                        help="The camera calibration file of each camera.",
+                        required=True)
+
+    parser.add_argument("--out", type=str,
+                        help="File to save output to",
+                        default="refined_transformation.json")
+
+    parser.add_argument("--intrinsics", action='store_true',
+                        help="Also refine the camera intrinsics and "
+                             "distortion.")
+
+    args = parser.parse_args()
+
+    result = refine_transformation(
+        correspondences=args.correspondences,
+        transformation=args.transformation,
+        calibrations=args.calibration,
+        file_out=args.out,
+        refine_intrinsics=args.intrinsics
+    )
+
+    print('Final Result:\n{}'.format(result['bundle adjustment']))
+
+
+def refine_transformation(correspondences, transformation, calibrations,
+                          file_out, refine_intrinsics=False):
+    """Refine a transformation file using every recorded grid corner.
+
+    Args:
+        correspondences (str): The correspondences file, which must include
+            `corners` and `object_points`
+        transformation (str): The transformation file to start from
+        calibrations (list of str): The camera calibration file of each
+            camera, in the order of the cameras in the correspondences
+        file_out (str): The file to write the refined transformation to
+        refine_intrinsics (bool): Whether to also refine the intrinsics
+
+    Returns: The refined transformation as a dictionary
+
+    Raises:
+        ValueError: The correspondences do not include corners, or the
+            number of calibrations does not match the number of cameras
+    """
+    with open(correspondences, 'r') as correspondences_file:
+        correspondences_dictionary = json.load(correspondences_file)
+    with open(transformation, 'r') as transformation_file:
+        transformation_dictionary = json.load(transformation_file)
+    if 'corners' not in correspondences_dictionary:
+        raise ValueError('the correspondences do not include corners, '
+                         'record them again with robot2cam-record-ur')
+
+    cameras = correspondences_dictionary.get('cameras', [None])
+    if len(calibrations) != len(cameras):
+        raise ValueError('there must be one calibration per camera')
+    intrinsics = []
+    for calibration in calibrations:
+        calibration = camera_calibrations.load(calibration)
+        intrinsics.append(intrinsic_vector(calibration.intrinsic,
+                                           calibration.distortion))
+
+    cam2robot = transformation_dictionary['cam2robot']
+    if not isinstance(cam2robot, list):
+        cam2robot = [cam2robot]
+    cam2robot = np.array([pose['xyz-angle'] for pose in cam2robot])
+    tcp2target = np.array(transformation_dictionary['tcp2target']['xyz-angle'])
+
+    data = observations(correspondences_dictionary)
+    print('refining with {} corners from {} images'.format(
+        len(data[1]), len(data[0])))
+    result = bundle_adjust(data, cam2robot, tcp2target, np.array(intrinsics),
+                           refine_intrinsics=refine_intrinsics)
+
+    json_dict = dict(transformation_dictionary)
+    json_dict["time"] = str(datetime.datetime.now())
+    poses = result["poses"]
+    if len(cameras) > 1:
+        json_dict["cam2robot"] = [
+            {"camera": name, "xyz-angle": pose.tolist(),
+             "Tmatrix": rotations.pose2mat(pose).tolist()}
+            for name, pose in zip(cameras, poses[:-1])]
+    else:
+        json_dict["cam2robot"] = {
+            "xyz-angle": poses[0].tolist(),
+            "Tmatrix": rotations.pose2mat(poses[0]).tolist()}
+    json_dict["tcp2target"] = {
+        "xyz-angle": poses[-1].tolist(),
+        "Tmatrix": rotations.pose2mat(poses[-1]).tolist()}
+    json_dict["bundle adjustment"] = {
+        "corners": len(data[1]),
+        "images": len(data[0]),
+        "initial rms error": result["initial rms error"],
+        "rms error": result["rms error"],
+        "success": str(result["result"].success),
+        "message": result["result"].message}
+    if refine_intrinsics:
+        json_dict["bundle adjustment"]["intrinsics"] = [
+            {"intrinsic": intrinsic.tolist(),
+             "distortion": distortion.tolist()}
+            for intrinsic, distortion in
+            (intrinsic_matrix(vector) for vector in result["intrinsics"])]
+
+    with open(os.path.splitext(file_out)[0] + '.json', 'w') as \
+            result_json_file:
+        json.dump(json_dict, result_json_file, indent=4)
+    return json_dict
+
+
+def intrinsic_vector(intrinsic, distortion):
+    """Pack an intrinsic matrix and distortion into a parameter vector.
+
+    Args:
+        intrinsic (3x3 array): The intrinsic matrix
+        distortion (array): The distortion, k1, k2, p1, p2[, k3]
+
+    Returns: 9 element np.ndarray, fx, fy, cx, cy, k1, k2, p1, p2, k3
+
+    Raises:
+        ValueError: The distortion model is not supported
+    """
+    intrinsic = np.asarray(intrinsic, dtype=float)
+    distortion = np.ravel(distortion).astype(float)
+    if len(distortion) not in (4, 5):
+        raise ValueError('only 4 or 5 parameter distortion is supported')
+    vector = np.zeros(INTRINSIC_SIZE)
+    vector[:4] = (intrinsic[0, 0], intrinsic[1, 1], intrinsic[0, 2],
+                  intrinsic[1, 2])
+    vector[4:4 + len(distortion)] = distortion
+    return vector
+
+
+def intrinsic_matrix(vector):
+    """Unpack a parameter vector from :py:func:`intrinsic_vector`.
+
+    Args:
+        vector (9 element array): fx, fy, cx, cy, k1, k2, p1, p2, k3
+
+    Returns: A tuple, (3x3 np.ndarray, the intrinsic matrix, 5 element
+        np.ndarray, the distortion)
+    """
+    fx, fy, cx, cy = vector[:4]
+    return (np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]]),
+            np.asarray(vector[4:]))
+
+
+def observations(correspondences):
+    """Flatten the corners of a correspondences dictionary.
+
+    Args:
+        correspondences (dict): The correspondences, with `tcp2robot`,
+            `corners` and `object_points` fields. With several cameras, the
+            corners and object points of each sample are lists by camera.
+
+    Returns: A tuple, (nx6 np.ndarray of the robot pose of each image, k
+        np.ndarray of the image each corner is in, k np.ndarray of the camera
+        which saw each corner, kx2 np.ndarray of the corners, kx3 np.ndarray
+        of the matching grid points)
+    """
+    multi_camera = 'cameras' in correspondences
+    poses = []
+    image_index = []
+    camera_index = []
+    corners = []
+    object_points = []
+    for pose, sample_corners, sample_points in zip(
+            correspondences['tcp2robot'], correspondences['corners'],
+            correspondences['object_points']):
+        if not multi_camera:
+            sample_corners = [sample_corners]
+            sample_points = [sample_points]
+        for camera, (seen, points) in enumerate(zip(sample_corners,
+                                                    sample_points)):
+            if not seen:
+                continue
+            image_index.extend([len(poses)] * len(seen))
+            camera_index.extend([camera] * len(seen))
+            corners.extend(seen)
+            object_points.extend(points)
+        poses.append(pose)
+    return (np.asarray(poses, dtype=float).reshape(-1, 6),
+            np.asarray(image_index, dtype=int),
+            np.asarray(camera_index, dtype=int),
+            np.asarray(corners, dtype=float).reshape(-1, 2),
+            np.asarray(object_points, dtype=float).reshape(-1, 3))
+
+
+def project(points, intrinsics):
+    """Project points in camera coordinates onto the image.
+
+    This is the vectorized equivalent of :py:func:`cv2.projectPoints` with
+    a separate set of intrinsics for every point.
+
+    Args:
+        points (kx3 array): The points in camera coordinates
+        intrinsics (kx9 array): The intrinsics of the camera which sees each
+            point, see :py:func:`intrinsic_vector`
+
+    Returns: kx2 np.ndarray of the image points
+    """
+    x = points[:, 0] / points[:, 2]
+    y = points[:, 1] / points[:, 2]
+    fx, fy, cx, cy, k1, k2, p1, p2, k3 = intrinsics.T
+    r2 = x * x + y * y
+    radial = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+    distorted_x = x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x)
+    distorted_y = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y
+    return np.column_stack((fx * distorted_x + cx, fy * distorted_y + cy))
+
+
+def reprojection_residuals(parameters, data, cameras, intrinsics=None):
+    """The pixel error of every corner for a set of transformations.
+
+    Args:
+        parameters (array): The camera to robot transformation of each camera
+            and the tcp to target transformation (all x,y,z,axis-angle),
+            followed by the intrinsics of each camera if they are being
+            refined
+        data (tuple): The observations, see :py:func:`observations`
+        cameras (int): The number of cameras
+        intrinsics (cameras x 9 array): The fixed intrinsics, or None if they
+            are part of the parameters
+
+    Returns: 2k np.ndarray of the x and y pixel error of each corner
+    """
+    tcp2robot, image_index, camera_index, corners, object_points = data
+    poses_end = 6 * (cameras + 1)
+    poses = rotations.pose2mat(np.reshape(parameters[:poses_end], (-1, 6)))
+    if intrinsics is None:
+        intrinsics = np.reshape(parameters[poses_end:], (-1, INTRINSIC_SIZE))
+
+    # camera to grid for every image and camera pair that was observed
+    tcp2target = poses[-1]
+    robot_grid = np.matmul(rotations.pose2mat(tcp2robot), tcp2target)
+    pairs, pair_index = np.unique(image_index * cameras + camera_index,
+                                  return_inverse=True)
+    cam2grid = np.matmul(poses[pairs % cameras], robot_grid[pairs // cameras])
+
+    transform = cam2grid[pair_index]
+    points = (np.einsum('kij,kj->ki', transform[:, :3, :3], object_points) +
+              transform[:, :3, 3])
+    return (project(points, intrinsics[camera_index]) - corners).ravel()
+
+
+def reprojection_sparsity(camera_index, cameras, refine_intrinsics=False):
+    """The structure of the Jacobian of :py:func:`reprojection_residuals`.
+
+    Args:
+        camera_index (k array): The camera which saw each corner
+        cameras (int): The number of cameras
+        refine_intrinsics (bool): Whether the intrinsics are parameters
+
+    Returns: A scipy.sparse.csr_matrix of the non-zero entries
+    """
+    camera_index = np.asarray(camera_index, dtype=int)
+    rows = np.arange(2 * len(camera_index))
+    corner_camera = np.repeat(camera_index, 2)
+    # each corner depends on its camera pose, the tcp to target and its
+    # camera intrinsics
+    columns = [6 * corner_camera[:, None] + np.arange(6),
+               6 * cameras + np.arange(6) + np.zeros((len(rows), 1), int)]
+    if refine_intrinsics:
+        columns.append(6 * (cameras + 1) +
+                       INTRINSIC_SIZE * corner_camera[:, None] +
+                       np.arange(INTRINSIC_SIZE))
+    columns = np.hstack(columns)
+    size = 6 * (cameras + 1) + (INTRINSIC_SIZE * cameras
+                                if refine_intrinsics else 0)
+    from scipy import sparse
+    return sparse.csr_matrix(
+        (np.ones(columns.size, dtype=int),
+         (np.repeat(rows, columns.shape[1]), columns.ravel())),
+        shape=(len(rows), size))
+
+
+def bundle_adjust(data, cam2robot, tcp2target, intrinsics,
+                  refine_intrinsics=False, loss='huber', pixel_scale=1.0):
+    """Minimize the reprojection error of every corner.
+
+    Args:
+        data (tuple): The observations, see :py:func:`observations`
+        cam2robot (cameras x 6 array): The initial camera to robot
+            transformations
+        tcp2target (6 element array): The initial tcp to target
+            transformation
+        intrinsics (cameras x 9 array): The initial intrinsics, see
+            :py:func:`intrinsic_vector`
+        refine_intrinsics (bool): Whether to also refine the intrinsics
+        loss (str): The scipy.optimize.least_squares loss, a robust loss
+            limits the influence of badly detected corners
+        pixel_scale (float): The error in pixels beyond which the robust
+            loss takes effect
+
+    Returns: A dictionary with the refined `poses` (the camera to robot
+        transformations followed by the tcp to target), `intrinsics`, the
+        `initial rms error` and `rms error` in pixels and the scipy `result`
+    """
+    cam2robot = np.reshape(cam2robot, (-1, 6))
+    intrinsics = np.reshape(intrinsics, (-1, INTRINSIC_SIZE)).astype(float)
+    cameras = len(cam2robot)
+    guess = np.concatenate((cam2robot.ravel(), tcp2target))
+    fixed_intrinsics = intrinsics
+    if refine_intrinsics:
+        guess = np.concatenate((guess, intrinsics.ravel()))
+        fixed_intrinsics = None
+
+    initial = reprojection_residuals(guess, data, cameras, fixed_intrinsics)
+    sparsity = reprojection_sparsity(data[2], cameras, refine_intrinsics)
+    from scipy import optimize
+    # A robust loss far from the solution makes the sparse solver crawl, so
+    # converge with plain least squares first and then discount the outliers
+    result = optimize.least_squares(
+        reprojection_residuals, guess, jac_sparsity=sparsity, x_scale='jac',
+        method='trf', tr_solver='lsmr',
+        args=(data, cameras, fixed_intrinsics))
+    if loss != 'linear':
+        result = optimize.least_squares(
+            reprojection_residuals, result.x, jac_sparsity=sparsity,
+            x_scale='jac', loss=loss, f_scale=pixel_scale, method='trf',
+            tr_solver='lsmr', args=(data, cameras, fixed_intrinsics))
+
+    poses_end = 6 * (cameras + 1)
+    poses = rotations.mat2pose(rotations.pose2mat(
+        result.x[:poses_end].reshape(-1, 6)))
+    if refine_intrinsics:
+        intrinsics = result.x[poses_end:].reshape(-1, INTRINSIC_SIZE)
+    return {"poses": poses,
+            "intrinsics": intrinsics,
+            "initial rms error": rms(initial),
+            "rms error": rms(result.fun),
+            "result": result}
+
+
+def rms(residuals):
+    """The root mean square pixel error from x,y residuals.
+
+    Args:
+        residuals (2k array): The x and y error of each corner
+
+    Returns: Float, the rms distance in pixels
+    """
+    residuals = np.reshape(residuals, (-1, 2))
+    return float(np.sqrt(np.mean(np.sum(residuals ** 2, axis=1))))
+
+
+if __name__ == "__main__":
+    main()
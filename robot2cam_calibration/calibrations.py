@@ -0,0 +1,265 @@
+"""A shared registry of camera calibrations and the data derived from them.
+
+Several parts of the package need a camera's calibration: tracking the grid,
+checking, refining and planning a calibration. Rather than each reading and
+parsing the calibration file and rebuilding what it needs from it, they ask
+:py:func:`load`, which reads a file once per process and hands out the same
+:py:class:`CameraCalibration` to everyone. The calibration keeps what is
+derived from it, the inverse of the intrinsic matrix and the undistortion
+maps for each image size, so they are only computed once.
+
+Computing the undistortion maps is the expensive part and they only depend on
+the calibration and the image size, so they are also kept on disk, in the
+folder named by the ``ROBOT2CAM_CACHE`` environment variable or
+``~/.cache/robot2cam_calibration``, named by a hash of the calibration file.
+Set ``ROBOT2CAM_CACHE`` to an empty string to only cache them in memory.
+
+The corner coordinates of a chessboard only depend on its geometry, so
+:py:func:`chessboard_points` builds them once per geometry as well.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+# the calibrations loaded, by (camera, hash of the file)
+_calibrations = {}
+# the hash of each file read, by path, with the modification time and size it
+# had, so an unchanged file is not read again
+_hashes = {}
+# the corners of each chessboard geometry, by (rows, cols, space)
+_chessboards = {}
+_lock = threading.Lock()
+
+
+def cache_folder():
+    """The folder the undistortion maps are kept in between runs.
+
+    Returns: str, the folder, or None if they are only kept in memory
+    """
+    folder = os.environ.get('ROBOT2CAM_CACHE')
+    if folder is None:
+        folder = os.path.join(os.path.expanduser('~'), '.cache',
+                              'robot2cam_calibration')
+    return folder or None
+
+
+def load(file_name, camera=None):
+    """Get the calibration of a camera from a calibration file.
+
+    The file is only read and parsed the first time it is asked for, and
+    again if it changes.
+
+    Args:
+        file_name (str): The json calibration file, with the `intrinsic`
+                         matrix and `distortion` parameters of the camera
+        camera (str): The camera the calibration is for, such as its name or
+                      serial number, so that each camera is given its own
+                      calibration even when they share a file
+
+    Returns: The :py:class:`CameraCalibration`, shared with every other
+        caller asking for the same file and camera
+    """
+    path = os.path.realpath(file_name)
+    status = os.stat(path)
+    stamp = (status.st_mtime, status.st_size)
+    with _lock:
+        known = _hashes.get(path)
+        if known is not None and known[0] == stamp:
+            calibration = _calibrations.get((camera, known[1]))
+            if calibration is not None:
+                return calibration
+
+    with open(path, 'rb') as calibration_file:
+        contents = calibration_file.read()
+    digest = hashlib.sha1(contents).hexdigest()
+    with _lock:
+        _hashes[path] = (stamp, digest)
+        calibration = _calibrations.get((camera, digest))
+        if calibration is None:
+            calibration = CameraCalibration(
+                json.loads(contents.decode('utf-8')), digest, path, camera)
+            _calibrations[(camera, digest)] = calibration
+    return calibration
+
+
+def chessboard_points(rows, cols, space):
+    """Get the corners of a chessboard in its own coordinate system.
+
+    Args:
+        rows (int): The number of rows of interior corners on the grid
+        cols (int): The number of columns of interior corners on the grid
+        space (float): The spacing of corners on the grid
+
+    Returns: A (rows*cols)x3 float32 numpy.ndarray of the corners, ordered as
+        OpenCV finds them. It is shared, so it is read only.
+    """
+    key = (rows, cols, space)
+    with _lock:
+        points = _chessboards.get(key)
+        if points is None:
+            points = np.zeros((cols * rows, 3), np.float32)
+            points[:, :2] = (np.mgrid[0:(rows*space):space,
+                                      0:(cols*space):space]
+                             .T.reshape(-1, 2))
+            points.setflags(write=False)
+            _chessboards[key] = points
+    return points
+
+
+class CameraCalibration(object):
+    """The calibration of a camera and the data derived from it.
+
+    Get these from :py:func:`load` rather than making them directly, so that
+    they are shared. The arrays are shared too, so they are read only.
+
+    Attributes:
+        file: A str, the calibration file
+        digest: A str, the sha1 hash of the calibration file
+        camera: A str, the camera the calibration is for, or None
+        intrinsic: A 3x3 numpy.ndarray, the camera intrinsic matrix
+        distortion: A numpy.ndarray of the camera distortion parameters
+        time: A str, when the camera was calibrated, or None
+        dictionary: A dictionary, the contents of the calibration file
+    """
+    def __init__(self, dictionary, digest, file_name=None, camera=None):
+        """Set up the calibration.
+
+        Args:
+            dictionary (dict): The contents of a calibration file
+            digest (str): The hash of the calibration file
+            file_name (str): The calibration file
+            camera (str): The camera the calibration is for
+        """
+        self.file = file_name
+        self.digest = digest
+        self.camera = camera
+        self.dictionary = dictionary
+        self.intrinsic = np.array(dictionary['intrinsic'], dtype=float)
+        self.distortion = np.array(dictionary['distortion'], dtype=float)
+        self.intrinsic.setflags(write=False)
+        self.distortion.setflags(write=False)
+        self.time = dictionary.get('time')
+
+        self._inverse_intrinsic = None
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    @property
+    def inverse_intrinsic(self):
+        """The inverse of the intrinsic matrix, which maps pixels to rays."""
+        if self._inverse_intrinsic is None:
+            inverse = np.linalg.inv(self.intrinsic)
+            inverse.setflags(write=False)
+            self._inverse_intrinsic = inverse
+        return self._inverse_intrinsic
+
+    def undistortion_maps(self, image_size):
+        """Get the maps which undistort images of a size.
+
+        The maps are made once per size, or read from the cache folder if an
+        earlier run made them, see :py:func:`cache_folder`.
+
+        Args:
+            image_size (tuple): The (width, height) of the images in pixels
+
+        Returns: A tuple of the two maps to pass to cv2.remap
+        """
+        image_size = (int(image_size[0]), int(image_size[1]))
+        with self._lock:
+            maps = self._maps.get(image_size)
+            if maps is None:
+                maps = self._read_maps(image_size)
+            if maps is None:
+                import cv2
+                maps = cv2.initUndistortRectifyMap(
+                    self.intrinsic, self.distortion, None, self.intrinsic,
+                    image_size, cv2.CV_16SC2)
+                self._write_maps(image_size, maps)
+            self._maps[image_size] = maps
+        return maps
+
+    def undistort(self, image):
+        """Undistort an image taken by the camera.
+
+        This gives the same result as cv2.undistort, without making the
+        undistortion maps for every image.
+
+        Args:
+            image (numpy.ndarray): The raw image
+
+        Returns: numpy.ndarray, the undistorted image
+        """
+        import cv2
+        first, second = self.undistortion_maps(image.shape[1::-1])
+        return cv2.remap(image, first, second, cv2.INTER_LINEAR)
+
+    def _map_files(self, image_size):
+        """The files the maps of an image size are cached in, or None"""
+        folder = cache_folder()
+        if folder is None:
+            return None
+        return [os.path.join(folder, '{}_{}x{}_{}.npy'.format(
+            self.digest, image_size[0], image_size[1], index))
+            for index in (1, 2)]
+
+    def _read_maps(self, image_size):
+        """Read the maps of an image size from the cache, None if missing"""
+        map_files = self._map_files(image_size)
+        if map_files is None or not all(os.path.isfile(map_file)
+                                        for map_file in map_files):
+            return None
+        try:
+            # mapped rather than read, which is faster than making them
+            return tuple(np.load(map_file, mmap_mode='r')
+                         for map_file in map_files)
+        except (IOError, OSError, ValueError) as error:
+            print('ignoring the cached undistortion maps {}: {}'.format(
+                map_files[0], error))
+            return None
+
+    def _write_maps(self, image_size, maps):
+        """Keep the maps of an image size in the cache, if there is one"""
+        map_files = self._map_files(image_size)
+        if map_files is None:
+            return
+        folder = os.path.dirname(map_files[0])
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            for map_file, undistortion_map in zip(map_files, maps):
+                # written next to the cache and renamed, so another process
+                # never reads a partly written file
+                handle, temporary = tempfile.mkstemp(suffix='.npy',
+                                                     dir=folder)
+                with os.fdopen(handle, 'wb') as temporary_file:
+                    np.save(temporary_file, undistortion_map)
+                os.rename(temporary, map_file)
+        except (IOError, OSError) as error:
+            print('could not cache the undistortion maps in {}: {}'.format(
+                folder, error))
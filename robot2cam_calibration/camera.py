@@ -29,11 +29,16 @@ TODO: Add some more:
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import collections
 import threading
 
 import numpy as np
 import cv2
 
+from robot2cam_calibration.synchronize import clock
+
+Frame = collections.namedtuple('Frame', ['image', 'time'])
+
 
 class Camera(object):
     """Wraps various camera and image capture technologies.
@@ -42,25 +47,37 @@ class Camera(object):
     
     - Flycapture2 devices : `flycap`, `flycap2`, `flycapture`, `flycapture2`
 
+    When several devices of a type are connected, the index of the device to
+    use can be added to the name, ex: `flycap:1`.
+
     Attributes:
         intrinsic: A numpy array of the camera intrinsic matrix
         distortion: A numpy array of the camera distortion parameters
+        calibration: The :py:class:`calibrations.CameraCalibration` of the
+            camera, or None
         cam: A camera or other image acquisition device, which this class wraps.
     """
-    def __init__(self, name, intrinsic=None, distortion=None):
+    def __init__(self, name, intrinsic=None, distortion=None,
+                 calibration=None):
         """Sets up camera acquisition and reads calibration data.
 
         Args:
-            name (str): Name of the camera to use
+            name (str): Name of the camera to use, optionally followed by
+                `:<index>` to select one of several devices
             intrinsic (numpy.ndarray): The camera intrinsic matrix
             distortion (numpy.ndarray): The camera distortion parameters
+            calibration (calibrations.CameraCalibration): The calibration of
+                the camera, used instead of `intrinsic` and `distortion` so
+                the undistortion maps are only made once
 
         Raises:
             NotImplementedError: The camera type selected is not yet implemented
             Value Error: The value entered for the camera is not valid.
         """
+        name, _, index = name.partition(':')
+        index = int(index) if index else 0
         if name.lower() in ('flycap', 'flycap2', 'flycapture', 'flycapture2'):
-            self.cam = FlyCap2()
+            self.cam = FlyCap2(index)
         elif name.lower() in ('wc', 'webcam'):
             raise NotImplementedError
         elif name.lower() in ('file', 'files', 'folder', 'pictures', 'picture',
@@ -69,6 +86,10 @@ class Camera(object):
         else:
             raise ValueError('unknown camera type')
 
+        if calibration is not None:
+            intrinsic = calibration.intrinsic
+            distortion = calibration.distortion
+        self.calibration = calibration
         self.intrinsic = intrinsic
         self.distortion = distortion
 
@@ -80,16 +101,26 @@ class Camera(object):
         Raises:
             RuntimeError: It was not possible to capture and rectify an image
         """
-        raw_image = self.cam.capture_image()
-        if self.intrinsic is not None and self.distortion is not None:
-            rectified_image = cv2.undistort(raw_image, self.intrinsic,
-                                            self.distortion)
-        else:
-            rectified_image = raw_image
+        rectified_image = self.rectify(self.cam.capture_image())
         if rectified_image is None:
             raise RuntimeError("Unable to capture and rectify image")
         return rectified_image
 
+    def rectify(self, raw_image):
+        """Rectify an image captured by this camera.
+
+        Args:
+            raw_image (numpy.ndarray): The raw image
+
+        Returns: The rectified image, or the raw image if there is no
+            calibration data.
+        """
+        if self.calibration is not None:
+            return self.calibration.undistort(raw_image)
+        if self.intrinsic is not None and self.distortion is not None:
+            return cv2.undistort(raw_image, self.intrinsic, self.distortion)
+        return raw_image
+
     def capture_raw(self):
         """ Return the raw (still distorted) image.
 
@@ -97,6 +128,27 @@ class Camera(object):
         """
         return self.cam.capture_image()
 
+    def capture_frame(self, after=None, rectify=True):
+        """Capture an image along with the time at which it was captured.
+
+        Args:
+            after (float): If given, wait for a frame captured after this time
+                (using :py:data:`synchronize.clock`). This is useful to get an
+                image which was exposed after the robot stopped.
+            rectify (bool): Whether to rectify the image
+
+        Returns: :py:class:`Frame` of the image and its capture time
+
+        Raises:
+            RuntimeError: It was not possible to capture and rectify an image
+        """
+        frame = self.cam.capture_frame(after)
+        if rectify:
+            frame = Frame(self.rectify(frame.image), frame.time)
+        if frame.image is None:
+            raise RuntimeError("Unable to capture and rectify image")
+        return frame
+
     def __del__(self):
         self.cam.__del__()
 
@@ -117,8 +169,12 @@ class FlyCap2(object):
         fc2_image: flycapture2.Image which represents the image buffer of the
             camera images
     """
-    def __init__(self):
-        """Setup the communications with the flycapture2 device."""
+    def __init__(self, index=0):
+        """Setup the communications with the flycapture2 device.
+
+        Args:
+            index (int): The index of the device to connect to
+        """
         import flycapture2 as fc2
 
         # FlyCapture Info printing and setup:
@@ -126,7 +182,7 @@ class FlyCap2(object):
         self.context = fc2.Context()
         print "Number of Cameras: {}\n".format(
             self.context.get_num_of_cameras())
-        self.context.connect(*self.context.get_camera_from_index(0))
+        self.context.connect(*self.context.get_camera_from_index(index))
         print "Camera Info: {}\n".format(self.context.get_camera_info())
         m, f = self.context.get_video_mode_and_frame_rate()
         print "Video Mode: {}\nFrame Rate:{}\n".format(m, f)
@@ -141,11 +197,13 @@ class FlyCap2(object):
         self.cam_on = True
 
         self.image = None
+        self.image_time = None
         cv2.namedWindow('raw', cv2.WINDOW_NORMAL)
         cv2.waitKey(5)
 
         self.__acquisition_thread = None
         self.lock = threading.Lock()
+        self.new_image = threading.Condition(self.lock)
 
         self.run = True
         self.__acquisition_thread = threading.Thread(group=None,
@@ -173,6 +231,28 @@ class FlyCap2(object):
         with self.lock:
             return np.copy(self.image)
 
+    def capture_frame(self, after=None, timeout=1.0):
+        """Return the latest image from the camera and its capture time
+
+        Args:
+            after (float): If given, wait for an image captured after this time
+            timeout (float): The maximum time to wait for a new image
+
+        Returns: :py:class:`Frame` of the latest image from the camera.
+
+        Raises:
+            RuntimeError: No new image arrived before the timeout
+        """
+        deadline = clock() + timeout
+        with self.new_image:
+            while (self.image_time is None or
+                   (after is not None and self.image_time <= after)):
+                remaining = deadline - clock()
+                if remaining <= 0:
+                    raise RuntimeError('timed out waiting for a new image')
+                self.new_image.wait(remaining)
+            return Frame(np.copy(self.image), self.image_time)
+
     def stop(self):
         if self.__acquisition_thread is not None:
             if self.__acquisition_thread.is_alive():
@@ -190,8 +270,13 @@ class FlyCap2(object):
 
     def acquire(self):
         while self.run:
-            with self.lock:
-                self.image = np.array(self.context.retrieve_buffer(self.fc2_image))
+            image = np.array(self.context.retrieve_buffer(self.fc2_image))
+            # stamp as soon as the buffer is returned
+            image_time = clock()
+            with self.new_image:
+                self.image = image
+                self.image_time = image_time
+                self.new_image.notify_all()
             cv2.imshow('raw', self.image)
             cv2.waitKey(5)
 
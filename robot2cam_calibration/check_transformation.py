@@ -28,10 +28,17 @@ import cv2
 import os
 import numpy as np
 import json
-import track_grid
+import robot2cam_calibration.track_grid as track_grid
 import re
-import compute_transformations
 import argparse
+import csv
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import robot2cam_calibration.rotations as rotations
+import robot2cam_calibration.calibrations as calibrations
+
+# The frames drawn on each image, see frame_transforms
+FRAME_LABELS = ['base_est', 'tcp_est', 'target_est', 'target_measured']
 
 def main():
     """
@@ -74,6 +81,32 @@ def main():
                              "https://pypi.python.org/pypi/camera_calibration/",
                         default='calibration.json')
 
+    parser.add_argument("--camera", type=str,
+                        help="The camera to check, by name or index, when "
+                             "the transformation or correspondences have "
+                             "several cameras. The camera calibration must "
+                             "be that camera's.",
+                        default=None)
+
+    parser.add_argument("--workers", type=int,
+                        help="The number of threads reading and writing "
+                             "images. Defaults to the number of CPUs.",
+                        default=None)
+
+    parser.add_argument("--images", type=str, nargs='+',
+                        help="Only check these images (file names as "
+                             "recorded in the correspondences).",
+                        default=None)
+
+    parser.add_argument("--report", type=str,
+                        help="Write the error of each pose and summary "
+                             "statistics to this file, .csv or .json",
+                        default=None)
+
+    parser.add_argument("--no_images", action='store_true',
+                        help="Only compute the report, without reading or "
+                             "drawing any images")
+
     args = parser.parse_args()
 
     check_transformation(
@@ -81,14 +114,32 @@ def main():
         robot_data=args.robot_data,
         image_folder=args.image_folder,
         result_folder=args.result_folder,
-        cam_calibration=args.cam_calibration
+        cam_calibration=args.cam_calibration,
+        workers=args.workers,
+        report=args.report,
+        render=not args.no_images,
+        images=args.images,
+        camera=args.camera
     )
 
 
 def check_transformation(r2c_calibration, robot_data, image_folder,
-                         result_folder, cam_calibration):
+                         result_folder, cam_calibration, workers=None,
+                         report=None, render=True, images=None,
+                         camera=None):
     """Plots transformed 3D world points onto camera image
 
+    Can also (or instead) report the error between the estimated and measured
+    target of each pose numerically, which needs no images.
+
+    If the correspondences name the image of each sample (`image`, recorded
+    by `robot2cam-record-ur --image_folder`), images are matched to samples
+    by name. Otherwise the readable images in the folder are paired with the
+    samples in file name order.
+
+    A transformation or correspondences with several cameras are checked one
+    camera at a time, using the samples in which that camera saw the grid.
+
     Args:
         r2c_calibration (str): JSON file generated by
                            compute_transformations
@@ -108,6 +159,25 @@ def check_transformation(r2c_calibration, robot_data, image_folder,
         cam_calibration (str): The JSON file holding the camera
                                   calibration data as generated by:
                                   https://pypi.python.org/pypi/camera_calibration/
+        workers (int): The number of threads reading and writing images,
+                       None for one per CPU
+        report (str): If given, the file to write the numeric errors of each
+                      pose to, see :py:func:`reprojection_report`
+        render (bool): Whether to draw the frames on the images. If False,
+                       no images are read at all.
+        images (list of str): If given, only draw on these images. Needs
+                              correspondences which name the image of each
+                              sample (`image`).
+        camera (str or int): The name or index of the camera to check, None
+                             if there is only one
+
+    Returns: The report as a dictionary if one was requested, else None
+
+    Raises:
+        ValueError: There are more images than robot poses, the
+            requested images can not be found in the correspondences, or
+            there are several cameras and the camera is not given or not
+            found
     """
     if len(result_folder) and (result_folder[0] == '/' or
                                        result_folder[0] == '\\'):
@@ -123,12 +193,10 @@ def check_transformation(r2c_calibration, robot_data, image_folder,
                                       image_folder[-1] == '\\'):
         image_folder = image_folder[:-1]
 
-    with open(cam_calibration, 'r') as open_file:
-        calib_dict = json.load(open_file)
-        intrinsic = np.array(calib_dict['intrinsic'])
-        distortion = np.array(calib_dict['distortion'])
-        print("Loaded camera calibration data from {}".format(
-            calib_dict['time']))
+    calibration = calibrations.load(cam_calibration)
+    intrinsic = calibration.intrinsic
+    distortion = calibration.distortion
+    print("Loaded camera calibration data from {}".format(calibration.time))
 
     with open(robot_data, 'r') as open_file:
         robot_dict = json.load(open_file)
@@ -142,52 +210,358 @@ def check_transformation(r2c_calibration, robot_data, image_folder,
         r2c_dict = json.load(open_file)
         # nx6 arrays x,y,z,axis-angle:
         tcp2target = r2c_dict['tcp2target']['Tmatrix']
-        cam2rob = r2c_dict['cam2robot']['Tmatrix']
+        cam2rob = r2c_dict['cam2robot']
         print("Loaded calibration results from {}".format(r2c_dict['time']))
 
+    # with several cameras, cam2robot is a list with each camera's pose
+    if isinstance(cam2rob, list):
+        chosen = select_camera([pose.get('camera') for pose in cam2rob],
+                               camera, r2c_calibration)
+        cam2rob = cam2rob[chosen]
+        if cam2rob.get('camera') is not None:
+            camera = cam2rob['camera']
+        else:
+            camera = chosen
+    cam2rob = cam2rob['Tmatrix']
+
+    # with several cameras, each sample has a grid and an image for every
+    # camera
+    samples = list(range(len(tcp2robot)))
+    labels = [str(sample) for sample in samples]
+    image_names = robot_dict.get('image')
+    cameras = robot_dict.get('cameras', [None])
+    if len(cameras) > 1:
+        column = select_camera(cameras, camera, robot_data)
+        print("Checking camera {}".format(cameras[column]))
+        samples = [sample for sample, grids in enumerate(camera2target)
+                   if grids[column] is not None]
+        labels = ['{}_{}'.format(sample, column) for sample in samples]
+        tcp2robot = [tcp2robot[sample] for sample in samples]
+        camera2target = [camera2target[sample][column]
+                         for sample in samples]
+        if image_names is not None:
+            image_names = [image_names[sample][column]
+                           for sample in samples]
+
+    frames = frame_transforms(cam2rob, tcp2target, tcp2robot, camera2target)
+    image_points = project_frames(frames, intrinsic, distortion)
+
+    results = None
+    if report is not None:
+        results = reprojection_report(frames, image_points, samples)
+        write_report(results, report)
+        print("Wrote report to {}\n{}".format(
+            report, json.dumps(results['summary'], indent=4)))
+    if not render:
+        return results
+
     target_directory = os.path.join(os.getcwd(), image_folder)
     directory_out = os.path.join(os.getcwd(), result_folder)
-    file_names = os.listdir(target_directory)
     if not os.path.exists(directory_out):
         os.makedirs(directory_out)
 
-    axis_length = 250
-    axis = np.float32([[0, 0, 0], [axis_length, 0, 0], [0, axis_length, 0],
-                       [0, 0, axis_length]]).reshape(-1, 3)
+    # Decoding and encoding images dominates, and OpenCV releases the GIL
+    # while doing it, so both are spread over a pool of threads.
+    workers = workers or multiprocessing.cpu_count()
+    pool = ThreadPool(workers)
+    try:
+        if image_names is not None:
+            render_indexed(pool, image_names, image_points,
+                           target_directory, result_folder, images, labels)
+        elif images is not None:
+            raise ValueError('{} does not name the image of each sample, '
+                             'so images can not be selected'.format(
+                                 robot_data))
+        elif len(cameras) > 1:
+            raise ValueError('{} does not name the image of each sample, '
+                             'so the images of one camera can not be '
+                             'told apart'.format(robot_data))
+        else:
+            print("{} does not name the image of each sample, pairing "
+                  "images with samples in file name order".format(
+                      robot_data))
+            render_in_order(pool, image_points, target_directory,
+                            result_folder, 4 * workers)
+    finally:
+        pool.close()
+        pool.join()
+    print("Done processing all images")
+    return results
 
-    number_found = 0
 
-    for image_file in sort_nicely(file_names):
-        image_file = os.path.join(target_directory, image_file)
-
-        # Try to read in image as gray scale
-        img = cv2.imread(image_file, 0)
-
-        # If the image_file isn't an image, move on
-        if img is not None:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
-            labels = ['base_est', 'tcp_est', 'target_est', 'target_measured']
-            tcp_est = np.matmul(cam2rob,
-                                compute_transformations.vector2mat(
-                                    tcp2robot[number_found]))
-            target_est = np.matmul(tcp_est, tcp2target)
-            coordinates = np.array([cam2rob, tcp_est, target_est, compute_transformations.vector2mat(camera2target[number_found])])
-            for j in range(coordinates.shape[0]):
-                cam2target = np.array(coordinates[j])
-                rvec, jac = cv2.Rodrigues(cam2target[0:3,0:3])
-                image_points, jac = cv2.projectPoints(axis, rvec,
-                                                      cam2target[0:3, 3],
-                                                      intrinsic, distortion)
-                img = track_grid.draw_axes(image_raw=img,
-                                           corners=image_points[0],
-                                           image_points=image_points[1:],
-                                           label=labels[j])
-            cv2.imwrite(
-                os.path.join(
-                    result_folder, "result" + str(number_found) + ".jpg"), img)
+def render_indexed(pool, image_names, image_points, image_folder,
+                   result_folder, images=None, labels=None):
+    """Draw the frames on the images named in the correspondences.
+
+    Each image is matched to its sample by name, so every image is handled
+    independently and stray or missing files do not affect the others.
+
+    Args:
+        pool (multiprocessing.pool.ThreadPool): The pool to work on
+        image_names (list of str): The image file name of each sample, None
+                                   where there is no image
+        image_points (nx4x4x2 array): The projected frames of each sample,
+                                      see :py:func:`project_frames`
+        image_folder (str): The folder the images are in
+        result_folder (str): The folder to write the results to
+        images (list of str): If given, only these images are checked
+        labels (list of str): The name of the result of each sample, which
+                              is written as result<label>.jpg. None to
+                              number them in order.
+
+    Raises:
+        ValueError: An image is not in the correspondences
+    """
+    if labels is None:
+        labels = [str(number) for number in range(len(image_names))]
+    index = dict((name, number) for number, name in enumerate(image_names)
+                 if name is not None)
+    if images is None:
+        images = sorted(index, key=index.get)
+    unknown = [name for name in images if name not in index]
+    if unknown:
+        raise ValueError('images {} are not in the correspondences'.format(
+            unknown))
+    jobs = [(os.path.join(image_folder, name), image_points[index[name]],
+             os.path.join(result_folder, "result" + labels[index[name]] +
+                          ".jpg"))
+            for name in images]
+    for (image_file, _, _), done in zip(jobs, pool.map(check_image, jobs)):
+        if done:
             print("finished processing Image {}".format(image_file))
+        else:
+            print("unable to read Image {}".format(image_file))
+
+
+def render_in_order(pool, image_points, image_folder, result_folder,
+                    chunk):
+    """Draw the frames on every image in a folder, pairing the images with
+    the samples in file name order.
+
+    This is for correspondences recorded without image names. Images are
+    read a chunk at a time to find which files are images (and so which
+    sample they belong to) without holding every image in memory.
+
+    Args:
+        pool (multiprocessing.pool.ThreadPool): The pool to work on
+        image_points (nx4x4x2 array): The projected frames of each sample,
+                                      see :py:func:`project_frames`
+        image_folder (str): The folder the images are in
+        result_folder (str): The folder to write the results to
+        chunk (int): The number of images to read at a time
+
+    Raises:
+        ValueError: There are more images than samples
+    """
+    paths = [os.path.join(image_folder, image_file)
+             for image_file in sort_nicely(os.listdir(image_folder))]
+    number_found = 0
+    for start in range(0, len(paths), chunk):
+        images = pool.map(read_image, paths[start:start + chunk])
+        jobs = []
+        for image_file, img in zip(paths[start:start + chunk], images):
+            # If the image_file isn't an image, move on
+            if img is None:
+                continue
+            if number_found >= len(image_points):
+                raise ValueError('there are more images than samples')
+            jobs.append((img, image_points[number_found],
+                         os.path.join(result_folder, "result" +
+                                      str(number_found) + ".jpg")))
+            print("processing Image {}".format(image_file))
             number_found += 1
-    print("Done processing all images")
+        pool.map(render_image, jobs)
+
+
+def select_camera(cameras, camera, file_name):
+    """Find the camera to check among the cameras of a file.
+
+    Args:
+        cameras (list of str): The names of the cameras in the file
+        camera (str or int): The name or index of the camera, None if there
+                             is only one
+        file_name (str): The file, for errors
+
+    Returns: int, the index of the camera
+
+    Raises:
+        ValueError: There are several cameras and none was given, or the
+            camera is not in the file
+    """
+    if camera is None:
+        if len(cameras) == 1:
+            return 0
+        raise ValueError('{} has several cameras ({}), choose one with '
+                         '--camera'.format(file_name, ', '.join(
+                             str(name) for name in cameras)))
+    if camera in cameras:
+        return cameras.index(camera)
+    try:
+        index = int(camera)
+    except ValueError:
+        index = None
+    if index is None or not 0 <= index < len(cameras):
+        raise ValueError('{} has no camera {}, the cameras are {}'.format(
+            file_name, camera, ', '.join(str(name) for name in cameras)))
+    return index
+
+
+def frame_transforms(cam2rob, tcp2target, tcp2robot, camera2target):
+    """The estimated and measured frames of every image in camera
+    coordinates.
+
+    The frames are the robot base, the tcp and the target as estimated from
+    the transformations and the target as measured.
+
+    Args:
+        cam2rob (4x4 array): The camera to robot transformation
+        tcp2target (4x4 array): The tcp to target transformation
+        tcp2robot (nx6 array): The robot pose of each image
+        camera2target (nx6 array): The measured camera to target
+                                   transformation of each image
+
+    Returns: nx4x4x4 np.ndarray, the transformation of each frame of each
+        image
+    """
+    tcp_est = np.matmul(cam2rob, rotations.pose2mat(tcp2robot))
+    target_est = np.matmul(tcp_est, tcp2target)
+    return np.stack(
+        (np.broadcast_to(cam2rob, tcp_est.shape), tcp_est, target_est,
+         rotations.pose2mat(camera2target)), axis=1)
+
+
+def project_frames(frames, intrinsic, distortion, axis_length=250):
+    """Project the axes of every frame of every image.
+
+    Every axis point of every frame is moved into camera coordinates and all
+    are projected in a single call.
+
+    Args:
+        frames (nx4x4x4 array): The frames, see :py:func:`frame_transforms`
+        intrinsic (3x3 array): The camera intrinsics
+        distortion (array): The camera distortion
+        axis_length (float): The length of the drawn axes
+
+    Returns: nx4x4x2 np.ndarray, for each image and frame the image points of
+        the origin and the ends of the x, y and z axes
+    """
+    axis = np.float32([[0, 0, 0], [axis_length, 0, 0], [0, axis_length, 0],
+                       [0, 0, axis_length]])
+    points = (np.einsum('nfij,aj->nfai', frames[..., :3, :3], axis) +
+              frames[..., None, :3, 3])
+    image_points, jac = cv2.projectPoints(
+        points.reshape(-1, 1, 3), np.zeros(3), np.zeros(3), intrinsic,
+        distortion)
+    return image_points.reshape(points.shape[:-1] + (2,))
+
+
+def reprojection_report(frames, image_points, samples=None):
+    """Measure how far the estimated target is from the measured target in
+    every image.
+
+    Args:
+        frames (nx4x4x4 array): The frames, see :py:func:`frame_transforms`
+        image_points (nx4x4x2 array): The projected axes of the frames, see
+                                      :py:func:`project_frames`
+        samples (list of int): The sample number of each image, reported as
+                               its `pose`. None to number them in order.
+
+    Returns: A dictionary with `poses`, a list with the errors of each pose,
+        and `summary`, the mean, median, rms and max of each error. The
+        errors are the mean and max pixel distance between the estimated and
+        measured axis points (`pixel_mean`, `pixel_max`), the distance between
+        the estimated and measured target (`translation`) and the angle
+        between them in radians (`rotation`).
+    """
+    estimated = frames[:, 2]
+    measured = frames[:, 3]
+    pixel = np.linalg.norm(image_points[:, 2] - image_points[:, 3], axis=-1)
+    errors = [
+        ('pixel_mean', pixel.mean(axis=1)),
+        ('pixel_max', pixel.max(axis=1)),
+        ('translation', np.linalg.norm(
+            estimated[:, :3, 3] - measured[:, :3, 3], axis=-1)),
+        ('rotation', np.linalg.norm(rotations.mat2rotvec(np.matmul(
+            np.swapaxes(measured[:, :3, :3], 1, 2), estimated[:, :3, :3])),
+            axis=-1))]
+
+    if samples is None:
+        samples = range(len(frames))
+    poses = [dict([('pose', sample)] + [(name, float(values[index]))
+                                        for name, values in errors])
+             for index, sample in enumerate(samples)]
+    summary = dict((name, {'mean': float(np.mean(values)),
+                           'median': float(np.median(values)),
+                           'rms': float(np.sqrt(np.mean(values ** 2))),
+                           'max': float(np.max(values))})
+                   for name, values in errors)
+    return {'poses': poses, 'summary': summary}
+
+
+def write_report(report, file_out):
+    """Write a report from :py:func:`reprojection_report`.
+
+    Args:
+        report (dict): The report
+        file_out (str): The file to write. A .csv file gets a row per pose,
+                        anything else is written as json.
+    """
+    if os.path.splitext(file_out)[1].lower() == '.csv':
+        fields = ['pose', 'pixel_mean', 'pixel_max', 'translation',
+                  'rotation']
+        with open(file_out, 'w') as report_file:
+            writer = csv.DictWriter(report_file, fields)
+            writer.writeheader()
+            writer.writerows(report['poses'])
+    else:
+        with open(file_out, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+
+
+def read_image(image_file):
+    """Read an image as grayscale and convert it to RGB for drawing on.
+
+    Args:
+        image_file (str): The file to read
+
+    Returns: numpy.ndarray, the image, or None if the file is not an image
+    """
+    img = cv2.imread(image_file, 0)
+    if img is None:
+        return None
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+
+
+def check_image(job):
+    """Read one image, draw its frames and write it out.
+
+    Args:
+        job (tuple): The image file, the image points of its frames (see
+                     :py:func:`project_frames`) and the file to write to
+
+    Returns: Boolean, whether the image could be read
+    """
+    image_file, frames, file_out = job
+    img = read_image(image_file)
+    if img is None:
+        return False
+    render_image((img, frames, file_out))
+    return True
+
+
+def render_image(job):
+    """Draw the frames of one image and write it out.
+
+    Args:
+        job (tuple): The image, the image points of its frames (see
+                     :py:func:`project_frames`) and the file to write to
+    """
+    img, frames, file_out = job
+    for points, label in zip(frames, FRAME_LABELS):
+        track_grid.draw_axes(image_raw=img, corners=points[:1],
+                             image_points=points[1:, None], label=label,
+                             copy=False)
+    cv2.imwrite(file_out, img)
 
 
 # http://stackoverflow.com/questions/4623446/how-do-you-sort-files-numerically
@@ -26,12 +26,15 @@ a tool offset from correspondences.
 from __future__ import division
 import argparse
 import json
-from scipy import optimize
 import datetime
 import os
 import math
 import numpy as np
-import cv2
+
+import robot2cam_calibration.rotations as rotations
+
+# scipy is imported by the functions which solve, so the commandline and the
+# helpers used by other modules start without it
 
 
 def main():
@@ -87,6 +90,37 @@ def main():
                                                       "TNC, and L-BFGS-B",
                         default="SLSQP")
 
+    parser.add_argument("--uncertainty", type=str,
+                        choices=['covariance', 'bootstrap'],
+                        help="Also estimate the uncertainty of the result, "
+                             "see uncertainty.py",
+                        default=None)
+
+    parser.add_argument("--resamples", type=int,
+                        help="The number of bootstrap resamples",
+                        default=200)
+
+    parser.add_argument("--consensus", action="store_true",
+                        help="Solve by consensus over random minimal sets of "
+                             "samples instead of basin hopping, see "
+                             "consensus.py")
+
+    parser.add_argument("--hypotheses", type=int,
+                        help="The number of minimal sets to solve with "
+                             "--consensus",
+                        default=500)
+
+    parser.add_argument("--threshold", type=float,
+                        help="The error below which a sample agrees with a "
+                             "consensus hypothesis. Defaults to the least "
+                             "median error.",
+                        default=None)
+
+    parser.add_argument("--workers", type=int,
+                        help="The number of bootstrap or consensus "
+                             "processes. Defaults to the number of CPUs.",
+                        default=None)
+
     args = parser.parse_args()
 
     result = compute_transformation(
@@ -97,7 +131,13 @@ def main():
         max_cam2rob_deviation=args.max_cam2rob,
         max_tcp2target_deviation=args.max_tcp2target,
         iterations=args.iter,
-        minimizer=args.minimizer
+        minimizer=args.minimizer,
+        uncertainty=args.uncertainty,
+        resamples=args.resamples,
+        workers=args.workers,
+        consensus=args.consensus,
+        hypotheses=args.hypotheses,
+        threshold=args.threshold
     )
 
     print('Final Result:\n{}'.format(result))
@@ -105,13 +145,18 @@ def main():
 
 def compute_transformation(correspondences, file_out, cam2rob_guess,
                            tcp2target_guess, max_cam2rob_deviation,
-                           max_tcp2target_deviation, iterations, minimizer):
+                           max_tcp2target_deviation, iterations, minimizer,
+                           uncertainty=None, resamples=200, workers=None,
+                           consensus=False, hypotheses=500, threshold=None):
     """Computes the camera to robot base and tcp to target (flange to tcp in
     some cases) transformations. Uses matched coorespondences of
     transformations from the camera to a fixed point past the final robot axis
     (for example a grid or other marker) and the robot base to tcp
     transformation.
 
+    If the correspondences are from several cameras, all of the cameras are
+    solved for together, see :py:func:`compute_multi_camera_transformation`.
+
     Args:
         correspondences (string): The filename of the correspondences file.
                                   This file should be a json file with fields:
@@ -126,7 +171,8 @@ def compute_transformation(correspondences, file_out, cam2rob_guess,
         file_out (string): The name of the file to be output (no extension)
         cam2rob_guess (6 element list): The Rodrigues vector for the initial
                                         guess of the camera to robot
-                                        transformation
+                                        transformation. With several cameras
+                                        the guesses are estimated instead.
         tcp2target_guess (6 element list): The Rodrigues vector for the initial
                                            guess of the tcp to target
                                            transformation
@@ -139,8 +185,26 @@ def compute_transformation(correspondences, file_out, cam2rob_guess,
         iterations (int): The number of iterations of basin hopping to perform.
         minimizer (str): The minimizer to use at each basin hopping stop
                          Valid options are: SLSQP TNC, and L-BFGS-B
+        uncertainty (str): If given, how to estimate the uncertainty of the
+                           result, 'covariance' or 'bootstrap'. It is added
+                           to the results as 'uncertainty', see
+                           :py:mod:`uncertainty`.
+        resamples (int): The number of bootstrap resamples
+        workers (int): The number of bootstrap or consensus processes, None
+                       for one per CPU
+        consensus (bool): Whether to solve by consensus over random minimal
+                          sets of samples instead of by basin hopping, see
+                          :py:mod:`consensus`. The guesses and deviations
+                          are then unused.
+        hypotheses (int): The number of minimal sets to solve by consensus
+        threshold (float): The error below which a sample agrees with a
+                           consensus hypothesis, None for the least median
+                           error
 
     Returns: The results as a dictionary
+
+    Raises:
+        ValueError: Consensus is requested for several cameras
     """
     with open(correspondences, 'r') as correspondences_file:
         correspondences_dictionary = json.load(correspondences_file)
@@ -150,7 +214,27 @@ def compute_transformation(correspondences, file_out, cam2rob_guess,
         camera2grid = correspondences_dictionary['camera2grid']
         print("Loaded data from {}".format(write_time))
 
+    if len(correspondences_dictionary.get('cameras', [])) > 1:
+        if consensus:
+            raise ValueError('consensus is only supported for one camera')
+        json_dict = compute_multi_camera_transformation(
+            correspondences_dictionary, file_out, tcp2target_guess)
+        return estimate_uncertainty(correspondences_dictionary, json_dict,
+                                    file_out, uncertainty, resamples,
+                                    workers)
+
+    if consensus:
+        # imported here as consensus builds on this module
+        from robot2cam_calibration.consensus import consensus_transformation
+        json_dict = consensus_transformation(
+            correspondences_dictionary, file_out, hypotheses,
+            threshold=threshold, workers=workers, minimizer=minimizer)
+        return estimate_uncertainty(correspondences_dictionary, json_dict,
+                                    file_out, uncertainty, resamples,
+                                    workers)
+
     #optimize
+    from scipy import optimize
     guess = np.concatenate((cam2rob_guess, tcp2target_guess))
     bounds = Bounds([guess[0] + max_cam2rob_deviation,
                      guess[1] + max_cam2rob_deviation,
@@ -179,7 +263,11 @@ def compute_transformation(correspondences, file_out, cam2rob_guess,
     bounds_tuple = [(low, high) for low, high in zip(bounds.xmin, bounds.xmax)]
     # define the new step taking routine and pass it to basinhopping
     take_step = RandomDisplacementBounds(bounds.xmin, bounds.xmax)
-    minimizer_kwargs = {"args": (tcp2robot, camera2grid), "method": minimizer,
+    tcp2robot = np.asarray(tcp2robot, dtype=float)
+    camera2grid = np.asarray(camera2grid, dtype=float)
+    all_samples = np.ones(len(tcp2robot), dtype=bool)
+    minimizer_kwargs = {"args": (tcp2robot, camera2grid, 0.25, all_samples),
+                        "method": minimizer,
                         "bounds": bounds_tuple, "options":{"maxiter": 25000}}
     print('starting basinhopping')
     result = optimize.basinhopping(
@@ -187,12 +275,16 @@ def compute_transformation(correspondences, file_out, cam2rob_guess,
         accept_test=bounds, disp=False, callback=callback, take_step=take_step,
         niter=iterations, interval=25,
         niter_success=math.ceil(iterations/7.5))
+    solution, inliers, rounds = reject_outliers(
+        result.x, tcp2robot, camera2grid, minimizer, bounds_tuple)
 
     json_dict = {"time": str(datetime.datetime.now()),
-                 "cam2robot": {"xyz-angle": result.x[:6].tolist(),
-                               "Tmatrix": vector2mat(result.x[:6]).tolist()},
-                 "tcp2target": {"xyz-angle": result.x[6:].tolist(),
-                                "Tmatrix": vector2mat(result.x[6:]).tolist()},
+                 "cam2robot": {"xyz-angle": solution[:6].tolist(),
+                               "Tmatrix": vector2mat(solution[:6]).tolist()},
+                 "tcp2target": {"xyz-angle": solution[6:].tolist(),
+                                "Tmatrix": vector2mat(solution[6:]).tolist()},
+                 "inliers": np.flatnonzero(inliers).tolist(),
+                 "outliers": np.flatnonzero(~inliers).tolist(),
                  "minimization": {"terminated for":result.message,
                                   "Number of minimization failures":result.minimization_failures,
                                   "Number of iterations":result.nit,
@@ -200,7 +292,10 @@ def compute_transformation(correspondences, file_out, cam2rob_guess,
                                   "method": minimizer,
                                   "best result":{"success":str(result.lowest_optimization_result.success),
                                                  "message": result.lowest_optimization_result.message,
-                                                 "error": result.lowest_optimization_result.fun}
+                                                 "error": result.lowest_optimization_result.fun},
+                                  "outlier rounds": rounds,
+                                  "error": error(solution, tcp2robot,
+                                                 camera2grid, 0.25, inliers)
                                   }
                  }
 
@@ -208,9 +303,340 @@ def compute_transformation(correspondences, file_out, cam2rob_guess,
             result_json_file:
         json.dump(json_dict, result_json_file, indent=4)
 
+    return estimate_uncertainty(correspondences_dictionary, json_dict,
+                                file_out, uncertainty, resamples, workers)
+
+
+def estimate_uncertainty(correspondences, json_dict, file_out, method,
+                         resamples, workers):
+    """Estimate the uncertainty of a result and add it to the output file.
+
+    Args:
+        correspondences (dict): The correspondences the result was computed
+                                from
+        json_dict (dict): The result
+        file_out (string): The name of the file the result was written to
+        method (str): 'covariance', 'bootstrap' or None to skip the estimate
+        resamples (int): The number of bootstrap resamples
+        workers (int): The number of bootstrap processes
+
+    Returns: The result, with the uncertainty
+    """
+    if method is None:
+        return json_dict
+    # imported here as uncertainty builds on this module
+    import robot2cam_calibration.uncertainty as uncertainty
+    print('estimating the uncertainty by {}'.format(method))
+    json_dict["uncertainty"] = uncertainty.estimate(
+        correspondences, json_dict, method, resamples, workers)
+    with open(os.path.splitext(file_out)[0] + '.json', 'w') as \
+            result_json_file:
+        json.dump(json_dict, result_json_file, indent=4)
     return json_dict
 
 
+def compute_multi_camera_transformation(correspondences, file_out,
+                                        tcp2target_guess, ratio=0.25):
+    """Computes the transformations for several cameras in one solve.
+
+    Every camera gets its own camera to robot transformation while the tcp to
+    target transformation is shared, see :py:func:`solve_cameras`. Outliers
+    are reported as [sample, camera] pairs, see
+    :py:func:`reject_camera_outliers`.
+
+    Args:
+        correspondences (dict): The multi-camera correspondences, with fields
+                                'cameras' (a list of camera names),
+                                'tcp2robot' and 'camera2grid', where each
+                                entry of 'camera2grid' is a list with the
+                                camera to grid transformation for every
+                                camera (None where the grid was not seen).
+        file_out (string): The name of the file to be output (no extension)
+        tcp2target_guess (6 element list): The Rodrigues vector for the initial
+                                           guess of the tcp to target
+                                           transformation
+        ratio (float): The weight of position vs angular error, see
+                       :py:func:`error`
+
+    Returns: The results as a dictionary
+    """
+    cameras = correspondences['cameras']
+    tcp2robot, camera2grid, camera_index, sample_index = flatten_cameras(
+        correspondences['tcp2robot'], correspondences['camera2grid'])
+    print('solving for {} cameras from {} observations'.format(
+        len(cameras), len(camera_index)))
+    result = solve_cameras(tcp2robot, camera2grid, camera_index,
+                           len(cameras), tcp2target_guess, ratio=ratio)
+    result, inliers, rounds = reject_camera_outliers(
+        result, tcp2robot, camera2grid, camera_index, len(cameras), ratio)
+    observations = np.column_stack((sample_index, camera_index))
+
+    # least squares does not keep the rotation vectors in [-pi, pi]
+    poses = rotations.mat2pose(rotations.pose2mat(result.x.reshape(-1, 6)))
+    cam2robot = poses[:-1]
+    tcp2target = poses[-1]
+    json_dict = {"time": str(datetime.datetime.now()),
+                 "cameras": cameras,
+                 "cam2robot": [{"camera": name,
+                                "xyz-angle": pose.tolist(),
+                                "Tmatrix": vector2mat(pose).tolist()}
+                               for name, pose in zip(cameras, cam2robot)],
+                 "tcp2target": {"xyz-angle": tcp2target.tolist(),
+                                "Tmatrix": vector2mat(tcp2target).tolist()},
+                 "inliers": observations[inliers].tolist(),
+                 "outliers": observations[~inliers].tolist(),
+                 "minimization": {"terminated for": result.message,
+                                  "Number of executions of error function":
+                                      result.nfev,
+                                  "method": "least_squares",
+                                  "best result": {
+                                      "success": str(result.success),
+                                      "message": result.message,
+                                      "error": float(result.cost)},
+                                  "outlier rounds": rounds
+                                  }
+                 }
+
+    with open(os.path.splitext(file_out)[0] + '.json', 'w') as \
+            result_json_file:
+        json.dump(json_dict, result_json_file, indent=4)
+
+    return json_dict
+
+
+def flatten_cameras(tcp2robot, camera2grid):
+    """Flatten multi-camera correspondences into one row per observation.
+
+    Args:
+        tcp2robot (nx6 array): The robot poses
+        camera2grid (list of lists): For every robot pose, a list with the
+                                     camera to grid transformation seen by
+                                     each camera, or None where the grid was
+                                     not seen
+
+    Returns: A tuple, (kx6 np.ndarray of robot poses, kx6 np.ndarray of
+        camera to grid transformations, k np.ndarray of camera indices, k
+        np.ndarray of the index of the robot pose of each observation)
+    """
+    poses = []
+    grids = []
+    index = []
+    samples = []
+    for sample, (pose, seen) in enumerate(zip(tcp2robot, camera2grid)):
+        for camera, grid in enumerate(seen):
+            if grid is not None:
+                poses.append(pose)
+                grids.append(grid)
+                index.append(camera)
+                samples.append(sample)
+    return (np.asarray(poses, dtype=float).reshape(-1, 6),
+            np.asarray(grids, dtype=float).reshape(-1, 6),
+            np.asarray(index, dtype=int),
+            np.asarray(samples, dtype=int))
+
+
+def pose_residuals(parameters, tcp2robot, camera2grid, camera_index,
+                   ratio=0.25):
+    """The residuals of every observation for a set of transformations.
+
+    This is the vectorized least squares form of :py:func:`error`, extended to
+    several cameras sharing a tcp to target transformation.
+
+    Args:
+        parameters (array): The camera to robot transformation of each camera
+                            followed by the tcp to target transformation, all
+                            x,y,z,axis-angle
+        tcp2robot (nx6 array): The robot poses
+        camera2grid (nx6 array): The measured camera to grid transformations
+        camera_index (n array): The camera which made each observation
+        ratio (float): The weight of position vs angular error, in [0,1]
+
+    Returns: 6n np.ndarray, the weighted position and rotation vector error of
+        each observation
+    """
+    parameters = np.asarray(parameters, dtype=float)
+    cam2robot = rotations.pose2mat(parameters[:-6].reshape(-1, 6))
+    tcp2target = rotations.pose2mat(parameters[-6:])
+    predicted = np.matmul(np.matmul(cam2robot[camera_index],
+                                    rotations.pose2mat(tcp2robot)),
+                          tcp2target)
+    measured = rotations.pose2mat(camera2grid)
+    position = predicted[:, :3, 3] - measured[:, :3, 3]
+    rotation = rotations.mat2rotvec(np.matmul(
+        np.swapaxes(measured[:, :3, :3], 1, 2), predicted[:, :3, :3]))
+    return np.concatenate((position * ratio, rotation * (1 - ratio)),
+                          axis=1).ravel()
+
+
+def jacobian_sparsity(camera_index, cameras):
+    """The structure of the Jacobian of :py:func:`pose_residuals`.
+
+    Each observation only depends on the transformation of its own camera and
+    the shared tcp to target transformation, so the number of function
+    evaluations needed for a Jacobian does not grow with the number of
+    cameras.
+
+    Args:
+        camera_index (n array): The camera which made each observation
+        cameras (int): The number of cameras
+
+    Returns: A scipy.sparse.csr_matrix, 6n x 6(cameras + 1), of the non-zero
+        entries
+    """
+    camera_index = np.asarray(camera_index, dtype=int)
+    rows = np.arange(6 * len(camera_index))
+    observation_camera = np.repeat(camera_index, 6)
+    columns = np.hstack((6 * observation_camera[:, None] + np.arange(6),
+                         6 * cameras + np.arange(6) +
+                         np.zeros((len(rows), 1), dtype=int)))
+    from scipy import sparse
+    return sparse.csr_matrix(
+        (np.ones(columns.size, dtype=int),
+         (np.repeat(rows, columns.shape[1]), columns.ravel())),
+        shape=(len(rows), 6 * (cameras + 1)))
+
+
+def initial_cam2robot(tcp2robot, camera2grid, camera_index, cameras,
+                      tcp2target):
+    """Estimate each camera to robot transformation from a tcp to target
+    guess.
+
+    Every observation gives an estimate camera2grid * inv(tcp2target) *
+    inv(tcp2robot); the estimates for each camera are averaged.
+
+    Args:
+        tcp2robot (nx6 array): The robot poses
+        camera2grid (nx6 array): The measured camera to grid transformations
+        camera_index (n array): The camera which made each observation
+        cameras (int): The number of cameras
+        tcp2target (6 element list): The tcp to target guess
+
+    Returns: cameras x 6 np.ndarray of camera to robot transformations
+
+    Raises:
+        ValueError: A camera has no observations
+    """
+    estimates = np.matmul(
+        np.matmul(rotations.pose2mat(camera2grid),
+                  rotations.invert_transform(rotations.pose2mat(tcp2target))),
+        rotations.invert_transform(rotations.pose2mat(tcp2robot)))
+    result = np.zeros((cameras, 6))
+    for camera in range(cameras):
+        mine = estimates[np.asarray(camera_index) == camera]
+        if not len(mine):
+            raise ValueError('camera {} has no observations'.format(camera))
+        # project the mean rotation back onto a rotation matrix
+        u, _, vt = np.linalg.svd(mine[:, :3, :3].mean(axis=0))
+        rotation = np.matmul(u, vt)
+        if np.linalg.det(rotation) < 0:
+            rotation = np.matmul(u * [1, 1, -1], vt)
+        result[camera, :3] = mine[:, :3, 3].mean(axis=0)
+        result[camera, 3:] = rotations.mat2rotvec(rotation)
+    return result
+
+
+def solve_cameras(tcp2robot, camera2grid, camera_index, cameras,
+                  tcp2target_guess, cam2robot_guess=None, ratio=0.25,
+                  loss='soft_l1'):
+    """Jointly solve for every camera to robot transformation and the shared
+    tcp to target transformation.
+
+    Uses a sparse least squares solve, so the cost grows linearly with the
+    number of cameras and observations. As the solve is local, it is started
+    from the tcp to target guess and from the guess flipped 180 degrees about
+    each of its axes (targets are often mounted facing back at the tool), and
+    the best result is kept.
+
+    Args:
+        tcp2robot (nx6 array): The robot poses
+        camera2grid (nx6 array): The measured camera to grid transformations
+        camera_index (n array): The camera which made each observation
+        cameras (int): The number of cameras
+        tcp2target_guess (6 element list): The tcp to target guess
+        cam2robot_guess (cameras x 6 array): The camera to robot guesses. If
+                                             not given, they are estimated
+                                             for each start with
+                                             :py:func:`initial_cam2robot`
+        ratio (float): The weight of position vs angular error, in [0,1]
+        loss (str): The scipy.optimize.least_squares loss, a robust loss
+                    limits the influence of outliers
+
+    Returns: A scipy.optimize.OptimizeResult whose `x` is the camera to robot
+        transformations followed by the tcp to target transformation
+    """
+    if ratio < 0 or ratio > 1:
+        raise ValueError("ratio must be in the range [0,1]")
+    tcp2robot = np.asarray(tcp2robot, dtype=float)
+    camera2grid = np.asarray(camera2grid, dtype=float)
+    camera_index = np.asarray(camera_index, dtype=int)
+    sparsity = jacobian_sparsity(camera_index, cameras)
+
+    from scipy import optimize
+    guess_mat = rotations.pose2mat(tcp2target_guess)
+    best = None
+    for flip in np.vstack((np.zeros(3), np.pi * np.eye(3))):
+        start = rotations.mat2pose(np.matmul(
+            guess_mat, rotations.pose2mat(np.concatenate(([0, 0, 0], flip)))))
+        if cam2robot_guess is None:
+            cam2robot_start = initial_cam2robot(tcp2robot, camera2grid,
+                                                camera_index, cameras, start)
+        else:
+            cam2robot_start = cam2robot_guess
+        result = optimize.least_squares(
+            pose_residuals, np.concatenate((np.ravel(cam2robot_start), start)),
+            jac_sparsity=sparsity, x_scale='jac', loss=loss, method='trf',
+            args=(tcp2robot, camera2grid, camera_index, ratio))
+        if best is None or result.cost < best.cost:
+            best = result
+    return best
+
+
+def reject_camera_outliers(result, tcp2robot, camera2grid, camera_index,
+                           cameras, ratio=0.25, loss='soft_l1',
+                           max_rounds=10):
+    """Alternate between classifying outliers and solving without them.
+
+    This is :py:func:`reject_outliers` for :py:func:`solve_cameras`. Each
+    re-solve is a local least squares solve from the previous solution.
+
+    Args:
+        result (scipy.optimize.OptimizeResult): The solution with every
+                                                observation included
+        tcp2robot (nx6 array): The robot poses
+        camera2grid (nx6 array): The measured camera to grid transformations
+        camera_index (n array): The camera which made each observation
+        cameras (int): The number of cameras
+        ratio (float): The weight of position vs angular error, in [0,1]
+        loss (str): The scipy.optimize.least_squares loss
+        max_rounds (int): The most times to re-solve
+
+    Returns: A tuple, (scipy.optimize.OptimizeResult, the solution, n
+        np.ndarray of bool, whether each observation is an inlier, int, the
+        number of rounds)
+    """
+    from scipy import optimize
+    inliers = np.ones(len(camera_index), dtype=bool)
+    for rounds in range(1, max_rounds + 1):
+        # the residuals are the weighted position and rotation errors, so
+        # their norms sum to the error of each observation
+        errors = np.linalg.norm(pose_residuals(
+            result.x, tcp2robot, camera2grid, camera_index,
+            ratio).reshape(-1, 2, 3), axis=2).sum(axis=1)
+        classified = np.logical_not(mad_based_outlier(errors))
+        if np.array_equal(classified, inliers):
+            break
+        inliers = classified
+        print('re-solving without {} outliers'.format(
+            np.count_nonzero(~inliers)))
+        result = optimize.least_squares(
+            pose_residuals, result.x,
+            jac_sparsity=jacobian_sparsity(camera_index[inliers], cameras),
+            x_scale='jac', loss=loss, method='trf',
+            args=(tcp2robot[inliers], camera2grid[inliers],
+                  camera_index[inliers], ratio))
+    return result, inliers, rounds
+
+
 class Bounds(object):
     def __init__(self, xmax, xmin):
         self.xmax = np.array(xmax)
@@ -223,7 +649,7 @@ class Bounds(object):
         return tmax and tmin
 
 
-def error(guess, tcp2robot, camera2grid, ratio=0.25):
+def error(guess, tcp2robot, camera2grid, ratio=0.25, inliers=None):
     """
     Calculates the difference between a guess at robot 2 cam transformations
     compared to gathered data. Uses manhattan error for the distance (as
@@ -244,36 +670,87 @@ def error(guess, tcp2robot, camera2grid, ratio=0.25):
                        angular error. A higer value will give more weight to
                        the manhattan error and less to the the angular error.
                        Must be in the range [0,1]
+        inliers (n array of bool): The samples to include. If not given,
+                                   outliers are rejected on every call, which
+                                   makes the error discontinuous, see
+                                   :py:func:`reject_outliers`.
 
     Returns: A float, the total error between the guess and the collected
              data
     """
-    errors = np.zeros(len(tcp2robot))
-    total_error = 0
+    errors = pose_errors(guess, tcp2robot, camera2grid, ratio)
+    if inliers is None:
+        inliers = np.logical_not(mad_based_outlier(errors))
+    return np.mean(errors[inliers])
+
+
+def pose_errors(guess, tcp2robot, camera2grid, ratio=0.25):
+    """The error of each sample for a guess, see :py:func:`error`.
+
+    Args:
+        guess (12 or hx12 array): The camera to robot and tcp to target
+                                  transformations, x,y,z,axis-angle. Several
+                                  guesses can be scored at once.
+        tcp2robot (nx6 array): The robot poses
+        camera2grid (nx6 array): The measured camera to grid transformations
+        ratio (float): The weight of position vs angular error, in [0,1]
+
+    Returns: n (or hxn) np.ndarray, the weighted sum of the position and
+        angular error of each sample
+    """
     if ratio < 0:
         raise ValueError("ratio must be greater than or equal to zero")
     if ratio > 1:
         raise ValueError("ratio must be less than or equal to one")
-    for i in range(len(tcp2robot)):
-        guess_cam2rob = vector2mat(guess[:6])
-        guess_tcp2target = vector2mat(guess[6:])
-        guess_cam2tcp = np.matmul(guess_cam2rob,
-                                  vector2mat(np.concatenate(
-                                      (np.array(tcp2robot[i][:3]),
-                                       np.array(tcp2robot[i][3:])))))
-        guess_cam2target = np.matmul(guess_cam2tcp, guess_tcp2target)
+    guess = np.asarray(guess, dtype=float)[..., None, :]
+    predicted = np.matmul(np.matmul(rotations.pose2mat(guess[..., :6]),
+                                    rotations.pose2mat(tcp2robot)),
+                          rotations.pose2mat(guess[..., 6:]))
+    measured = rotations.pose2mat(camera2grid)
+    euclidean_distance = np.linalg.norm(
+        predicted[..., :3, 3] - measured[:, :3, 3], axis=-1)
+    cosine = (np.trace(np.matmul(np.swapaxes(measured[:, :3, :3], 1, 2),
+                                 predicted[..., :3, :3]),
+                       axis1=-2, axis2=-1) - 1) / 2
+    angular_error = np.arccos(np.clip(cosine, -1, 1))
+    return euclidean_distance * ratio + angular_error * (1 - ratio)
+
+
+def reject_outliers(guess, tcp2robot, camera2grid, minimizer, bounds,
+                    ratio=0.25, max_rounds=10):
+    """Alternate between classifying outliers and solving without them.
+
+    Outliers are classified once per solve with :py:func:`mad_based_outlier`
+    and held fixed while solving, so the error being minimized stays smooth.
+    This repeats until the outliers no longer change.
 
-        euclidean_distance = np.sqrt(np.sum(np.square(
-            np.array(guess_cam2target[:3, 3]) - np.array(camera2grid[i][:3])
-        )))
-        angular_error = math.acos(
-            (np.trace(np.matmul(vector2mat(np.array(camera2grid[i]))[:3, :3].T,
-                                guess_cam2target[:3, :3]))-1)/2)
-
-        errors[i] = euclidean_distance*ratio + angular_error*(1-ratio)
-
-    return np.mean(errors[
-                       np.where(mad_based_outlier(np.array(errors)) == False)])
+    Args:
+        guess (1x12 array): The solution with every sample included
+        tcp2robot (nx6 array): The robot poses
+        camera2grid (nx6 array): The measured camera to grid transformations
+        minimizer (str): The scipy.optimize.minimize method
+        bounds (list of tuples): The bounds of each parameter
+        ratio (float): The weight of position vs angular error, in [0,1]
+        max_rounds (int): The most times to re-solve
+
+    Returns: A tuple, (12 element np.ndarray, the solution, n np.ndarray of
+        bool, whether each sample is an inlier, int, the number of rounds)
+    """
+    from scipy import optimize
+    inliers = np.ones(len(tcp2robot), dtype=bool)
+    for rounds in range(1, max_rounds + 1):
+        classified = np.logical_not(mad_based_outlier(
+            pose_errors(guess, tcp2robot, camera2grid, ratio)))
+        if np.array_equal(classified, inliers):
+            break
+        inliers = classified
+        print('re-solving without {} outliers'.format(
+            np.count_nonzero(~inliers)))
+        guess = optimize.minimize(
+            error, guess, args=(tcp2robot, camera2grid, ratio, inliers),
+            method=minimizer, bounds=bounds,
+            options={"maxiter": 25000}).x
+    return guess, inliers, rounds
 
 
 def mad_based_outlier(points, thresh=3.5):
@@ -302,15 +779,7 @@ def vector2mat(vector):
 
     Returns: A 4x4 np.ndarry of the homogenous transformation matrix
     """
-    transformation_matrix = np.zeros((4, 4))
-    transformation_matrix[3, 3] = 1
-    try:
-        transformation_matrix[0:3, 3] = vector[:3, 0]
-    except:
-        transformation_matrix[0:3, 3] = vector[:3]
-    rotation_matrix, _ = cv2.Rodrigues(np.array(vector[3:]))
-    transformation_matrix[:3, :3] = rotation_matrix
-    return transformation_matrix
+    return rotations.pose2mat(np.ravel(vector)[:6])
 
 
 def mat2vector(mat):
@@ -321,11 +790,7 @@ def mat2vector(mat):
 
     Returns: A 6 element list, x,y,z,axis-angle
     """
-    vector = [0]*6
-    vector[:3] = np.asarray(mat[:3, 3])
-    axis_angle, _ = cv2.Rodrigues(np.array(mat[:3, :3]))
-    vector[3:] = axis_angle
-    return vector
+    return rotations.mat2pose(mat).tolist()
 
 
 def callback(x, f, accept):
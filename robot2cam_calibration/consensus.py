@@ -0,0 +1,290 @@
+"""A file to compute the calibration by consensus over small sets of poses.
+
+A few badly wrong camera to grid measurements (reflections, a grid found with
+the wrong corner ordering) can pull a minimization far off before outliers
+are rejected. Here, like RANSAC, the transformations are solved in closed
+form from many random minimal sets of samples, every hypothesis is scored
+against all of the samples and the one with the best consensus is refined on
+its inliers only.
+
+Each camera to grid measurement is G = X T Y, where X is the camera to robot
+transformation, T the robot pose and Y the tcp to target transformation. For
+two samples, Gi inv(Gj) = X Ti inv(Tj) inv(X), which is the hand-eye problem
+AX = XB. X is solved for with the method of Park and Martin (Robot Sensor
+Calibration: Solving AX = XB on the Euclidean Group, 1994) and Y then follows
+from each sample.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+
+import numpy as np
+from scipy import optimize
+
+import robot2cam_calibration.compute_transformations as compute
+import robot2cam_calibration.rotations as rotations
+
+# The data shared by the hypothesis worker processes, see _init_worker
+_worker_data = None
+
+
+def consensus_transformation(correspondences, file_out, hypotheses=500,
+                             subset_size=3, threshold=None, workers=None,
+                             minimizer='SLSQP', ratio=0.25):
+    """Computes the camera to robot base and tcp to target transformations by
+    consensus, see :py:func:`consensus`.
+
+    Args:
+        correspondences (dict): The correspondences, with fields 'tcp2robot'
+                                and 'camera2grid'
+        file_out (string): The name of the file to be output (no extension)
+        hypotheses (int): The number of minimal sets to solve
+        subset_size (int): The number of samples in each minimal set, at
+                           least 3
+        threshold (float): The error (see
+                           :py:func:`compute_transformations.error`) below
+                           which a sample agrees with a hypothesis. If None,
+                           the hypothesis with the least median error is kept
+                           and outliers are found with
+                           :py:func:`compute_transformations.mad_based_outlier`
+        workers (int): The number of processes, None for one per CPU
+        minimizer (str): The scipy.optimize.minimize method of the final
+                         refinement
+        ratio (float): The weight of position vs angular error
+
+    Returns: The results as a dictionary
+    """
+    tcp2robot = np.asarray(correspondences['tcp2robot'], dtype=float)
+    camera2grid = np.asarray(correspondences['camera2grid'], dtype=float)
+    print('solving {} hypotheses from sets of {} of {} samples'.format(
+        hypotheses, subset_size, len(tcp2robot)))
+    best, score, inliers, solved = consensus(
+        tcp2robot, camera2grid, hypotheses, subset_size, threshold, workers,
+        ratio)
+    print('best consensus of {} samples, refining'.format(
+        np.count_nonzero(inliers)))
+    result = optimize.minimize(
+        compute.error, best,
+        args=(tcp2robot, camera2grid, ratio, inliers), method=minimizer,
+        options={"maxiter": 25000})
+
+    solution = rotations.mat2pose(rotations.pose2mat(
+        result.x.reshape(-1, 6))).ravel()
+    json_dict = {"time": str(datetime.datetime.now()),
+                 "cam2robot": {"xyz-angle": solution[:6].tolist(),
+                               "Tmatrix": compute.vector2mat(
+                                   solution[:6]).tolist()},
+                 "tcp2target": {"xyz-angle": solution[6:].tolist(),
+                                "Tmatrix": compute.vector2mat(
+                                    solution[6:]).tolist()},
+                 "inliers": np.flatnonzero(inliers).tolist(),
+                 "outliers": np.flatnonzero(~inliers).tolist(),
+                 "minimization": {"method": "consensus",
+                                  "hypotheses": solved,
+                                  "subset size": subset_size,
+                                  "threshold": threshold,
+                                  "consensus score": score,
+                                  "refinement": {
+                                      "method": minimizer,
+                                      "success": str(result.success),
+                                      "message": result.message},
+                                  "error": float(result.fun)
+                                  }
+                 }
+
+    with open(os.path.splitext(file_out)[0] + '.json', 'w') as \
+            result_json_file:
+        json.dump(json_dict, result_json_file, indent=4)
+    return json_dict
+
+
+def consensus(tcp2robot, camera2grid, hypotheses=500, subset_size=3,
+              threshold=None, workers=None, ratio=0.25, seed=0):
+    """Find the transformations which most samples agree with.
+
+    The hypotheses are solved and scored in chunks on a pool of processes.
+
+    Args:
+        tcp2robot (nx6 array): The robot poses
+        camera2grid (nx6 array): The measured camera to grid transformations
+        hypotheses (int): The number of minimal sets to solve
+        subset_size (int): The number of samples in each minimal set
+        threshold (float): The error below which a sample agrees with a
+                           hypothesis, or None to use the least median error
+        workers (int): The number of processes, None for one per CPU
+        ratio (float): The weight of position vs angular error
+        seed (int): The seed of the sample selection
+
+    Returns: A tuple, (12 element np.ndarray, the best hypothesis, float, its
+        score, n np.ndarray of bool, whether each sample is an inlier, int,
+        the number of hypotheses which could be solved)
+
+    Raises:
+        ValueError: There are too few samples, or no set could be solved
+    """
+    if subset_size < 3:
+        raise ValueError('at least 3 samples are needed per set')
+    if len(tcp2robot) < subset_size:
+        raise ValueError('there are fewer samples than the set size')
+    workers = workers or multiprocessing.cpu_count()
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1,
+                                                size=hypotheses)
+    chunks = np.array_split(seeds, min(hypotheses, 4 * workers))
+    pool = multiprocessing.Pool(
+        workers, initializer=_init_worker,
+        initargs=(tcp2robot, camera2grid, subset_size, threshold, ratio))
+    try:
+        results = pool.map(_solve_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    solved = sum(count for _, _, count in results)
+    if not solved:
+        raise ValueError('no set of samples could be solved, the robot poses '
+                         'may not rotate about enough different axes')
+    score, best, _ = min((result for result in results
+                          if result[1] is not None), key=lambda x: x[0])
+    errors = compute.pose_errors(best, tcp2robot, camera2grid, ratio)
+    if threshold is None:
+        inliers = np.logical_not(compute.mad_based_outlier(errors))
+    else:
+        inliers = errors < threshold
+    return best, float(score), inliers, solved
+
+
+def score_hypotheses(guesses, tcp2robot, camera2grid, threshold=None,
+                     ratio=0.25):
+    """Score many hypotheses against every sample at once.
+
+    Args:
+        guesses (hx12 array): The hypotheses
+        tcp2robot (nx6 array): The robot poses
+        camera2grid (nx6 array): The measured camera to grid transformations
+        threshold (float): With a threshold, the score is the sum of the
+                           errors capped at the threshold (MSAC). Without,
+                           the score is the median error (LMedS).
+        ratio (float): The weight of position vs angular error
+
+    Returns: h np.ndarray, the score of each hypothesis, lower is better
+    """
+    errors = compute.pose_errors(guesses, tcp2robot, camera2grid, ratio)
+    if threshold is None:
+        return np.median(errors, axis=-1)
+    return np.minimum(errors, threshold).sum(axis=-1)
+
+
+def solve_subset(tcp2robot, camera2grid):
+    """Solve for the transformations in closed form from a few samples.
+
+    Args:
+        tcp2robot (mx6 array): The robot poses, m >= 3
+        camera2grid (mx6 array): The measured camera to grid transformations
+
+    Returns: 12 element np.ndarray, the camera to robot and tcp to target
+        transformations, or None if the robot poses do not rotate about at
+        least two different axes
+    """
+    robot = rotations.pose2mat(tcp2robot)
+    grid = rotations.pose2mat(camera2grid)
+    pairs = np.array(list(itertools.combinations(range(len(robot)), 2)))
+    # Gi inv(Gj) X = X Ti inv(Tj)
+    a = np.matmul(grid[pairs[:, 0]],
+                  rotations.invert_transform(grid[pairs[:, 1]]))
+    b = np.matmul(robot[pairs[:, 0]],
+                  rotations.invert_transform(robot[pairs[:, 1]]))
+
+    # the rotation axes are related by the camera to robot rotation
+    alpha = rotations.mat2rotvec(a[:, :3, :3])
+    beta = rotations.mat2rotvec(b[:, :3, :3])
+    u, singular, vt = np.linalg.svd(np.dot(beta.T, alpha))
+    if singular[1] < 1e-6 * max(singular[0], 1e-12):
+        return None
+    correction = np.diag([1, 1, np.sign(np.linalg.det(np.dot(vt.T, u.T)))])
+    rotation = np.dot(np.dot(vt.T, correction), u.T)
+
+    # (Ra - I) t = R tb - ta
+    lhs = (a[:, :3, :3] - np.eye(3)).reshape(-1, 3)
+    rhs = (np.dot(b[:, :3, 3], rotation.T) - a[:, :3, 3]).ravel()
+    cam2robot = np.eye(4)
+    cam2robot[:3, :3] = rotation
+    cam2robot[:3, 3] = np.linalg.lstsq(lhs, rhs, rcond=None)[0]
+
+    # Y = inv(T) inv(X) G for every sample, averaged
+    estimates = np.matmul(np.matmul(rotations.invert_transform(robot),
+                                    rotations.invert_transform(cam2robot)),
+                          grid)
+    u, _, vt = np.linalg.svd(estimates[:, :3, :3].mean(axis=0))
+    mean_rotation = np.dot(u, vt)
+    if np.linalg.det(mean_rotation) < 0:
+        mean_rotation = np.dot(u * [1, 1, -1], vt)
+    tcp2target = np.eye(4)
+    tcp2target[:3, :3] = mean_rotation
+    tcp2target[:3, 3] = estimates[:, :3, 3].mean(axis=0)
+    return rotations.mat2pose(np.stack((cam2robot, tcp2target))).ravel()
+
+
+def _init_worker(tcp2robot, camera2grid, subset_size, threshold, ratio):
+    """Store the data shared by every hypothesis in a worker process.
+
+    Args:
+        tcp2robot (nx6 array): The robot poses
+        camera2grid (nx6 array): The measured camera to grid transformations
+        subset_size (int): The number of samples in each minimal set
+        threshold (float): The consensus threshold, see
+                           :py:func:`score_hypotheses`
+        ratio (float): The weight of position vs angular error
+    """
+    global _worker_data
+    _worker_data = (tcp2robot, camera2grid, subset_size, threshold, ratio)
+
+
+def _solve_chunk(seeds):
+    """Solve and score a chunk of hypotheses in a worker process.
+
+    Args:
+        seeds (array of int): The seed of each hypothesis
+
+    Returns: A tuple, (float, the best score, 12 element np.ndarray, the best
+        hypothesis or None if none could be solved, int, the number of
+        hypotheses solved)
+    """
+    tcp2robot, camera2grid, subset_size, threshold, ratio = _worker_data
+    guesses = []
+    for seed in seeds:
+        subset = np.random.RandomState(seed).choice(
+            len(tcp2robot), subset_size, replace=False)
+        guess = solve_subset(tcp2robot[subset], camera2grid[subset])
+        if guess is not None:
+            guesses.append(guess)
+    if not guesses:
+        return np.inf, None, 0
+    scores = score_hypotheses(np.array(guesses), tcp2robot, camera2grid,
+                              threshold, ratio)
+    best = np.argmin(scores)
+    return scores[best], guesses[best], len(guesses)
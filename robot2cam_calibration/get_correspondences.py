@@ -1,7 +1,7 @@
-"""A file to move a UR robot with a grid and save correspondences between
+"""A file to move a robot with a grid and save correspondences between
 camera and robot pose for future processing.
 
-todo: generalize this to other robot types
+The robot is driven through :py:mod:`robots`, a UR by default.
 """
 
 # The MIT License (MIT)
@@ -27,13 +27,19 @@ todo: generalize this to other robot types
 # SOFTWARE.
 
 import argparse
-import datetime
+import contextlib
 import os
 
 import robot2cam_calibration.track_grid as ci
-import ur_cb2.cb2_robot as cb2_robot
+import robot2cam_calibration.synchronize as synchronize
+import robot2cam_calibration.sweep as sweep
+import robot2cam_calibration.pipeline as pipeline
+import robot2cam_calibration.journal as journal
+import robot2cam_calibration.planning as planning
+import robot2cam_calibration.targets as targets
+import robot2cam_calibration.robots as robots
 import json
-import time
+import cv2
 import numpy as np
 
 
@@ -44,8 +50,8 @@ def main():
     """
     # Parse in arguments
     parser = argparse.ArgumentParser(
-        description="Get correspondences between camera and UR Robot",
-        epilog="Gets correspondences between a camera and UR Robot with a "
+        description="Get correspondences between camera and robot",
+        epilog="Gets correspondences between a camera and robot with a "
                "grid attached. Relies on pre-trained points to direct "
                "robot motion. Will try to find the grid 5 times per "
                "position. Generates a json file with all of the data "
@@ -70,18 +76,46 @@ def main():
                         help="the number of inner corners vertically",
                         required=True)
 
-    parser.add_argument("--calibration", type=str,
+    parser.add_argument("--target", type=str,
+                        help="The type of target attached to the robot. For "
+                             "circle grids, rows and columns count circles, "
+                             "for charuco boards they count squares and for "
+                             "apriltag grids they count tags.",
+                        choices=targets.TARGETS,
+                        default="chessboard")
+
+    parser.add_argument("--marker", type=float,
+                        help="The side length of the markers in mm, for "
+                             "charuco and apriltag targets.",
+                        default=None)
+
+    parser.add_argument("--refine_window", type=int,
+                        help="The half size (pixels) of the window in which "
+                             "chessboard corners are refined. It should be "
+                             "less than half of a grid square in the image.",
+                        default=11)
+
+    parser.add_argument("--calibration", type=str, nargs='+',
                         help="The filename of the camera calibration "
                              "information. This file can be generated using "
                              "the`calibrate-camera` command from the "
-                             "camera-calibration toolbox.",
+                             "camera-calibration toolbox. Give one per "
+                             "camera.",
                         required=True)
 
-    parser.add_argument("--camera", type=str,
+    parser.add_argument("--camera", type=str, nargs='+',
                         help="The name of the camera to be used."
                              "Valid options are:"
-                             "- `flycap`",
-                        default="flycap")
+                             "- `flycap`"
+                             "Give several cameras (ex: `flycap:0 flycap:1`) "
+                             "to capture from all of them at each point.",
+                        default=["flycap"])
+
+    parser.add_argument("--robot", type=str,
+                        help="The type of robot, see robots.py. `simulated` "
+                             "connects to robot2cam-simulate-robot.",
+                        choices=robots.ROBOTS,
+                        default="ur")
 
     parser.add_argument("--address", type=str,
                         help="The address of the robot in form: `###.###.###`",
@@ -94,6 +128,69 @@ def main():
                         help="File to save output to",
                         default="correspondences.json")
 
+    parser.add_argument("--continuous", action='store_true',
+                        help="Sweep through the points without stopping, "
+                             "keeping the sharpest well synchronized frame "
+                             "near each point.")
+
+    parser.add_argument("--velocity", type=float,
+                        help="The joint velocity in rad/s to use when "
+                             "sweeping in continuous mode.",
+                        default=0.2)
+
+    parser.add_argument("--blend", type=float,
+                        help="How close (rad) the robot must get to a point "
+                             "before moving to the next in continuous mode.",
+                        default=0.02)
+
+    parser.add_argument("--max_speed", type=float,
+                        help="The fastest the tool may move (m/s) for a "
+                             "frame to be kept in continuous mode. Raise it "
+                             "if no frames are kept with a large blend.",
+                        default=0.005)
+
+    parser.add_argument("--max_angular_speed", type=float,
+                        help="The fastest the tool may turn (rad/s) for a "
+                             "frame to be kept in continuous mode.",
+                        default=0.02)
+
+    parser.add_argument("--workers", type=int,
+                        help="The number of threads finding grids while the "
+                             "robot moves. With 0, grids are found before "
+                             "moving on.",
+                        default=2)
+
+    parser.add_argument("--resume", action='store_true',
+                        help="Resume an interrupted capture, skipping the "
+                             "points already recorded in the journal which "
+                             "goes along with the output file.")
+
+    parser.add_argument("--transformation", type=str,
+                        help="A rough transformation file (from a previous "
+                             "calibration of this setup) used to predict "
+                             "where the grid will be in each image, which "
+                             "speeds up finding it. Points where the grid "
+                             "would not be found are skipped.",
+                        default=None)
+
+    parser.add_argument("--max_angle", type=float,
+                        help="With --transformation, skip points where the "
+                             "grid would be seen more obliquely than this "
+                             "(degrees)",
+                        default=60)
+
+    parser.add_argument("--min_spacing", type=float,
+                        help="With --transformation, skip points where "
+                             "neighbouring corners would be closer than "
+                             "this (pixels)",
+                        default=8)
+
+    parser.add_argument("--image_folder", type=str,
+                        help="If given, save the image each grid was found "
+                             "in to this folder and record its file name "
+                             "with the sample, for robot2cam-check.",
+                        default=None)
+
     args = parser.parse_args()
 
     get_correspondences(
@@ -105,41 +202,125 @@ def main():
         camera=args.camera,
         robot_address=args.address,
         robot_port=args.port,
-        file_out=args.out
+        file_out=args.out,
+        robot_type=args.robot,
+        continuous=args.continuous,
+        velocity=args.velocity,
+        blend=args.blend,
+        max_speed=args.max_speed,
+        max_angular_speed=args.max_angular_speed,
+        workers=args.workers,
+        resume=args.resume,
+        transformation=args.transformation,
+        target=args.target,
+        marker_length=args.marker,
+        refine_window=args.refine_window,
+        image_folder=args.image_folder,
+        max_angle=args.max_angle,
+        min_spacing=args.min_spacing
     )
 
 
 def get_correspondences(robot_samples, calibration, rows, cols, spacing,
-                        camera, robot_address, robot_port, file_out):
+                        camera, robot_address, robot_port, file_out,
+                        continuous=False, velocity=0.2, blend=0.02,
+                        workers=2, resume=False, transformation=None,
+                        target='chessboard', marker_length=None,
+                        image_folder=None, robot_type='ur', max_angle=60,
+                        min_spacing=8, max_speed=0.005,
+                        max_angular_speed=0.02, refine_window=11):
     """
-    Gets correspondences between a camera and UR Robot with a grid attached.
+    Gets correspondences between a camera and robot with a grid attached.
     Relies on pre-trained points to direct robot motion. Will try to find the
     grid 5 times per position. Generates a json file with all of the data
     needed o then calculate the tool offset and the camera to robot
     transformation.
 
+    With several cameras, every camera captures an image at each point in a
+    single pass of the robot. The correspondence file then lists the camera
+    names under `cameras` and each entry of `camera2grid` is a list with the
+    transformation seen by each camera (None where the grid was not found).
+
     Args:
         robot_samples (str): The filename for the file containing the list of
                              points which the robot should move through. This
                              file can be generated using the `cb2-record`
                              command from the ur_cb2 package.
-        calibration (str): The filename of the camera calibration information.
-                           This file can be generated using the
-                           `calibrate-camera` command from the
-                           camera-calibration toolbox.
+        calibration (str or list): The filename of the camera calibration
+                                   information, or a list with one per
+                                   camera. This file can be generated using
+                                   the `calibrate-camera` command from the
+                                   camera-calibration toolbox.
         rows (int): The number of rows on the grid which is attached to the
                     robot
         cols (int): The number of columns on the grid which is attached to the
                     robot
         spacing (float): The spacing in mm between grid corners on the grid
                          which is attached to the robot
-        camera (str): The name of the camera to be used.
-                      Valid options are:
-                        - `flycap`
+        camera (str or list): The name of the camera to be used, or a list of
+                              cameras to capture from together.
+                              Valid options are:
+                                - `flycap`
         robot_address (str): The address of the robot in form: `###.###.###`
         robot_port (int): The port of the robot
         file_out (str): The file in which to save all of the generated data.
+        continuous (bool): Whether to sweep through the points without
+                           stopping (see :py:func:`sweep.sweep`) rather than
+                           stopping at each point. Only supported with a
+                           single camera.
+        velocity (float): The joint velocity in rad/s for continuous mode
+        blend (float): How close (rad) the robot must get to a point before
+                       moving to the next in continuous mode
+        workers (int): The number of threads finding grids while the robot
+                       moves on to the next point. Points where the grid was
+                       not found are revisited at the end.
+        resume (bool): Whether to resume an interrupted capture. Every sample
+                       is recorded in a journal (`file_out` with a `.journal`
+                       extension) as soon as it is captured and points which
+                       are already in the journal are skipped.
+        transformation (str): The filename of a rough transformation file, as
+                              written by `robot2cam-compute`. If given, it is
+                              used to predict where the grid is in each
+                              image so that only that region is searched,
+                              and to skip points where the grid would not
+                              be found (see :py:func:`detectable_points`).
+        target (str): The type of target attached to the robot, one of
+                      :py:data:`targets.TARGETS`
+        marker_length (float): The side length of the markers in mm, for
+                               `charuco` and `apriltag` targets
+        image_folder (str): If given, the raw image each grid was found in is
+                            saved to this folder and its file name (relative
+                            to the folder) is recorded as `image`, so that
+                            `robot2cam-check` can match images to samples.
+        robot_type (str): The type of robot, one of :py:data:`robots.ROBOTS`
+        max_angle (float): With a transformation, skip points where the grid
+                           would be seen more obliquely than this (degrees)
+        min_spacing (float): With a transformation, skip points where
+                             neighbouring corners would be closer than this
+                             (pixels)
+        max_speed (float): The fastest the tool may move (m/s) for a frame
+                           to be kept in continuous mode
+        max_angular_speed (float): The fastest the tool may turn (rad/s) for
+                                   a frame to be kept in continuous mode
+        refine_window (int): The half size (pixels) of the window in which
+                             chessboard corners are refined, see
+                             :py:class:`targets.Chessboard`
+
+    Raises:
+        ValueError: The cameras and calibrations do not match, continuous
+            capture was requested with several cameras, or the journal being
+            resumed was recorded with a different grid, calibration or
+            cameras
     """
+    cameras = camera if isinstance(camera, (list, tuple)) else [camera]
+    calibrations = (calibration if isinstance(calibration, (list, tuple))
+                    else [calibration])
+    if len(cameras) != len(calibrations):
+        raise ValueError('there must be one calibration per camera')
+    multi_camera = len(cameras) > 1
+    if continuous and multi_camera:
+        raise ValueError('continuous capture only supports a single camera')
+
     with open(robot_samples, 'r') as f:
         data = json.load(f)
         write_time = data['time']
@@ -147,50 +328,352 @@ def get_correspondences(robot_samples, calibration, rows, cols, spacing,
         print('read in {} points, written at: {}'.format(len(points.keys()),
                                                          write_time))
 
-    camera2grid = []
-    tcp2robot = []
-
-    with ci.GridLocation(calibration, rows, cols, spacing, camera) as calib:
-        with cb2_robot.URRobot(robot_address, robot_port) as robot:
-            for number in sorted([int(x) for x in points.keys()]):
-                robot.add_goal(cb2_robot.Goal(points[str(number)]['joint'],
-                                              False, 'joint'))
-                # TODO: this appears to skip the first point!
-                robot.move_on_stop()
-                print('Beginning move: {}'.format(number))
-
-                while not (robot.at_goal() and robot.is_stopped()):
-                    time.sleep(.25)
-                time.sleep(.25)  # let everything settle
-                print("reached goal")
-                go_on = 0
-                while go_on <= 5:
+    estimates = [None] * len(cameras)
+    if transformation is not None:
+        with open(transformation, 'r') as f:
+            data = json.load(f)
+        cam2robot = data['cam2robot']
+        if not isinstance(cam2robot, list):
+            cam2robot = [cam2robot]
+        estimates = [(pose['xyz-angle'], data['tcp2target']['xyz-angle'])
+                     for pose in cam2robot]
+
+    journal_file = journal.journal_name(file_out)
+    header = {"grid": {"rows": rows,
+                       "cols": cols,
+                       "spacing": spacing,
+                       "target": target,
+                       "marker": marker_length},
+              "calibration": calibrations if multi_camera else calibrations[0]}
+    if multi_camera:
+        header["cameras"] = cameras
+    grid_target = targets.create(target, rows, cols, spacing, marker_length,
+                                 refine_window=refine_window)
+    if image_folder is not None and not os.path.isdir(image_folder):
+        os.makedirs(image_folder)
+
+    with journal.Journal(journal_file, header, resume) as capture_journal, \
+            grid_locations(calibrations, rows, cols, spacing, cameras,
+                           grid_target) as calibs:
+        with robots.create(robot_type, robot_address, robot_port) as robot:
+            with robot.pose_stream() as pose_stream:
+                synchronizer = synchronize.Synchronizer(pose_stream)
+                numbers = [number for number in
+                           sorted([int(x) for x in points.keys()])
+                           if number not in capture_journal.points]
+                numbers, skipped = detectable_points(
+                    calibs, points, numbers, estimates, max_angle,
+                    min_spacing)
+                for number in sorted(skipped):
+                    print('skipping point {}, the grid would be {}'.format(
+                        number, skipped[number]))
+                pending = []
+                with pipeline.CapturePipeline(workers) as capture_pipeline:
+                    if not numbers:
+                        print('there are no points left to record')
+                    elif continuous:
+                        candidates = sweep.sweep(
+                            robot, calibs[0].cam, pose_stream,
+                            [points[str(number)]['joint']
+                             for number in numbers],
+                            velocity=velocity, blend=blend,
+                            max_speed=max_speed,
+                            max_angular_speed=max_angular_speed)
+                        for number, candidate in zip(numbers, candidates):
+                            if candidate is None:
+                                print('no usable frame for point: {}'.format(
+                                    number))
+                                continue
+                            pending.append((number, capture_pipeline.submit(
+                                record_grid, calibs, capture_journal, number,
+                                candidate.pose, candidate.skew,
+                                [candidate.frame.image], estimates,
+                                image_folder)))
+                    else:
+                        for number in numbers:
+                            print('Beginning move: {}'.format(number))
+                            stopped_time = robot.move_and_wait(
+                                points[str(number)]['joint'])
+                            print("reached goal")
+                            frames = capture_frames(calibs, stopped_time)
+                            pose, pose_skew = synchronizer.pair(
+                                frames[0].time)
+                            # The robot moves on while the grid is found
+                            pending.append((number, capture_pipeline.submit(
+                                record_grid, calibs, capture_journal, number,
+                                pose, pose_skew,
+                                [frame.image for frame in frames],
+                                estimates, image_folder)))
+                            calibs[0].show_images()
+
+                # Anything going wrong with one point only sends it to the
+                # retries, so the results of the others are kept
+                for number, task in pending:
                     try:
-                        camera2grid.append(calib.get_cam2grid())
-                        calib.show_images()
-                        with robot.receiver.lock:
-                            tcp2robot.append(robot.receiver.position)
-                        print("got the grid")
-                        go_on = 6
-                    except RuntimeError as e:
-                        print("something went wrong: {}".format(e))
-                        go_on += 1
-    tcp2robot = np.array(tcp2robot)
-    tcp2robot[:, 0:3] = tcp2robot[:, 0:3] * 1000
-    tcp2robot = tcp2robot.tolist()
-
-    print(np.asarray(tcp2robot))  # Axis-Angle [x,y,z,ax,ay,az]
-    print(np.asarray(camera2grid))
-    json_dict = {"grid": {"rows": rows,
-                          "cols": cols,
-                          "spacing": spacing},
-                 "time": str(datetime.datetime.now()),
-                 "calibration": calibration,
-                 "tcp2robot": tcp2robot,
-                 "camera2grid": camera2grid}
-    with open(os.path.splitext(file_out)[0] + '.json', 'w') as \
-            result_json_file:
-        json.dump(json_dict, result_json_file, indent=4)
+                        task.result()
+                    except Exception as e:
+                        print("something went wrong at point {}: {}: "
+                              "{}".format(number, type(e).__name__, e))
+
+                # Go back to any points where the grid was not found and try
+                # a few more times while holding still
+                for number in [x for x in numbers
+                               if x not in capture_journal.points]:
+                    print('Retrying point: {}'.format(number))
+                    stopped_time = robot.move_and_wait(
+                        points[str(number)]['joint'])
+                    go_on = 0
+                    while go_on <= 5:
+                        try:
+                            frames = capture_frames(calibs, stopped_time)
+                            pose, pose_skew = synchronizer.pair(
+                                frames[0].time)
+                            record_grid(calibs, capture_journal, number,
+                                        pose, pose_skew,
+                                        [frame.image for frame in frames],
+                                        estimates, image_folder)
+                            calibs[0].show_images()
+                            print("got the grid")
+                            go_on = 6
+                        except Exception as e:
+                            # one bad point uses up its retries rather than
+                            # ending the capture
+                            print("something went wrong at point {}: {}: "
+                                  "{}".format(number, type(e).__name__, e))
+                            go_on += 1
+                print('timing: {}'.format(synchronizer.skew_statistics()))
+
+    json_dict = journal.compact(journal_file, file_out)
+    print(np.asarray(json_dict['tcp2robot']))  # Axis-Angle [x,y,z,ax,ay,az]
+    print(np.asarray(json_dict['camera2grid']))
+
+
+def record_grid(calibs, capture_journal, number, pose, pose_skew, images,
+                estimates=None, image_folder=None):
+    """Find the grid in each camera's image and record the sample in the
+    journal.
+
+    The camera to grid transformation is recorded along with the image
+    (`corners`) and grid (`object_points`) coordinates of every feature found,
+    which are used by :py:mod:`bundle_adjustment`. If an image folder is
+    given, the images the grid was found in are saved as `<point>.png` (or
+    `<point>_<camera>.png` with several cameras) and their names recorded as
+    `image`. With several cameras, each of these is a list with an entry for
+    each camera, with None where the grid was not found.
+
+    Args:
+        calibs (list of track_grid.GridLocation): The grid locator for each
+            camera
+        capture_journal (journal.Journal): The journal to record to
+        number (int): The number of the point the images were captured at
+        pose (6 member list): The tcp to robot pose when the images were
+            captured, in m
+        pose_skew (float): The timing skew of the pose
+        images (list of numpy.ndarray): The raw image from each camera
+        estimates (list of tuples): If given, rough (cam2robot, tcp2target)
+            transformations for each camera used to predict where the grid is
+            in the image
+        image_folder (str): If given, the folder to save the images in
+
+    Returns: The camera to grid transformation(s) recorded
+
+    Raises:
+        RuntimeError: Could not find a grid in any image, or an image could
+            not be written
+    """
+    estimates = estimates or [None] * len(calibs)
+    detections = []
+    for calib, image, estimate in zip(calibs, images, estimates):
+        try:
+            detections.append(detect_grid(calib, image, predict_roi(
+                calib, pose, estimate, image.shape)))
+        except RuntimeError:
+            if len(calibs) == 1:
+                raise
+            detections.append(None)
+    if all(detection is None for detection in detections):
+        raise RuntimeError('unable to find grid in any camera')
+
+    camera2grid = [None if detection is None else detection.pose
+                   for detection in detections]
+    corners = [None if detection is None else
+               detection.image_points.reshape(-1, 2).tolist()
+               for detection in detections]
+    object_points = [None if detection is None else
+                     detection.object_points.reshape(-1, 3).tolist()
+                     for detection in detections]
+    fields = {'camera2grid': camera2grid, 'corners': corners,
+              'object_points': object_points}
+    if image_folder is not None:
+        fields['image'] = []
+        for camera, (image, detection) in enumerate(zip(images, detections)):
+            if detection is None:
+                fields['image'].append(None)
+                continue
+            name = '{}.png'.format(number if len(calibs) == 1 else
+                                   '{}_{}'.format(number, camera))
+            if not cv2.imwrite(os.path.join(image_folder, name), image):
+                raise RuntimeError('unable to write image {}'.format(name))
+            fields['image'].append(name)
+    if len(calibs) == 1:
+        fields = dict((key, value[0]) for key, value in fields.items())
+    capture_journal.append(number, tcp2robot=tcp2robot_mm(pose),
+                           skew=pose_skew, **fields)
+    return fields['camera2grid']
+
+
+def capture_frames(calibs, after):
+    """Capture a raw frame from every camera.
+
+    Every camera acquires continuously, so the frames are the first exposed
+    by each camera after the given time.
+
+    Args:
+        calibs (list of track_grid.GridLocation): The grid locator for each
+            camera
+        after (float): Only use frames captured after this time
+
+    Returns: A list of camera.Frame, one per camera
+    """
+    return [calib.cam.capture_frame(after=after, rectify=False)
+            for calib in calibs]
+
+
+@contextlib.contextmanager
+def grid_locations(calibrations, rows, cols, spacing, cameras, target):
+    """Open a grid locator for each camera.
+
+    Args:
+        calibrations (list of str): The calibration file of each camera
+        rows (int): The number of rows on the grid
+        cols (int): The number of columns on the grid
+        spacing (float): The spacing of the grid
+        cameras (list of str): The name of each camera
+        target (targets.Target): The target to locate
+
+    Returns: A context manager giving a list of track_grid.GridLocation, which
+        are all closed on exit
+    """
+    calibs = []
+    try:
+        for cam_name, calibration in zip(cameras, calibrations):
+            calibs.append(ci.GridLocation(calibration, rows, cols, spacing,
+                                          cam_name, target=target))
+        yield calibs
+    finally:
+        for calib in calibs:
+            calib.__exit__()
+
+
+def detectable_points(calibs, points, numbers, estimates, max_angle=60,
+                      min_spacing=8, margin=10):
+    """Predict which points the grid can be found at, before moving there.
+
+    The grid's object points are projected through each camera's model at
+    the recorded pose of each point, using the rough transformations, and
+    checked with :py:func:`planning.skip_reasons`. A point is kept if any
+    camera would see all of the grid, not too obliquely and not too small.
+    Points without a recorded `cartesian` pose are kept.
+
+    Args:
+        calibs (list of track_grid.GridLocation): The grid locator for each
+            camera
+        points (dict): The points of the samples file, by number
+        numbers (list of int): The points to visit
+        estimates (list of tuples): Rough (cam2robot, tcp2target)
+            transformations for each camera, or Nones
+        max_angle (float): The most oblique (degrees) the grid may be seen at
+        min_spacing (float): The fewest pixels between neighbouring corners
+        margin (float): How far (pixels) every corner must be inside the
+            image
+
+    Returns: A tuple, (list of int, the points to visit, dict, why the grid
+        would not be found at each skipped point)
+    """
+    known = [number for number in numbers
+             if 'cartesian' in points[str(number)]]
+    if not known or any(estimate is None for estimate in estimates):
+        return numbers, {}
+    tcp2robot = np.array([tcp2robot_mm(points[str(number)]['cartesian'])
+                          for number in known])
+    reasons = []
+    for calib, estimate in zip(calibs, estimates):
+        height, width = calib.cam.capture_frame(
+            rectify=False).image.shape[:2]
+        shape = ((calib.target.cols, calib.target.rows)
+                 if isinstance(calib.target, targets.Chessboard) else None)
+        camera2grid = planning.predict_camera2grid(
+            np.concatenate(estimate), tcp2robot)
+        reasons.append(planning.skip_reasons(
+            *planning.grid_views(camera2grid, calib.object_point,
+                                 calib.intrinsic, calib.distortion,
+                                 (width, height), margin, shape),
+            max_angle=max_angle, min_spacing=min_spacing))
+
+    skipped = {}
+    for number, camera_reasons in zip(known, zip(*reasons)):
+        if all(reason is not None for reason in camera_reasons):
+            skipped[number] = ', '.join(
+                reason if len(calibs) == 1 else
+                '{} in camera {}'.format(reason, camera)
+                for camera, reason in enumerate(camera_reasons))
+    return [number for number in numbers if number not in skipped], skipped
+
+
+def tcp2robot_mm(pose):
+    """Convert a UR tcp pose from m to mm.
+
+    Args:
+        pose (6 member list): The pose, x,y,z (m), axis-angle
+
+    Returns: 6 member list, the pose, x,y,z (mm), axis-angle
+    """
+    return [x * 1000 for x in pose[:3]] + list(pose[3:])
+
+
+def predict_roi(calib, pose, estimate, image_shape):
+    """Predict the region of an image which the grid will be in.
+
+    Args:
+        calib (track_grid.GridLocation): The grid locator
+        pose (6 member list): The tcp to robot pose, in m
+        estimate (tuple): Rough (cam2robot, tcp2target) transformations, or
+            None
+        image_shape (tuple): The shape of the image
+
+    Returns: A tuple (x0, y0, x1, y1), or None to use the grid locator's own
+        tracking
+    """
+    if estimate is None:
+        return None
+    cam2robot, tcp2target = estimate
+    return calib.predict_roi(
+        ci.expected_cam2grid(cam2robot, tcp2robot_mm(pose), tcp2target),
+        image_shape)
+
+
+def detect_grid(calib, image, roi=None):
+    """Rectify an image and find the grid in it.
+
+    Safe to call from a worker thread, the result image is stored on the
+    GridLocation for display from the main thread.
+
+    Args:
+        calib (track_grid.GridLocation): The grid locator
+        image (numpy.ndarray): The raw image
+        roi (tuple): If given, the region of the image (x0, y0, x1, y1) to
+            search first
+
+    Returns: :py:class:`targets.Detection`, with the camera to grid
+        transformation as its pose
+
+    Raises:
+        RuntimeError: Could not find a grid
+    """
+    detection, calib.result_image = calib.find_target(
+        calib.cam.rectify(image), roi)
+    return detection
+
 
 if __name__ == '__main__':
     main()
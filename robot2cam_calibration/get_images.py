@@ -1,7 +1,7 @@
-"""A file to move a UR robot with a grid and save images and robot pose for
+"""A file to move a robot with a grid and save images and robot pose for
 future processing.
 
-todo: generalize this to any robot type
+The robot is driven through :py:mod:`robots`, a UR by default.
 """
 
 # The MIT License (MIT)
@@ -27,15 +27,16 @@ todo: generalize this to any robot type
 # SOFTWARE.
 
 import argparse
-import datetime
 import os
 
 import robot2cam_calibration.track_grid as ci
-import ur_cb2.cb2_robot as cb2_robot
+import robot2cam_calibration.synchronize as synchronize
+import robot2cam_calibration.sweep as sweep
+import robot2cam_calibration.pipeline as pipeline
+import robot2cam_calibration.journal as journal
+import robot2cam_calibration.robots as robots
 import json
-import time
 import numpy as np
-import camera
 import cv2
 
 
@@ -46,7 +47,7 @@ def main():
     """
     # Parse in arguments
     parser = argparse.ArgumentParser(
-        description="Get images from camera and poses from UR Robot")
+        description="Get images from camera and poses from a robot")
 
     parser.add_argument("--samples", type=str,
                         help='The filename for the file containing the list of'
@@ -61,6 +62,12 @@ def main():
                              "- `flycap`",
                         default="flycap")
 
+    parser.add_argument("--robot", type=str,
+                        help="The type of robot, see robots.py. `simulated` "
+                             "connects to robot2cam-simulate-robot.",
+                        choices=robots.ROBOTS,
+                        default="ur")
+
     parser.add_argument("--address", type=str,
                         help="The address of the robot in form: `###.###.###`",
                         required=True)
@@ -76,6 +83,31 @@ def main():
                         help="File to save output to",
                         default="correspondences.json")
 
+    parser.add_argument("--continuous", action='store_true',
+                        help="Sweep through the points without stopping, "
+                             "keeping the sharpest well synchronized frame "
+                             "near each point.")
+
+    parser.add_argument("--velocity", type=float,
+                        help="The joint velocity in rad/s to use when "
+                             "sweeping in continuous mode.",
+                        default=0.2)
+
+    parser.add_argument("--blend", type=float,
+                        help="How close (rad) the robot must get to a point "
+                             "before moving to the next in continuous mode.",
+                        default=0.02)
+
+    parser.add_argument("--workers", type=int,
+                        help="The number of threads writing images while the "
+                             "robot moves.",
+                        default=2)
+
+    parser.add_argument("--resume", action='store_true',
+                        help="Resume an interrupted capture, skipping the "
+                             "points already recorded in the journal which "
+                             "goes along with the output file.")
+
     args = parser.parse_args()
 
     get_images_poses(
@@ -84,14 +116,22 @@ def main():
         robot_address=args.address,
         robot_port=args.port,
         folder_out=args.out_folder,
-        file_out=args.out_file
+        file_out=args.out_file,
+        continuous=args.continuous,
+        velocity=args.velocity,
+        blend=args.blend,
+        workers=args.workers,
+        resume=args.resume,
+        robot_type=args.robot
     )
 
 
 def get_images_poses(robot_samples, cam_name,
-                     robot_address, robot_port, folder_out, file_out):
+                     robot_address, robot_port, folder_out, file_out,
+                     continuous=False, velocity=0.2, blend=0.02, workers=2,
+                     resume=False, robot_type='ur'):
     """
-    Gets images from a cam_name and and poses of a UR Robot.
+    Gets images from a cam_name and and poses of a robot.
     Relies on pre-trained points to direct robot motion. Generates a json file
     with the pose of the robot and filename of the corresponding image.
 
@@ -105,8 +145,24 @@ def get_images_poses(robot_samples, cam_name,
                         - `flycap`
         robot_address (str): The address of the robot in form: `###.###.###`
         robot_port (int): The port of the robot
-        folder_out (str): The folder in which to save the data.
+        folder_out (str): The folder in which to save the data. The image of
+                          each point is saved as `<point>.png`, so the names
+                          stay the same when a capture is resumed.
         file_out (str): The file in which to save all of the generated data.
+        continuous (bool): Whether to sweep through the points without
+                           stopping (see :py:func:`sweep.sweep`) rather than
+                           stopping at each point.
+        velocity (float): The joint velocity in rad/s for continuous mode
+        blend (float): How close (rad) the robot must get to a point before
+                       moving to the next in continuous mode
+        workers (int): The number of threads writing images while the robot
+                       moves on to the next point.
+        resume (bool): Whether to resume an interrupted capture. Every sample
+                       is recorded in a journal (`file_out` with a `.journal`
+                       extension, in `folder_out`) as soon as it is captured
+                       and points which are already in the journal are
+                       skipped.
+        robot_type (str): The type of robot, one of :py:data:`robots.ROBOTS`
     """
     with open(robot_samples, 'r') as f:
         data = json.load(f)
@@ -115,44 +171,99 @@ def get_images_poses(robot_samples, cam_name,
         print('read in {} points, written at: {}'.format(len(points.keys()),
                                                          write_time))
 
-    tcp2robot = []
-    im_num = 0
-
     if not os.path.isdir(folder_out):
         os.mkdir(folder_out)
+    journal_file = os.path.join(folder_out, journal.journal_name(file_out))
 
-    with cb2_robot.URRobot(robot_address, robot_port) as robot:
-        with camera.Camera(cam_name) as cam:
-            for number in sorted([int(x) for x in points.keys()]):
-                robot.add_goal(cb2_robot.Goal(points[str(number)]['joint'],
-                                              False, 'joint'))
-                # TODO: this appears to skip the first point!
-                robot.move_on_stop()
-                print('Beginning move: {}'.format(number))
+    import robot2cam_calibration.camera as camera
+    with journal.Journal(journal_file, resume=resume) as capture_journal:
+        with robots.create(robot_type, robot_address, robot_port) as robot:
+            with camera.Camera(cam_name) as cam:
+                with robot.pose_stream() as pose_stream:
+                    synchronizer = synchronize.Synchronizer(pose_stream)
+                    numbers = [number for number in
+                               sorted([int(x) for x in points.keys()])
+                               if number not in capture_journal.points]
+                    pending = []
+                    with pipeline.CapturePipeline(workers) as \
+                            capture_pipeline:
+                        if continuous:
+                            candidates = sweep.sweep(
+                                robot, cam, pose_stream,
+                                [points[str(number)]['joint']
+                                 for number in numbers],
+                                velocity=velocity, blend=blend)
+                            for number, candidate in zip(numbers,
+                                                         candidates):
+                                if candidate is None:
+                                    print('no usable frame for point: '
+                                          '{}'.format(number))
+                                    continue
+                                task = capture_pipeline.submit(
+                                    record_image, capture_journal, number,
+                                    candidate.pose, candidate.skew,
+                                    candidate.frame.image,
+                                    os.path.join(folder_out,
+                                                 '{}.png'.format(number)))
+                                pending.append((number, task))
+                        else:
+                            for number in numbers:
+                                print('Beginning move: {}'.format(number))
+                                stopped_time = robot.move_and_wait(
+                                    points[str(number)]['joint'])
+                                # Use an image exposed after the robot stopped
+                                # and the pose at the time of that image, no
+                                # need to wait for things to settle
+                                frame = cam.capture_frame(after=stopped_time,
+                                                          rectify=False)
+                                pose, pose_skew = synchronizer.pair(
+                                    frame.time)
+                                # The robot moves on while the image is written
+                                task = capture_pipeline.submit(
+                                    record_image, capture_journal, number,
+                                    pose, pose_skew, frame.image,
+                                    os.path.join(folder_out,
+                                                 '{}.png'.format(number)))
+                                pending.append((number, task))
+                            print('timing: {}'.format(
+                                synchronizer.skew_statistics()))
 
-                while not (robot.at_goal() and robot.is_stopped()):
-                    time.sleep(.25)
-                time.sleep(.25)  # let everything settle
+                    # A point whose image was not recorded is left out of the
+                    # output and is captured again by a resumed run
+                    for number, task in pending:
+                        try:
+                            task.result()
+                        except Exception as e:
+                            print("something went wrong at point {}: {}: "
+                                  "{}".format(number, type(e).__name__, e))
 
-                with robot.receiver.lock:
-                    tcp2robot.append(robot.receiver.position)
-                cv2.imwrite(os.path.join(folder_out, str(im_num) + '.png'),
-                            cam.capture_raw())
-
-                im_num += 1
-
-    print(np.asarray(tcp2robot))
+    json_dict = journal.compact(journal_file,
+                                os.path.join(folder_out, file_out))
+    print(np.asarray(json_dict['tcp2robot']))
     # `[x,y,z,<rotation vector>]` where `<rotation vector>` is a three element
     # vector representing the an axis about which to rotate (`<x,y,z>`) in
     # radians equal to the magnitude of the vector.
 
-    json_dict = {"time": str(datetime.datetime.now()),
-                 "tcp2robot": tcp2robot}
-    with open(
-            os.path.join(folder_out,
-                         os.path.splitext(file_out)[0] + '.json'), 'w') as \
-            result_json_file:
-        json.dump(json_dict, result_json_file, indent=4)
+
+def record_image(capture_journal, number, pose, pose_skew, image, file_name):
+    """Write an image and record the sample in the journal.
+
+    Args:
+        capture_journal (journal.Journal): The journal to record to
+        number (int): The number of the point the image was captured at
+        pose (6 member list): The tcp to robot pose when the image was
+            captured
+        pose_skew (float): The timing skew of the pose
+        image (numpy.ndarray): The raw image
+        file_name (str): The file to write the image to
+
+    Raises:
+        RuntimeError: The image could not be written
+    """
+    if not cv2.imwrite(file_name, image):
+        raise RuntimeError('unable to write image {}'.format(file_name))
+    capture_journal.append(number, tcp2robot=list(pose), skew=pose_skew,
+                           image=os.path.basename(file_name))
 
 if __name__ == '__main__':
     main()
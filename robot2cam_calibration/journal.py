@@ -0,0 +1,228 @@
+"""A file to record capture samples to disk as soon as they are captured.
+
+The journal is a line-delimited JSON file. The first line is a header holding
+the data which applies to the whole capture (grid, calibration file, etc.) and
+every following line is one sample, tagged with the number of the point it
+was captured at. Lines are flushed as they are written and fsync'ed in
+batches, so a crash or e-stop loses at most the last few samples. A capture
+can be resumed by skipping the points already in the journal, and the journal
+can be compacted into the standard correspondences file, ex::
+
+    {"type": "header", "grid": {...}, "calibration": "calibration.json"}
+    {"type": "sample", "point": 0, "tcp2robot": [...], "camera2grid": [...]}
+    {"type": "sample", "point": 1, "tcp2robot": [...], "camera2grid": [...]}
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import datetime
+import json
+import os
+import threading
+
+
+def journal_name(file_out):
+    """The name of the journal which goes along with an output file.
+
+    Args:
+        file_out (str): The name of the correspondence file
+
+    Returns: String, the name of the journal file
+    """
+    return os.path.splitext(file_out)[0] + '.journal'
+
+
+def read_journal(file_name):
+    """Read the header and samples from a journal.
+
+    A partially written final line (from a crash while writing) is ignored.
+
+    Args:
+        file_name (str): The journal file
+
+    Returns: A tuple, (dictionary of the header, list of sample dictionaries,
+        int, the length in bytes of the valid part of the file)
+
+    Raises:
+        ValueError: The journal is corrupt somewhere other than the last line
+    """
+    header = {}
+    samples = []
+    valid_length = 0
+    with open(file_name, 'rb') as journal_file:
+        lines = journal_file.readlines()
+    for number, line in enumerate(lines):
+        try:
+            if not line.endswith(b'\n'):
+                raise ValueError('incomplete line')
+            record = json.loads(line.decode('utf-8'))
+        except ValueError:
+            if number == len(lines) - 1:
+                print('ignoring partially written record at the end of '
+                      '{}'.format(file_name))
+                break
+            raise ValueError('journal {} is corrupt at line {}'.format(
+                file_name, number + 1))
+        valid_length += len(line)
+        if record.pop('type') == 'header':
+            header = record
+        else:
+            samples.append(record)
+    return header, samples, valid_length
+
+
+def compact(file_name, file_out):
+    """Compact a journal into a standard correspondences file.
+
+    Every sample field becomes a list in the output, ordered by point number.
+    If a point was recorded more than once, the latest sample is used.
+
+    Args:
+        file_name (str): The journal file
+        file_out (str): The file to write the correspondences to
+
+    Returns: The correspondences as a dictionary
+    """
+    header, samples, _ = read_journal(file_name)
+    by_point = {}
+    for sample in samples:
+        by_point[sample['point']] = sample
+    points = sorted(by_point.keys())
+
+    json_dict = dict(header)
+    json_dict['time'] = str(datetime.datetime.now())
+    fields = []
+    for sample in samples:
+        fields.extend(key for key in sample
+                      if key != 'point' and key not in fields)
+    for field in fields:
+        json_dict[field] = [by_point[point].get(field) for point in points]
+
+    with open(os.path.splitext(file_out)[0] + '.json', 'w') as \
+            result_json_file:
+        json.dump(json_dict, result_json_file, indent=4)
+    return json_dict
+
+
+class Journal(object):
+    """An append-only, crash-safe record of capture samples.
+
+    The Journal is thread safe and supports use by the with statement, ex::
+
+        with Journal('correspondences.journal', header) as journal:
+            journal.append(0, tcp2robot=pose, camera2grid=grid)
+
+    Attributes:
+        file_name: A string, the journal file
+        points: A set of the point numbers which have been recorded
+        sync_every: An int, the number of samples to write between fsyncs
+    """
+    def __init__(self, file_name, header=None, resume=False, sync_every=8):
+        """Open a journal for writing.
+
+        Args:
+            file_name (str): The journal file
+            header (dict): Data which applies to the whole capture. When
+                resuming an existing journal, it must match the header
+                already recorded.
+            resume (bool): Whether to continue an existing journal. If False,
+                any existing journal is replaced.
+            sync_every (int): The number of samples to write between fsyncs
+
+        Raises:
+            ValueError: The header does not match that of the journal being
+                resumed
+        """
+        self.file_name = file_name
+        self.sync_every = sync_every
+        self.points = set()
+        self.lock = threading.Lock()
+        self.__unsynced = 0
+
+        if resume and os.path.exists(file_name):
+            recorded, samples, valid_length = read_journal(file_name)
+            if header is not None:
+                # compared as they are stored, so tuples match lists
+                header = json.loads(json.dumps(header))
+                different = sorted(
+                    key for key in set(header) | set(recorded)
+                    if header.get(key) != recorded.get(key))
+                if different:
+                    raise ValueError(
+                        'cannot resume journal {}, this capture has '
+                        'different settings for: {}'.format(
+                            file_name, ', '.join(different)))
+            self.points = set(sample['point'] for sample in samples)
+            self.__file = open(file_name, 'r+b')
+            # drop any partially written record
+            self.__file.truncate(valid_length)
+            self.__file.seek(valid_length)
+            print('resuming journal with {} points recorded'.format(
+                len(self.points)))
+        else:
+            self.__file = open(file_name, 'wb')
+            record = dict(header or {})
+            record['type'] = 'header'
+            self.__write(record)
+            self.sync()
+
+    def __write(self, record):
+        """Write and flush a single record as one line."""
+        self.__file.write(json.dumps(record).encode('utf-8') + b'\n')
+        self.__file.flush()
+
+    def append(self, point, **fields):
+        """Record a sample.
+
+        Args:
+            point (int): The number of the point the sample was captured at
+            **fields: The sample data, each must be JSON serializable
+        """
+        record = dict(fields)
+        record['type'] = 'sample'
+        record['point'] = point
+        with self.lock:
+            self.__write(record)
+            self.points.add(point)
+            self.__unsynced += 1
+            if self.__unsynced >= self.sync_every:
+                self.sync()
+
+    def sync(self):
+        """Force everything written so far onto the disk."""
+        os.fsync(self.__file.fileno())
+        self.__unsynced = 0
+
+    def close(self):
+        """Sync and close the journal."""
+        with self.lock:
+            if not self.__file.closed:
+                self.sync()
+                self.__file.close()
+
+    def __enter__(self):
+        """Enters the journal from a with statement"""
+        return self
+
+    def __exit__(self, *_):
+        """Exits at the end of a context manager statement by closing."""
+        self.close()
@@ -0,0 +1,164 @@
+"""A file to convert a KUKA and EBT text log into correspondences.
+
+This replaces ``extract_for_calib.m`` and ``convert_kuka_points3.m`` (see
+``examples/KUKA_with_EBT/gather_data``). The tab separated log written by the
+original RSI_EBT_LOG.py holds, on each row, the EBT receipt time, the 19 EBT
+fields (see :py:data:`stream_recorder.EBT_FIELDS`), the KUKA data time and the
+KUKA X,Y,Z,A,B,C. The columns are loaded into arrays in one pass, the KUKA
+euler angles are converted to axis-angle and EBT meters to mm, and the two
+streams are paired by :py:func:`align_streams.align`, which keeps one
+correspondence for every stop of the robot.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import argparse
+import json
+import os
+
+import numpy as np
+
+import robot2cam_calibration.align_streams as align_streams
+from robot2cam_calibration.stream_recorder import EBT_FIELDS, KUKA_FIELDS
+
+# The columns of the text log
+EBT_TIME = 0
+EBT_COLUMNS = slice(1, 1 + len(EBT_FIELDS))
+KUKA_TIME = 1 + len(EBT_FIELDS)
+KUKA_COLUMNS = slice(KUKA_TIME + 1, KUKA_TIME + 1 + len(KUKA_FIELDS))
+
+
+def main():
+    """
+    Exposes :py:func:`convert` to the commandline. Run with arg `-h` for more
+    info.
+    """
+    parser = argparse.ArgumentParser(
+        description="Convert a KUKA and EBT text log into a correspondences "
+                    "file for robot2cam-compute")
+
+    parser.add_argument("--log", type=str,
+                        help="The tab separated log, ex: "
+                             "2016-5-31_15-38-12.txt",
+                        required=True)
+
+    parser.add_argument("--out", type=str,
+                        help="The correspondences file to write. Defaults "
+                             "to the log name with a .json extension.",
+                        default=None)
+
+    parser.add_argument("--offset", type=float,
+                        help="The KUKA clock minus the EBT clock in seconds. "
+                             "Both are stamped by the logging computer, so "
+                             "this is normally 0.",
+                        default=0.0)
+
+    parser.add_argument("--max_speed", type=float,
+                        help="The fastest the robot may move (mm/s) for a "
+                             "sample to be kept",
+                        default=1.0)
+
+    parser.add_argument("--max_angular_speed", type=float,
+                        help="The fastest the robot may rotate (rad/s) for a "
+                             "sample to be kept",
+                        default=0.005)
+
+    parser.add_argument("--min_still", type=float,
+                        help="The shortest stop (s) which makes a "
+                             "correspondence",
+                        default=0.5)
+
+    args = parser.parse_args()
+
+    convert(
+        log=args.log,
+        file_out=args.out,
+        offset=args.offset,
+        max_speed=args.max_speed,
+        max_angular_speed=args.max_angular_speed,
+        min_still=args.min_still
+    )
+
+
+def convert(log, file_out=None, offset=0.0, max_speed=1.0,
+            max_angular_speed=0.005, min_still=0.5):
+    """Convert a text log into a correspondences file.
+
+    Args:
+        log (str): The tab separated log
+        file_out (str): The correspondences file to write, None for the log
+                        name with a .json extension
+        offset (float): The KUKA clock minus the EBT clock in seconds
+        max_speed (float): The fastest the robot may move (mm/s) for a sample
+                           to be kept
+        max_angular_speed (float): The fastest the robot may rotate (rad/s)
+                                   for a sample to be kept
+        min_still (float): The shortest stop (s) which makes a
+                           correspondence
+
+    Returns: The correspondences as a dictionary
+    """
+    if file_out is None:
+        file_out = os.path.splitext(log)[0] + '.json'
+    ebt_times, ebt, kuka_times, kuka = read_text_log(log)
+    tracked, camera2grid = align_streams.ebt_poses(ebt)
+    _, tcp2robot = align_streams.kuka_poses(kuka)
+    print('read {} rows, tracking in {}'.format(len(ebt_times),
+                                               np.count_nonzero(tracked)))
+
+    # each row holds one sample of each stream, order each stream by time
+    ebt_order = np.argsort(ebt_times, kind='mergesort')
+    ebt_order = ebt_order[tracked[ebt_order]]
+    kuka_order = np.argsort(kuka_times, kind='mergesort')
+    correspondences = align_streams.align(
+        ebt_times[ebt_order], camera2grid[ebt_order],
+        kuka_times[kuka_order], tcp2robot[kuka_order], offset,
+        max_speed=max_speed, max_angular_speed=max_angular_speed,
+        min_still=min_still)
+
+    with open(file_out, 'w') as correspondences_file:
+        json.dump(correspondences, correspondences_file, indent=4)
+    print('{} correspondences written to {}'.format(
+        len(correspondences['tcp2robot']), file_out))
+    return correspondences
+
+
+def read_text_log(file_name):
+    """Load the columns of a text log.
+
+    Args:
+        file_name (str): The tab separated log, with one header row
+
+    Returns: A tuple, (n np.ndarray, the EBT times, nx19 np.ndarray, the EBT
+        fields, n np.ndarray, the KUKA times, nx6 np.ndarray, the KUKA
+        X,Y,Z,A,B,C)
+    """
+    # rows end in a tab, so only read the named columns
+    data = np.loadtxt(file_name, delimiter='\t', skiprows=1, ndmin=2,
+                      usecols=range(KUKA_COLUMNS.stop))
+    return (data[:, EBT_TIME], data[:, EBT_COLUMNS], data[:, KUKA_TIME],
+            data[:, KUKA_COLUMNS])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""A file to run capture post-processing concurrently with robot motion.
+
+Grid detection, pose estimation, image encoding and writing results to disk
+do not need the robot to hold still. A :py:class:`CapturePipeline` runs that
+work on worker threads (OpenCV releases the GIL, so these really do run in
+parallel) while the main thread commands the robot on to the next point. The
+queue of pending work is bounded, so if the workers fall behind, capture
+blocks until they catch up rather than buffering images without limit.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import threading
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+class Task(object):
+    """A unit of work submitted to a :py:class:`CapturePipeline`.
+
+    Attributes:
+        function: The callable to run
+        args: A tuple of positional arguments for the function
+        kwargs: A dictionary of keyword arguments for the function
+        value: The return value of the function, once it has run
+        error: The exception raised by the function, if any
+    """
+    def __init__(self, function, args, kwargs):
+        """Create a task.
+
+        Args:
+            function (callable): The callable to run
+            args (tuple): Positional arguments for the function
+            kwargs (dict): Keyword arguments for the function
+        """
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.error = None
+        self.__done = threading.Event()
+
+    def run(self):
+        """Run the function, storing its result or exception."""
+        try:
+            self.value = self.function(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        finally:
+            # release the (possibly large) arguments as soon as possible
+            self.args = self.kwargs = None
+            self.__done.set()
+
+    def done(self):
+        """Return whether the task has run
+
+        Returns: Boolean, whether the task has run
+        """
+        return self.__done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the task to run and return its result.
+
+        Args:
+            timeout (float): The maximum time to wait, or None to wait forever
+
+        Returns: The return value of the function
+
+        Raises:
+            RuntimeError: The task did not run before the timeout
+            Exception: Whatever the function raised
+        """
+        if not self.__done.wait(timeout):
+            raise RuntimeError('timed out waiting for task')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class CapturePipeline(object):
+    """A bounded pool of worker threads for capture post-processing.
+
+    The CapturePipeline supports use by the with statement, which waits for
+    all submitted work to finish on exit, ex::
+
+        with CapturePipeline(workers=2) as capture_pipeline:
+            task = capture_pipeline.submit(function, arg)
+            Move the robot...
+        task.result()
+
+    Attributes:
+        workers: An int, the number of worker threads. With zero workers,
+            tasks are run immediately in the submitting thread.
+        tasks: A queue.Queue of the pending tasks
+    """
+    def __init__(self, workers=2, max_pending=4):
+        """Start the worker threads.
+
+        Args:
+            workers (int): The number of worker threads
+            max_pending (int): The maximum number of tasks waiting for a
+                worker before :py:meth:`submit` blocks
+        """
+        self.workers = workers
+        self.tasks = queue.Queue(maxsize=max_pending)
+        self.__threads = []
+        for number in range(workers):
+            thread = threading.Thread(group=None,
+                                      target=self.work,
+                                      name='pipeline_thread_{}'.format(number),
+                                      args=(),
+                                      kwargs={})
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def submit(self, function, *args, **kwargs):
+        """Queue a function to run on a worker thread.
+
+        Blocks while the queue of pending work is full.
+
+        Args:
+            function (callable): The function to run
+            *args: Positional arguments for the function
+            **kwargs: Keyword arguments for the function
+
+        Returns: :py:class:`Task` which can be used to get the result
+        """
+        task = Task(function, args, kwargs)
+        if self.workers:
+            self.tasks.put(task)
+        else:
+            task.run()
+        return task
+
+    def work(self):
+        """Run tasks from the queue until a None task is received."""
+        while True:
+            task = self.tasks.get()
+            try:
+                if task is None:
+                    break
+                task.run()
+            finally:
+                self.tasks.task_done()
+
+    def join(self):
+        """Wait for all submitted tasks to run."""
+        self.tasks.join()
+
+    def close(self):
+        """Wait for all submitted tasks to run and stop the workers."""
+        for _ in self.__threads:
+            self.tasks.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+    def __enter__(self):
+        """Enters the pipeline from a with statement"""
+        return self
+
+    def __exit__(self, *_):
+        """Exits at the end of a context manager statement by closing."""
+        self.close()
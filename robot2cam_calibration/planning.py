@@ -0,0 +1,595 @@
+"""A file to plan which poses to capture correspondences at and in what order.
+
+Recording visits every point of a samples file, and many of the points add
+little to the calibration. Given a rough camera to robot estimate, the grid
+is predicted at every candidate point. Points where it would be out of view,
+too oblique or too small to detect are dropped. From the rest, the points
+are chosen greedily by how much each shrinks the predicted covariance of the
+transformations (D-optimal design): each adds the information of its
+predicted camera to grid measurement, J'J for the Jacobian J of
+:py:func:`compute_transformations.pose_residuals` scaled by the measurement
+noise. Points are added until every transformation parameter is predicted
+to be nearly as well known as with every usable candidate. The chosen
+points are then ordered to shorten the joint space travel between them,
+nearest neighbour first and then improved by 2-opt.
+
+The plan is written as a samples file for ``robot2cam-record-ur``.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import argparse
+import datetime
+import json
+
+import numpy as np
+
+import robot2cam_calibration.bundle_adjustment as bundle_adjustment
+import robot2cam_calibration.calibrations as calibrations
+import robot2cam_calibration.compute_transformations as compute
+import robot2cam_calibration.rotations as rotations
+import robot2cam_calibration.uncertainty as uncertainty
+
+# The reasons a candidate can not be used
+SKIP_REASONS = ['behind the camera', 'out of view', 'too oblique', 'too small']
+
+
+def main():
+    """
+    Exposes :py:func:`plan_poses` to the commandline. Run with arg `-h` for
+    more info.
+    """
+    parser = argparse.ArgumentParser(
+        description="Choose and order the points to record correspondences "
+                    "at")
+
+    parser.add_argument("--samples", type=str,
+                        help="The candidate points, a samples file as read "
+                             "by robot2cam-record-ur. Defaults to: "
+                             "cb2points.json",
+                        default="cb2points.json")
+
+    parser.add_argument("--transformation", type=str,
+                        help="A rough calibration of the camera, as written "
+                             "by robot2cam-compute",
+                        required=True)
+
+    parser.add_argument("--calibration", type=str,
+                        help="The camera calibration file. Defaults to: "
+                             "calibration.json",
+                        default="calibration.json")
+
+    parser.add_argument("-s", "--spacing", type=float,
+                        help="The grid spacing in mm.", required=True)
+
+    parser.add_argument("-c", "--columns", type=int,
+                        help="the number of inner corners horizontally",
+                        required=True)
+
+    parser.add_argument("-r", "--rows", type=int,
+                        help="the number of inner corners vertically",
+                        required=True)
+
+    parser.add_argument("--correspondences", type=str,
+                        help="Correspondences already recorded, whose "
+                             "information the plan adds to",
+                        default=None)
+
+    parser.add_argument("--out", type=str,
+                        help="The samples file to write the plan to",
+                        default="planned_points.json")
+
+    parser.add_argument("--count", type=int,
+                        help="Choose this many points instead of stopping "
+                             "at the tolerance",
+                        default=None)
+
+    parser.add_argument("--tolerance", type=float,
+                        help="Stop adding points when the predicted standard "
+                             "deviation of every parameter is within this "
+                             "fraction of that of using every usable point",
+                        default=0.2)
+
+    parser.add_argument("--max_angle", type=float,
+                        help="The most oblique (degrees) the grid may be "
+                             "seen at",
+                        default=60)
+
+    parser.add_argument("--min_spacing", type=float,
+                        help="The fewest pixels between neighbouring "
+                             "corners for the grid to be detected",
+                        default=8)
+
+    parser.add_argument("--margin", type=float,
+                        help="How far (pixels) every corner must be inside "
+                             "the image",
+                        default=10)
+
+    parser.add_argument("--image_size", type=int, nargs=2,
+                        help="The image width and height. Defaults to twice "
+                             "the principal point.",
+                        metavar=('width', 'height'),
+                        default=None)
+
+    parser.add_argument("--position_noise", type=float,
+                        help="The standard deviation (mm) of a measured grid "
+                             "position",
+                        default=1.0)
+
+    parser.add_argument("--rotation_noise", type=float,
+                        help="The standard deviation (rad) of a measured "
+                             "grid rotation",
+                        default=0.005)
+
+    parser.add_argument("--joint_velocity", type=float,
+                        help="The joint velocity (rad/s) to estimate travel "
+                             "times with",
+                        default=1.0)
+
+    args = parser.parse_args()
+
+    plan_poses(
+        robot_samples=args.samples,
+        transformation=args.transformation,
+        calibration=args.calibration,
+        rows=args.rows,
+        cols=args.columns,
+        spacing=args.spacing,
+        file_out=args.out,
+        correspondences=args.correspondences,
+        count=args.count,
+        tolerance=args.tolerance,
+        max_angle=args.max_angle,
+        min_spacing=args.min_spacing,
+        margin=args.margin,
+        image_size=args.image_size,
+        position_noise=args.position_noise,
+        rotation_noise=args.rotation_noise,
+        joint_velocity=args.joint_velocity
+    )
+
+
+def plan_poses(robot_samples, transformation, calibration, rows, cols,
+               spacing, file_out, correspondences=None, count=None,
+               tolerance=0.2, max_angle=60, min_spacing=8, margin=10,
+               image_size=None, position_noise=1.0, rotation_noise=0.005,
+               joint_velocity=1.0):
+    """Choose and order the points to record correspondences at.
+
+    Args:
+        robot_samples (str): The candidate points, a samples file with the
+                             `joint` and `cartesian` (m, axis-angle) pose of
+                             each point
+        transformation (str): A rough calibration, as written by
+                              robot2cam-compute
+        calibration (str): The camera calibration file
+        rows (int): The number of inner corners vertically
+        cols (int): The number of inner corners horizontally
+        spacing (float): The grid spacing in mm
+        file_out (str): The samples file to write the plan to
+        correspondences (str): Correspondences already recorded, whose
+                               information the plan adds to, or None
+        count (int): Choose this many points instead of stopping at the
+                     tolerance, or None
+        tolerance (float): Stop adding points when the predicted standard
+                           deviation of every parameter is within this
+                           fraction of that of using every usable point
+        max_angle (float): The most oblique (degrees) the grid may be seen at
+        min_spacing (float): The fewest pixels between neighbouring corners
+        margin (float): How far (pixels) every corner must be inside the
+                        image
+        image_size (tuple): The image width and height, None for twice the
+                            principal point
+        position_noise (float): The standard deviation (mm) of a measured
+                                grid position
+        rotation_noise (float): The standard deviation (rad) of a measured
+                                grid rotation
+        joint_velocity (float): The joint velocity (rad/s) to estimate
+                                travel times with
+
+    Returns: The plan as a dictionary, the samples file written
+
+    Raises:
+        ValueError: The transformation is of several cameras, or no
+            candidate is usable
+    """
+    with open(robot_samples, 'r') as samples_file:
+        points = json.load(samples_file)['points']
+    numbers = sorted(points, key=int)
+    joints = np.array([points[number]['joint'] for number in numbers])
+    tcp2robot = np.array([points[number]['cartesian'] for number in numbers])
+    tcp2robot[:, :3] *= 1000
+
+    with open(transformation, 'r') as transformation_file:
+        solution_dictionary = json.load(transformation_file)
+    if isinstance(solution_dictionary['cam2robot'], list):
+        raise ValueError('planning is only supported for one camera')
+    solution = uncertainty.solution_parameters(solution_dictionary)
+
+    calibration = calibrations.load(calibration)
+    intrinsic = calibration.intrinsic
+    distortion = calibration.distortion
+    if image_size is None:
+        image_size = 2 * intrinsic[:2, 2]
+
+    object_points = calibrations.chessboard_points(rows, cols, spacing)
+
+    camera2grid = predict_camera2grid(solution, tcp2robot)
+    reasons = skip_reasons(*grid_views(
+        camera2grid, object_points, intrinsic, distortion, image_size,
+        margin, (cols, rows)), max_angle=max_angle, min_spacing=min_spacing)
+    usable = np.array([reason is None for reason in reasons])
+    if not usable.any():
+        raise ValueError('none of the {} points would see the grid'.format(
+            len(numbers)))
+    for reason in SKIP_REASONS:
+        skipped = [number for number, why in zip(numbers, reasons)
+                   if why == reason]
+        if skipped:
+            print('skipping {} points, {}: {}'.format(
+                len(skipped), reason, ', '.join(skipped)))
+
+    prior = np.zeros((len(solution), len(solution)))
+    if correspondences is not None:
+        with open(correspondences, 'r') as correspondences_file:
+            recorded = np.asarray(json.load(correspondences_file)[
+                'tcp2robot'], dtype=float)
+        recorded_jacobians = pose_jacobians(
+            solution, recorded, predict_camera2grid(solution, recorded),
+            position_noise, rotation_noise)
+        prior = np.einsum('nji,njk->ik', recorded_jacobians,
+                          recorded_jacobians)
+
+    jacobians = pose_jacobians(solution, tcp2robot[usable],
+                               camera2grid[usable], position_noise,
+                               rotation_noise)
+    chosen, deviation, best_deviation = choose_poses(
+        jacobians, prior, count, tolerance)
+    chosen = np.flatnonzero(usable)[chosen]
+
+    times = travel_times(joints[chosen], joint_velocity)
+    order = order_poses(times)
+    chosen = chosen[order]
+    travel = path_time(order, times)
+    original = path_time(np.arange(len(numbers)),
+                         travel_times(joints, joint_velocity))
+    print('chose {} of {} points ({} usable), travel {:.1f} s instead of '
+          '{:.1f} s'.format(len(chosen), len(numbers),
+                            np.count_nonzero(usable), travel, original))
+    print('predicted standard deviation, x,y,z (mm), rotation (rad):')
+    for name, values, best in (
+            ('cam2robot', deviation[:6], best_deviation[:6]),
+            ('tcp2target', deviation[6:], best_deviation[6:])):
+        print('    {}: {} (every usable point: {})'.format(
+            name, np.round(values, 4).tolist(),
+            np.round(best, 4).tolist()))
+
+    json_dict = {
+        "time": str(datetime.datetime.now()),
+        "points": dict(
+            (str(index), {"joint": points[numbers[candidate]]['joint'],
+                          "cartesian": points[numbers[candidate]][
+                              'cartesian'],
+                          "source": numbers[candidate]})
+            for index, candidate in enumerate(chosen)),
+        "plan": {"samples": robot_samples,
+                 "transformation": transformation,
+                 "candidates": len(numbers),
+                 "usable": int(np.count_nonzero(usable)),
+                 "skipped": dict(
+                     (number, reason) for number, reason in
+                     zip(numbers, reasons) if reason is not None),
+                 "predicted std": deviation.tolist(),
+                 "usable std": best_deviation.tolist(),
+                 "travel time": travel,
+                 "original travel time": original}
+    }
+    with open(file_out, 'w') as plan_file:
+        json.dump(json_dict, plan_file, indent=4)
+    print('wrote the plan to {}'.format(file_out))
+    return json_dict
+
+
+def predict_camera2grid(solution, tcp2robot):
+    """Predict the camera to grid transformation at robot poses.
+
+    Args:
+        solution (12 element array): The camera to robot and tcp to target
+                                     transformations, x,y,z,axis-angle
+        tcp2robot (nx6 array): The robot poses, x,y,z (mm), axis-angle
+
+    Returns: nx6 np.ndarray, the camera to grid transformations
+    """
+    return rotations.mat2pose(np.matmul(np.matmul(
+        rotations.pose2mat(solution[:6]), rotations.pose2mat(tcp2robot)),
+        rotations.pose2mat(solution[6:])))
+
+
+def grid_views(camera2grid, object_points, intrinsic, distortion,
+               image_size, margin=0, shape=None):
+    """Predict how the camera would see the grid at each pose.
+
+    Args:
+        camera2grid (nx6 array): The camera to grid transformations
+        object_points (kx3 array): The corners in grid coordinates
+        intrinsic (3x3 array): The camera intrinsic matrix
+        distortion (array): The camera distortion
+        image_size (tuple): The image width and height
+        margin (float): How far (pixels) a corner must be inside the image
+                        to count as in view
+        shape (tuple): How the corners are laid out, the object points
+                       reshaped to this are neighbours along each axis (the
+                       columns and rows of a chessboard). None to only
+                       measure the spacing of the first two corners.
+
+    Returns: A tuple, (n np.ndarray of bool, whether the grid is in front of
+        the camera, n np.ndarray, the fraction of corners in view, n
+        np.ndarray, the angle (rad) between the grid normal and the line of
+        sight to its center, n np.ndarray, the smallest distance (pixels)
+        between neighbouring corners)
+    """
+    grids = rotations.pose2mat(camera2grid)
+    object_points = np.asarray(object_points, dtype=float)
+    # every corner in camera coordinates, n x k x 3
+    points = (np.matmul(grids[:, None, :3, :3], object_points[:, :, None])
+              [..., 0] + grids[:, None, :3, 3])
+    in_front = np.all(points[..., 2] > 0, axis=1)
+
+    intrinsics = bundle_adjustment.intrinsic_vector(intrinsic, distortion)
+    depth = np.where(points[..., 2] > 0, points[..., 2], np.nan)
+    image_points = bundle_adjustment.project(
+        np.concatenate((points[..., :2], depth[..., None]),
+                       axis=-1).reshape(-1, 3),
+        np.tile(intrinsics, (points[..., 0].size, 1))).reshape(
+            points.shape[:2] + (2,))
+    with np.errstate(invalid='ignore'):
+        inside = np.all((image_points >= margin) &
+                        (image_points <= np.asarray(image_size) - margin),
+                        axis=-1)
+    in_view = inside.mean(axis=1)
+
+    center = points.mean(axis=1)
+    normal = grids[:, :3, 2]
+    cos_angle = np.abs(np.sum(normal * center, axis=1)) / np.linalg.norm(
+        center, axis=1)
+    angle = np.arccos(np.clip(cos_angle, 0, 1))
+
+    if shape is None:
+        shape = (2, 1)
+    grid_image = image_points[:, :np.prod(shape)].reshape(
+        (len(points),) + tuple(shape) + (2,))
+    steps = [np.linalg.norm(np.diff(grid_image, axis=axis), axis=-1)
+             .reshape(len(points), -1)
+             for axis in range(1, len(shape) + 1)
+             if grid_image.shape[axis] > 1]
+    with np.errstate(invalid='ignore'):
+        spacing = np.min(np.concatenate(steps, axis=1), axis=1)
+    return in_front, in_view, angle, np.nan_to_num(spacing)
+
+
+def skip_reasons(in_front, in_view, angle, spacing, max_angle=60,
+                 min_spacing=8, min_in_view=1.0):
+    """Decide which poses can not be used, and why.
+
+    Args:
+        in_front (n array): Whether the grid is in front of the camera
+        in_view (n array): The fraction of corners in view
+        angle (n array): The angle (rad) the grid is seen at
+        spacing (n array): The smallest distance (pixels) between
+                           neighbouring corners
+        max_angle (float): The most oblique (degrees) the grid may be seen at
+        min_spacing (float): The fewest pixels between neighbouring corners
+        min_in_view (float): The smallest fraction of corners which must be
+                             in view
+
+    Returns: list, the first of :py:data:`SKIP_REASONS` which applies to each
+        pose, or None for a usable pose
+    """
+    reasons = []
+    for front, view, oblique, space in zip(in_front, in_view, angle,
+                                           spacing):
+        if not front:
+            reasons.append(SKIP_REASONS[0])
+        elif view < min_in_view:
+            reasons.append(SKIP_REASONS[1])
+        elif np.degrees(oblique) > max_angle:
+            reasons.append(SKIP_REASONS[2])
+        elif space < min_spacing:
+            reasons.append(SKIP_REASONS[3])
+        else:
+            reasons.append(None)
+    return reasons
+
+
+def pose_jacobians(solution, tcp2robot, camera2grid, position_noise=1.0,
+                   rotation_noise=0.005, step=1e-6):
+    """The noise weighted Jacobian of the residuals of each pose.
+
+    Args:
+        solution (12 element array): The camera to robot and tcp to target
+                                     transformations
+        tcp2robot (nx6 array): The robot poses
+        camera2grid (nx6 array): The camera to grid transformations
+        position_noise (float): The standard deviation (mm) of a measured
+                                grid position
+        rotation_noise (float): The standard deviation (rad) of a measured
+                                grid rotation
+        step (float): The central difference step
+
+    Returns: nx6x12 np.ndarray, the Jacobian of the residuals of each pose
+        with respect to changes of the transformations (see
+        :py:func:`uncertainty.perturb`), in units of the noise
+    """
+    size = len(solution)
+    camera_index = np.zeros(len(tcp2robot), dtype=int)
+    jacobians = np.empty((len(tcp2robot), 6, size))
+    for column in range(size):
+        delta = np.zeros(size)
+        delta[column] = step
+        jacobians[..., column] = (
+            compute.pose_residuals(uncertainty.perturb(solution, delta),
+                                   tcp2robot, camera2grid, camera_index,
+                                   0.5) -
+            compute.pose_residuals(uncertainty.perturb(solution, -delta),
+                                   tcp2robot, camera2grid, camera_index,
+                                   0.5)).reshape(-1, 6) / (2 * step)
+    # pose_residuals halves both errors with a ratio of 0.5
+    noise = 0.5 * np.repeat([position_noise, rotation_noise], 3)
+    return jacobians / noise[:, None]
+
+
+def choose_poses(jacobians, prior=None, count=None, tolerance=0.2,
+                 minimum=3):
+    """Greedily choose the poses which most increase the information.
+
+    Each step adds the pose which most increases the determinant of the
+    information matrix, which is the pose that most shrinks the volume of
+    the predicted covariance.
+
+    Args:
+        jacobians (nx6xm array): The noise weighted Jacobian of each pose,
+                                 see :py:func:`pose_jacobians`
+        prior (mxm array): The information already known, None for none
+        count (int): Choose this many poses, None to stop at the tolerance
+        tolerance (float): Stop when the predicted standard deviation of
+                           every parameter is within this fraction of that
+                           of using every pose
+        minimum (int): The fewest poses to choose
+
+    Returns: A tuple, (np.ndarray, the chosen poses in the order chosen, m
+        np.ndarray, the predicted standard deviation of each parameter, m
+        np.ndarray, that of using every pose)
+    """
+    size = jacobians.shape[2]
+    if prior is None:
+        prior = np.zeros((size, size))
+    # a little information about every parameter keeps the first steps
+    # well posed
+    information = prior + 1e-9 * np.eye(size)
+    every = information + np.einsum('nji,njk->ik', jacobians, jacobians)
+    best = np.sqrt(np.diag(np.linalg.inv(every)))
+    if count is None:
+        count = len(jacobians)
+    count = min(count, len(jacobians))
+
+    chosen = []
+    available = np.ones(len(jacobians), dtype=bool)
+    deviation = np.sqrt(np.diag(np.linalg.inv(information)))
+    while len(chosen) < count:
+        if (len(chosen) >= minimum and
+                np.all(deviation <= (1 + tolerance) * best)):
+            break
+        # det(M + J'J) / det(M) = det(I + J inv(M) J')
+        inverse = np.linalg.inv(information)
+        candidates = jacobians[available]
+        gains = np.linalg.slogdet(
+            np.eye(6) + np.matmul(np.matmul(candidates, inverse),
+                                  np.swapaxes(candidates, 1, 2)))[1]
+        pick = np.flatnonzero(available)[np.argmax(gains)]
+        chosen.append(pick)
+        available[pick] = False
+        information = information + np.dot(jacobians[pick].T,
+                                           jacobians[pick])
+        deviation = np.sqrt(np.diag(np.linalg.inv(information)))
+    return np.array(chosen, dtype=int), deviation, best
+
+
+def travel_times(joints, velocity=1.0):
+    """Estimate the time to move between every pair of joint positions.
+
+    The joints move together and arrive together, so a move takes as long as
+    its largest joint motion.
+
+    Args:
+        joints (nx6 array): The joint positions (rad)
+        velocity (float): The joint velocity (rad/s)
+
+    Returns: nxn np.ndarray, the travel time (s) between each pair
+    """
+    joints = np.asarray(joints, dtype=float)
+    return np.abs(joints[:, None] - joints[None]).max(axis=-1) / velocity
+
+
+def path_time(order, times):
+    """The time to visit poses in an order.
+
+    Args:
+        order (n array): The poses in the order they are visited
+        times (nxn array): The travel time between each pair
+
+    Returns: float, the total travel time
+    """
+    order = np.asarray(order, dtype=int)
+    return float(np.sum(times[order[:-1], order[1:]]))
+
+
+def order_poses(times):
+    """Order poses to shorten the travel between them.
+
+    A nearest neighbour path is built from every starting pose and the
+    shortest is improved by reversing stretches of it while that helps
+    (2-opt).
+
+    Args:
+        times (nxn array): The travel time between each pair of poses
+
+    Returns: n np.ndarray, the poses in the order to visit them
+    """
+    count = len(times)
+    if count < 3:
+        return np.arange(count)
+    best = None
+    for start in range(count):
+        order = [start]
+        remaining = np.ones(count, dtype=bool)
+        remaining[start] = False
+        while remaining.any():
+            candidates = np.flatnonzero(remaining)
+            order.append(candidates[np.argmin(times[order[-1], candidates])])
+            remaining[order[-1]] = False
+        if best is None or path_time(order, times) < path_time(best, times):
+            best = order
+    order = list(best)
+
+    improved = True
+    while improved:
+        improved = False
+        for first in range(count - 1):
+            for last in range(first + 1, count):
+                # the path is open, so the ends have no outside neighbour
+                before = times[order[first - 1], order[first]] \
+                    if first > 0 else 0
+                after = times[order[last], order[last + 1]] \
+                    if last < count - 1 else 0
+                new_before = times[order[first - 1], order[last]] \
+                    if first > 0 else 0
+                new_after = times[order[first], order[last + 1]] \
+                    if last < count - 1 else 0
+                if new_before + new_after < before + after - 1e-12:
+                    order[first:last + 1] = order[first:last + 1][::-1]
+                    improved = True
+    return np.array(order, dtype=int)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,719 @@
+"""A file with a common interface to the robots used for capturing.
+
+The capture routines (:py:mod:`get_correspondences`, :py:mod:`get_images` and
+:py:mod:`sweep`) only need to send a robot to joint positions, know when it
+has arrived and stopped, and read its tool pose and joint positions.
+:py:class:`Robot` is that interface and it is implemented for:
+
+- `ur`: Universal Robots CB2 controllers, through the ur_cb2 package
+- `kuka`: KUKA controllers through the KUKA-RSI interface. The motion is run
+  by the program on the controller, so a move only sets the goal which is
+  waited for.
+- `simulated`: A :py:class:`SimulatedRobotServer`, a UR5 simulated on a local
+  socket with a configurable latency, so that capture can be run and timed
+  without hardware, ex::
+
+    robot2cam-simulate-robot --port 30003 --latency 0.005
+
+Poses follow the UR convention: x,y,z in m and an axis-angle rotation. Joint
+positions are in radians.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import argparse
+import collections
+import json
+import select
+import socket
+import threading
+import time
+
+import numpy as np
+
+import robot2cam_calibration.rotations as rotations
+import robot2cam_calibration.synchronize as synchronize
+from robot2cam_calibration.stream_recorder import Stream
+
+ROBOTS = ['ur', 'kuka', 'simulated']
+
+# Denavit-Hartenberg parameters of a UR5 (m, rad)
+UR5_D = np.array([0.089159, 0, 0, 0.10915, 0.09465, 0.0823])
+UR5_A = np.array([0, -0.425, -0.39225, 0, 0, 0])
+UR5_ALPHA = np.array([np.pi / 2, 0, 0, np.pi / 2, -np.pi / 2, 0])
+
+# A reachable joint position of the simulated robot to start from
+HOME = [0, -np.pi / 2, np.pi / 2, -np.pi / 2, -np.pi / 2, 0]
+
+RobotState = collections.namedtuple('RobotState', ['time', 'joints', 'pose'])
+
+
+def main():
+    """
+    Runs a :py:class:`SimulatedRobotServer` from the commandline. Run with
+    arg `-h` for more info.
+    """
+    parser = argparse.ArgumentParser(
+        description="Simulate a robot on a local socket, for running and "
+                    "timing capture without hardware (--robot simulated)")
+
+    parser.add_argument("--port", type=int,
+                        help="The port to serve on", default=30003)
+
+    parser.add_argument("--latency", type=float,
+                        help="The delay (s) of every state and command",
+                        default=0.0)
+
+    parser.add_argument("--period", type=float,
+                        help="The period (s) at which the state is sent",
+                        default=0.008)
+
+    args = parser.parse_args()
+
+    with SimulatedRobotServer(args.port, args.latency, args.period) as server:
+        print('simulating a robot on port {}, ctrl-c to stop'.format(
+            server.address[1]))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print('stopping')
+
+
+def create(name, address, port):
+    """Connect to a robot by type.
+
+    Args:
+        name (str): One of :py:data:`ROBOTS`
+        address (str): The address of the robot (or its interface)
+        port (int): The port of the robot
+
+    Returns: :py:class:`Robot`
+
+    Raises:
+        ValueError: The robot type is unknown
+    """
+    if name == 'ur':
+        return URRobot(address, port)
+    elif name == 'kuka':
+        return KukaRSIRobot(address, port)
+    elif name == 'simulated':
+        return SimulatedRobot(address, port)
+    raise ValueError('unknown robot {}, valid options are: {}'.format(
+        name, ', '.join(ROBOTS)))
+
+
+def ur5_forward_kinematics(joints):
+    """The tool pose of a UR5 at joint positions.
+
+    Args:
+        joints (...x6 array): The joint positions (rad)
+
+    Returns: ...x6 np.ndarray of tool poses, x,y,z (m), axis-angle
+    """
+    theta = np.asarray(joints, dtype=float)
+    cos, sin = np.cos(theta), np.sin(theta)
+    cos_alpha, sin_alpha = np.cos(UR5_ALPHA), np.sin(UR5_ALPHA)
+    links = np.zeros(theta.shape + (4, 4))
+    links[..., 0, 0] = cos
+    links[..., 0, 1] = -sin * cos_alpha
+    links[..., 0, 2] = sin * sin_alpha
+    links[..., 0, 3] = UR5_A * cos
+    links[..., 1, 0] = sin
+    links[..., 1, 1] = cos * cos_alpha
+    links[..., 1, 2] = -cos * sin_alpha
+    links[..., 1, 3] = UR5_A * sin
+    links[..., 2, 1] = sin_alpha
+    links[..., 2, 2] = cos_alpha
+    links[..., 2, 3] = UR5_D
+    links[..., 3, 3] = 1
+    tool = links[..., 0, :, :]
+    for joint in range(1, 6):
+        tool = np.matmul(tool, links[..., joint, :, :])
+    return rotations.mat2pose(tool)
+
+
+class Robot(object):
+    """The interface to a robot for capturing.
+
+    Subclasses implement :py:meth:`move_to_joint`, :py:meth:`at_goal`,
+    :py:meth:`is_stopped`, :py:meth:`pose`, :py:meth:`joints` and
+    :py:meth:`close`. Robots
+    support use by the with statement.
+    """
+    def move_to_joint(self, joints, velocity=None, blend=None):
+        """Start moving to a joint position.
+
+        If the robot is already moving to a goal, this first waits for it to
+        stop there, or with a blend, for it to come within the blend of it,
+        so that successive calls queue moves up.
+
+        Args:
+            joints (6 member list): The joint positions to move to (rad)
+            velocity (float): The joint velocity (rad/s), None for the
+                robot's default
+            blend (float): How close (rad) to the current goal the robot
+                must be before moving on, None to wait for it to stop
+        """
+        raise NotImplementedError()
+
+    def at_goal(self):
+        """Whether the robot is at the goal of its latest move.
+
+        Returns: bool
+        """
+        raise NotImplementedError()
+
+    def is_stopped(self):
+        """Whether the robot is stopped.
+
+        Returns: bool
+        """
+        raise NotImplementedError()
+
+    def pose(self):
+        """The latest tool pose.
+
+        Returns: 6 member list, the tcp to robot pose, x,y,z (m), axis-angle
+        """
+        raise NotImplementedError()
+
+    def joints(self):
+        """The latest joint positions.
+
+        Returns: 6 member list, the joint positions (rad)
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """Disconnect from the robot."""
+        raise NotImplementedError()
+
+    def move_and_wait(self, joints, velocity=None, poll=0.01):
+        """Move to a joint position and wait for the robot to stop there.
+
+        Args:
+            joints (6 member list): The joint positions to move to (rad)
+            velocity (float): The joint velocity (rad/s), None for the
+                robot's default
+            poll (float): How often (s) to check whether the robot arrived
+
+        Returns: Float, the time (see :py:data:`synchronize.clock`) at which
+            the robot was found to be stopped at the goal. Images exposed
+            after this time can be used.
+        """
+        self.move_to_joint(joints, velocity)
+        while not (self.at_goal() and self.is_stopped()):
+            time.sleep(poll)
+        return synchronize.clock()
+
+    def pose_stream(self, **kwargs):
+        """Start recording the robot's poses.
+
+        Args:
+            **kwargs: Passed on to :py:class:`synchronize.PoseStream`
+
+        Returns: :py:class:`synchronize.PoseStream`
+        """
+        return synchronize.PoseStream(self.pose, **kwargs)
+
+    def joint_stream(self, **kwargs):
+        """Start recording the robot's joint positions.
+
+        Args:
+            **kwargs: Passed on to :py:class:`synchronize.PoseStream`
+
+        Returns: :py:class:`synchronize.PoseStream` of the joint positions
+        """
+        return synchronize.PoseStream(
+            self.joints, interpolate=synchronize.interpolate_joints, **kwargs)
+
+    def __enter__(self):
+        """Enters the robot from a with statement"""
+        return self
+
+    def __exit__(self, *_):
+        """Exits at the end of a context manager statement by closing."""
+        self.close()
+
+
+class URRobot(Robot):
+    """A Universal Robots CB2 robot, driven through the ur_cb2 package.
+
+    Attributes:
+        robot: The ur_cb2.cb2_robot.URRobot
+    """
+    def __init__(self, address, port=30003):
+        """Connect to the robot.
+
+        Args:
+            address (str): The address of the robot in form: `###.###.###`
+            port (int): The port of the robot
+
+        Raises:
+            ImportError: The ur_cb2 package is not installed
+        """
+        try:
+            import ur_cb2.cb2_robot as cb2_robot
+        except ImportError:
+            raise ImportError('UR robots require the ur_cb2 package')
+        self.__cb2_robot = cb2_robot
+        self.robot = cb2_robot.URRobot(address, port)
+
+    def move_to_joint(self, joints, velocity=None, blend=None):
+        """See :py:meth:`Robot.move_to_joint`"""
+        options = {} if velocity is None else {'velocity': velocity}
+        self.robot.add_goal(self.__cb2_robot.Goal(joints, False, 'joint',
+                                                  **options))
+        if blend is None:
+            # TODO: this appears to skip the first point!
+            self.robot.move_on_stop()
+        elif self.robot.current_goal is None:
+            self.robot.move_now()
+        else:
+            self.robot.error = blend
+            self.robot.move_on_error()
+
+    def at_goal(self):
+        """See :py:meth:`Robot.at_goal`"""
+        return self.robot.at_goal()
+
+    def is_stopped(self):
+        """See :py:meth:`Robot.is_stopped`"""
+        return self.robot.is_stopped()
+
+    def pose(self):
+        """See :py:meth:`Robot.pose`"""
+        with self.robot.receiver.lock:
+            return list(self.robot.receiver.position)
+
+    def joints(self):
+        """See :py:meth:`Robot.joints`"""
+        with self.robot.receiver.lock:
+            return list(self.robot.receiver.actual_joint_positions)
+
+    def close(self):
+        """See :py:meth:`Robot.close`"""
+        self.robot.__exit__()
+
+
+class StreamingRobot(Robot):
+    """A robot whose state arrives as lines on a socket.
+
+    A background thread receives the state (see
+    :py:class:`stream_recorder.Stream`) and keeps the latest. The robot is
+    stopped once its joints have not changed for `settle` seconds.
+
+    Attributes:
+        stream: The :py:class:`stream_recorder.Stream` of robot states
+        goal: A 6 element np.ndarray, the goal of the latest move, or None
+        tolerance: A float, how close (rad) the joints must be to the goal
+            to be at it
+        settle: A float, how long (s) the joints must be unchanged for the
+            robot to be stopped
+    """
+    def __init__(self, name, address, request, parse, tolerance=0.001,
+                 settle=0.05):
+        """Connect to the robot and start receiving its state.
+
+        Args:
+            name (str): The name of the robot
+            address (tuple): (host, port) of the robot
+            request (str): The request for the next state, None if the robot
+                sends its state unprompted
+            parse (function): Converts a line into (time, 12 values), the
+                joints followed by the pose
+            tolerance (float): How close (rad) the joints must be to the goal
+            settle (float): How long (s) the joints must be unchanged for the
+                robot to be stopped
+
+        Raises:
+            RuntimeError: The robot could not be reached or sent no state
+        """
+        self.goal = None
+        self.tolerance = tolerance
+        self.settle = settle
+        self.stream = Stream(name, address, request,
+                             ['joint {}'.format(i) for i in range(6)] +
+                             ['x', 'y', 'z', 'rx', 'ry', 'rz'], parse)
+        self.__state = None
+        self.__changed = None
+        self.__condition = threading.Condition()
+        self.stream.connect()
+        self.__run = True
+        self.__receiving_thread = threading.Thread(
+            target=self.__receive, name='{}_receive_thread'.format(name))
+        self.__receiving_thread.daemon = True
+        self.__receiving_thread.start()
+        with self.__condition:
+            deadline = synchronize.clock() + 5
+            while self.__state is None and synchronize.clock() < deadline:
+                self.__condition.wait(0.1)
+        if self.__state is None:
+            self.close()
+            raise RuntimeError('[{}] no state received'.format(name))
+
+    def __receive(self):
+        """Keep the latest state until closed."""
+        self.stream.request()
+        while self.__run:
+            ready, _, _ = select.select([self.stream], [], [], 0.1)
+            if not ready:
+                continue
+            lines = self.stream.lines
+            try:
+                samples = self.stream.read()
+            except (RuntimeError, socket.error) as e:
+                if self.__run:
+                    print(e)
+                return
+            if self.stream.lines > lines:
+                self.stream.request()
+            if not samples:
+                continue
+            sample_time, values = samples[-1]
+            state = RobotState(sample_time, np.asarray(values[:6]),
+                               list(values[6:]))
+            with self.__condition:
+                if self.__state is None or np.any(
+                        state.joints != self.__state.joints):
+                    self.__changed = sample_time
+                self.__state = state
+                self.__condition.notify_all()
+
+    def state(self):
+        """The latest state of the robot.
+
+        Returns: :py:class:`RobotState`
+        """
+        with self.__condition:
+            return self.__state
+
+    def wait_for_goal(self, blend=None, poll=0.002):
+        """Wait until the robot is at the current goal.
+
+        Args:
+            blend (float): How close (rad) to the goal is close enough, None
+                to also wait for the robot to stop
+            poll (float): How often (s) to check
+        """
+        if self.goal is None:
+            return
+        tolerance = self.tolerance if blend is None else blend
+        while not (self.__near_goal(tolerance) and
+                   (blend is not None or self.is_stopped())):
+            time.sleep(poll)
+
+    def __near_goal(self, tolerance):
+        """Whether the joints are within the tolerance of the goal."""
+        return np.max(np.abs(self.state().joints - self.goal)) <= tolerance
+
+    def at_goal(self):
+        """See :py:meth:`Robot.at_goal`"""
+        return self.goal is not None and self.__near_goal(self.tolerance)
+
+    def is_stopped(self):
+        """See :py:meth:`Robot.is_stopped`"""
+        with self.__condition:
+            return self.__state.time - self.__changed >= self.settle
+
+    def pose(self):
+        """See :py:meth:`Robot.pose`"""
+        return self.state().pose
+
+    def joints(self):
+        """See :py:meth:`Robot.joints`"""
+        return self.state().joints.tolist()
+
+    def close(self):
+        """See :py:meth:`Robot.close`"""
+        self.__run = False
+        if self.__receiving_thread.is_alive() and \
+                self.__receiving_thread is not threading.current_thread():
+            self.__receiving_thread.join()
+        self.stream.close()
+
+
+def parse_kuka_state(line, received):
+    """Parse a state line from the KUKA-RSI interface.
+
+    Args:
+        line (bytes): A JSON object with the actual cartesian pose in
+            Rob/RIst/@X..@C (mm, Z,Y,X euler degrees), the axis positions in
+            Rob/AIPos/@A1..@A6 (degrees) and the age of the data in
+            microseconds in Time/differential
+        received (float): The time the line arrived
+
+    Returns: A tuple, (float, the time of the state, list of float, the
+        joints (rad) and the pose, x,y,z (m), axis-angle)
+
+    Raises:
+        ValueError: The line could not be parsed
+    """
+    try:
+        data = json.loads(line.decode('utf-8'))
+        pose = [float(data['Rob']['RIst']['@' + axis])
+                for axis in ['X', 'Y', 'Z', 'A', 'B', 'C']]
+        joints = [float(data['Rob']['AIPos']['@A{}'.format(axis)])
+                  for axis in range(1, 7)]
+        age = 1e-6 * float(data['Time']['differential'])
+    except (KeyError, TypeError) as e:
+        raise ValueError('missing field {}'.format(e))
+    rotation = rotations.mat2rotvec(rotations.euler2mat(pose[3:], True))
+    return received - age, (np.radians(joints).tolist() +
+                            [x / 1000 for x in pose[:3]] + rotation.tolist())
+
+
+class KukaRSIRobot(StreamingRobot):
+    """A KUKA robot, read through the KUKA-RSI interface.
+
+    The robot is moved by the program running on the controller (ex: the
+    points in `examples/KUKA_with_EBT/gather_data/tp_files`), so a move only
+    records the goal, which is then waited for like any other robot's.
+    """
+    def __init__(self, address, port=6009, request='ping'):
+        """Connect to the KUKA-RSI interface.
+
+        Args:
+            address (str): The address of the KUKA-RSI interface
+            port (int): The port of the KUKA-RSI interface
+            request (str): The request string for the robot state
+        """
+        super(KukaRSIRobot, self).__init__('KUKA', (address, port), request,
+                                           parse_kuka_state)
+
+    def move_to_joint(self, joints, velocity=None, blend=None):
+        """See :py:meth:`Robot.move_to_joint`, the velocity is set by the
+        controller program."""
+        self.wait_for_goal(blend)
+        self.goal = np.asarray(joints, dtype=float)
+
+
+def parse_simulated_state(line, received):
+    """Parse a state line from a :py:class:`SimulatedRobotServer`.
+
+    Args:
+        line (bytes): A JSON object with `joints` and `pose`
+        received (float): The time the line arrived
+
+    Returns: A tuple, (float, the time of the state, list of float, the
+        joints and the pose)
+
+    Raises:
+        ValueError: The line could not be parsed
+    """
+    try:
+        data = json.loads(line.decode('utf-8'))
+        return received, list(data['joints']) + list(data['pose'])
+    except (KeyError, TypeError) as e:
+        raise ValueError('missing field {}'.format(e))
+
+
+class SimulatedRobot(StreamingRobot):
+    """A client of a :py:class:`SimulatedRobotServer`."""
+    def __init__(self, address='localhost', port=30003):
+        """Connect to the simulated robot.
+
+        Args:
+            address (str): The address of the server
+            port (int): The port of the server
+        """
+        super(SimulatedRobot, self).__init__('simulated', (address, port),
+                                             None, parse_simulated_state)
+
+    def move_to_joint(self, joints, velocity=None, blend=None):
+        """See :py:meth:`Robot.move_to_joint`"""
+        self.wait_for_goal(blend)
+        self.goal = np.asarray(joints, dtype=float)
+        command = {"move": self.goal.tolist()}
+        if velocity is not None:
+            command["velocity"] = velocity
+        self.stream.send(json.dumps(command).encode('utf-8') + b'\n')
+
+
+class SimulatedRobotServer(object):
+    """A UR5 simulated on a local socket.
+
+    Every `period` the joint positions and tool pose are sent as a line of
+    JSON. A line `{"move": [6 joints], "velocity": rad/s}` starts a move from
+    wherever the robot is, with a smooth velocity profile. States and
+    commands are both delayed by `latency`. One client is served at a time.
+    The server supports use by the with statement.
+
+    Attributes:
+        address: A tuple, (host, port) the server is listening on
+        latency: A float, the delay (s) of every state and command
+        period: A float, the period (s) at which the state is sent
+        velocity: A float, the default joint velocity (rad/s)
+    """
+    def __init__(self, port=0, latency=0.0, period=0.008, velocity=0.5,
+                 joints=None):
+        """Start serving.
+
+        Args:
+            port (int): The port to listen on, 0 for any free port
+            latency (float): The delay (s) of every state and command
+            period (float): The period (s) at which the state is sent
+            velocity (float): The default joint velocity (rad/s)
+            joints (6 member list): The starting joint positions, None for
+                :py:data:`HOME`
+        """
+        self.latency = latency
+        self.period = period
+        self.velocity = velocity
+        start = np.asarray(HOME if joints is None else joints, dtype=float)
+        # the current move: (start time, duration, start, goal)
+        self.__move = (0.0, 0.0, start, start)
+        self.__listener = socket.socket()
+        self.__listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__listener.bind(('localhost', port))
+        self.__listener.listen(1)
+        self.address = self.__listener.getsockname()
+        self.__run = True
+        self.__serving_thread = threading.Thread(
+            target=self.__serve, name='simulated_robot_thread')
+        self.__serving_thread.daemon = True
+        self.__serving_thread.start()
+
+    def joints_at(self, at_time):
+        """The joint positions at a time.
+
+        Args:
+            at_time (float): The time, see :py:data:`synchronize.clock`
+
+        Returns: 6 element np.ndarray of joint positions
+        """
+        started, duration, start, goal = self.__move
+        if duration <= 0:
+            return goal
+        fraction = np.clip((at_time - started) / duration, 0, 1)
+        # a smooth start and stop
+        fraction = fraction * fraction * (3 - 2 * fraction)
+        return start + (goal - start) * fraction
+
+    def motion(self):
+        """The timing of the latest move.
+
+        Returns: A tuple, (float, the time the move started, float, its
+            duration in seconds)
+        """
+        started, duration, _, _ = self.__move
+        return started, duration
+
+    def move(self, joints, velocity=None, at_time=None):
+        """Start a move from wherever the robot is.
+
+        Args:
+            joints (6 member list): The goal joint positions
+            velocity (float): The peak joint velocity is 1.5 times this
+                average (rad/s), None for the default
+            at_time (float): When the move starts, None for now
+        """
+        at_time = synchronize.clock() if at_time is None else at_time
+        start = self.joints_at(at_time)
+        goal = np.asarray(joints, dtype=float)
+        distance = np.max(np.abs(goal - start))
+        self.__move = (at_time, distance / (velocity or self.velocity),
+                       start, goal)
+
+    def __serve(self):
+        """Serve clients one at a time until closed."""
+        while self.__run:
+            ready, _, _ = select.select([self.__listener], [], [], 0.1)
+            if not ready:
+                continue
+            client, _ = self.__listener.accept()
+            try:
+                self.__handle(client)
+            except socket.error:
+                pass
+            finally:
+                client.close()
+
+    def __handle(self, client):
+        """Stream the state to a client and follow its commands."""
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client.setblocking(False)
+        received = bytearray()
+        outgoing = collections.deque()
+        commands = collections.deque()
+        next_tick = synchronize.clock()
+        while self.__run:
+            due = [next_tick]
+            if outgoing:
+                due.append(outgoing[0][0])
+            if commands:
+                due.append(commands[0][0])
+            wait = max(0, min(due) - synchronize.clock())
+            ready, _, _ = select.select([client], [], [], wait)
+            now = synchronize.clock()
+            if ready:
+                data = client.recv(4096)
+                if not data:
+                    return
+                received += data
+                end = received.find(b'\n')
+                while end != -1:
+                    try:
+                        command = json.loads(received[:end].decode('utf-8'))
+                        commands.append((now + self.latency,
+                                         (command['move'],
+                                          command.get('velocity'))))
+                    except (ValueError, KeyError, TypeError):
+                        print('ignoring the command {!r}'.format(
+                            bytes(received[:end])))
+                    del received[:end + 1]
+                    end = received.find(b'\n')
+            while commands and commands[0][0] <= now:
+                command_time, (joints, velocity) = commands.popleft()
+                self.move(joints, velocity, command_time)
+            if now >= next_tick:
+                joints = self.joints_at(next_tick)
+                state = {"joints": joints.tolist(),
+                         "pose": ur5_forward_kinematics(joints).tolist()}
+                outgoing.append((next_tick + self.latency,
+                                 json.dumps(state).encode('utf-8') + b'\n'))
+                next_tick = max(next_tick + self.period, now)
+            while outgoing and outgoing[0][0] <= now:
+                client.setblocking(True)
+                client.sendall(outgoing.popleft()[1])
+                client.setblocking(False)
+
+    def close(self):
+        """Stop serving."""
+        self.__run = False
+        if self.__serving_thread.is_alive():
+            self.__serving_thread.join()
+        self.__listener.close()
+
+    def __enter__(self):
+        """Enters the server from a with statement"""
+        return self
+
+    def __exit__(self, *_):
+        """Exits at the end of a context manager statement by closing."""
+        self.close()
+
+
+if __name__ == '__main__':
+    main()
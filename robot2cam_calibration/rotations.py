@@ -0,0 +1,291 @@
+"""Vectorized rotation and pose helpers.
+
+All of the functions in this file operate on stacks of rotations so that
+large numbers of poses (robot logs, image sets, etc.) can be processed without
+python loops. Poses follow the convention used throughout the package:
+x,y,z,axis-angle (a 3 element rotation vector whose magnitude is the angle in
+radians). Quaternions are stored as w,x,y,z.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import numpy as np
+
+
+def rotvec2quat(rotvec):
+    """Convert rotation vectors (axis-angle) to unit quaternions.
+
+    Args:
+        rotvec (...x3 array): The rotation vectors
+
+    Returns: ...x4 np.ndarray of quaternions (w,x,y,z)
+    """
+    rotvec = np.asarray(rotvec, dtype=float)
+    angle = np.linalg.norm(rotvec, axis=-1)
+    small = angle < 1e-6
+    # sin(angle/2)/angle, with a taylor expansion around zero
+    scale = np.where(small, 0.5 - angle ** 2 / 48,
+                     np.sin(angle / 2) / np.where(small, 1, angle))
+    quat = np.empty(rotvec.shape[:-1] + (4,))
+    quat[..., 0] = np.cos(angle / 2)
+    quat[..., 1:] = rotvec * scale[..., None]
+    return quat
+
+
+def quat2rotvec(quat):
+    """Convert quaternions to rotation vectors (axis-angle).
+
+    Args:
+        quat (...x4 array): The quaternions (w,x,y,z), need not be normalized
+
+    Returns: ...x3 np.ndarray of rotation vectors with angles in [0, pi]
+    """
+    quat = np.asarray(quat, dtype=float)
+    quat = quat / np.linalg.norm(quat, axis=-1)[..., None]
+    # q and -q are the same rotation, pick the one with the smaller angle
+    quat = np.where(quat[..., :1] < 0, -quat, quat)
+    sin_half = np.linalg.norm(quat[..., 1:], axis=-1)
+    angle = 2 * np.arctan2(sin_half, quat[..., 0])
+    small = angle < 1e-6
+    # angle/sin(angle/2), with a taylor expansion around zero
+    scale = np.where(small, 2 + angle ** 2 / 12,
+                     angle / np.where(small, 1, sin_half))
+    return quat[..., 1:] * scale[..., None]
+
+
+def quat2mat(quat):
+    """Convert quaternions to rotation matrices.
+
+    Args:
+        quat (...x4 array): The quaternions (w,x,y,z), need not be normalized
+
+    Returns: ...x3x3 np.ndarray of rotation matrices
+    """
+    quat = np.asarray(quat, dtype=float)
+    quat = quat / np.linalg.norm(quat, axis=-1)[..., None]
+    w, x, y, z = quat[..., 0], quat[..., 1], quat[..., 2], quat[..., 3]
+    mat = np.empty(quat.shape[:-1] + (3, 3))
+    mat[..., 0, 0] = 1 - 2 * (y * y + z * z)
+    mat[..., 0, 1] = 2 * (x * y - z * w)
+    mat[..., 0, 2] = 2 * (x * z + y * w)
+    mat[..., 1, 0] = 2 * (x * y + z * w)
+    mat[..., 1, 1] = 1 - 2 * (x * x + z * z)
+    mat[..., 1, 2] = 2 * (y * z - x * w)
+    mat[..., 2, 0] = 2 * (x * z - y * w)
+    mat[..., 2, 1] = 2 * (y * z + x * w)
+    mat[..., 2, 2] = 1 - 2 * (x * x + y * y)
+    return mat
+
+
+def mat2quat(mat):
+    """Convert rotation matrices to unit quaternions.
+
+    Uses the numerically stable branch for each matrix (largest of the
+    diagonal or trace), so that rotations near pi are handled correctly.
+
+    Args:
+        mat (...x3x3 array): The rotation matrices
+
+    Returns: ...x4 np.ndarray of quaternions (w,x,y,z)
+    """
+    mat = np.asarray(mat, dtype=float)
+    shape = mat.shape[:-2]
+    mat = mat.reshape(-1, 3, 3)
+    trace = np.trace(mat, axis1=1, axis2=2)
+    choice = np.column_stack((mat[:, 0, 0], mat[:, 1, 1], mat[:, 2, 2],
+                              trace)).argmax(axis=1)
+    quat = np.empty((mat.shape[0], 4))
+
+    index = choice == 3
+    quat[index, 0] = 1 + trace[index]
+    quat[index, 1] = mat[index, 2, 1] - mat[index, 1, 2]
+    quat[index, 2] = mat[index, 0, 2] - mat[index, 2, 0]
+    quat[index, 3] = mat[index, 1, 0] - mat[index, 0, 1]
+
+    for i in range(3):
+        j = (i + 1) % 3
+        k = (i + 2) % 3
+        index = choice == i
+        quat[index, 0] = mat[index, k, j] - mat[index, j, k]
+        quat[index, i + 1] = 1 - trace[index] + 2 * mat[index, i, i]
+        quat[index, j + 1] = mat[index, j, i] + mat[index, i, j]
+        quat[index, k + 1] = mat[index, k, i] + mat[index, i, k]
+
+    quat /= np.linalg.norm(quat, axis=1)[:, None]
+    return quat.reshape(shape + (4,))
+
+
+def rotvec2mat(rotvec):
+    """Convert rotation vectors (axis-angle) to rotation matrices.
+
+    Args:
+        rotvec (...x3 array): The rotation vectors
+
+    Returns: ...x3x3 np.ndarray of rotation matrices
+    """
+    return quat2mat(rotvec2quat(rotvec))
+
+
+def mat2rotvec(mat):
+    """Convert rotation matrices to rotation vectors (axis-angle).
+
+    Args:
+        mat (...x3x3 array): The rotation matrices
+
+    Returns: ...x3 np.ndarray of rotation vectors
+    """
+    return quat2rotvec(mat2quat(mat))
+
+
+def quat_multiply(first, second):
+    """The hamilton product of two sets of quaternions.
+
+    Args:
+        first (...x4 array): The left hand quaternions (w,x,y,z)
+        second (...x4 array): The right hand quaternions (w,x,y,z)
+
+    Returns: ...x4 np.ndarray of the products
+    """
+    first = np.asarray(first, dtype=float)
+    second = np.asarray(second, dtype=float)
+    w1, v1 = first[..., :1], first[..., 1:]
+    w2, v2 = second[..., :1], second[..., 1:]
+    return np.concatenate(
+        (w1 * w2 - np.sum(v1 * v2, axis=-1)[..., None],
+         w1 * v2 + w2 * v1 + np.cross(v1, v2)), axis=-1)
+
+
+def slerp(start, end, fraction):
+    """Spherical linear interpolation between sets of quaternions.
+
+    Args:
+        start (...x4 array): The quaternions at fraction 0 (w,x,y,z)
+        end (...x4 array): The quaternions at fraction 1 (w,x,y,z)
+        fraction (... array): How far to interpolate between start and end
+
+    Returns: ...x4 np.ndarray of unit quaternions
+    """
+    start = np.asarray(start, dtype=float)
+    end = np.asarray(end, dtype=float)
+    fraction = np.asarray(fraction, dtype=float)[..., None]
+    start = start / np.linalg.norm(start, axis=-1)[..., None]
+    end = end / np.linalg.norm(end, axis=-1)[..., None]
+    dot = np.sum(start * end, axis=-1)[..., None]
+    # take the short way around
+    end = np.where(dot < 0, -end, end)
+    dot = np.abs(dot)
+    # nearly parallel quaternions fall back to normalized linear interpolation
+    close = dot > 0.9995
+    theta = np.arccos(np.clip(dot, -1, 1))
+    sin_theta = np.where(close, 1, np.sin(theta))
+    start_weight = np.where(close, 1 - fraction,
+                            np.sin((1 - fraction) * theta) / sin_theta)
+    end_weight = np.where(close, fraction,
+                          np.sin(fraction * theta) / sin_theta)
+    result = start_weight * start + end_weight * end
+    return result / np.linalg.norm(result, axis=-1)[..., None]
+
+
+def pose2mat(pose):
+    """Convert poses (x,y,z,axis-angle) to homogeneous transformation matrices.
+
+    This is the vectorized form of
+    :py:func:`compute_transformations.vector2mat`.
+
+    Args:
+        pose (...x6 array): The poses
+
+    Returns: ...x4x4 np.ndarray of homogeneous transformation matrices
+    """
+    pose = np.asarray(pose, dtype=float)
+    mat = np.zeros(pose.shape[:-1] + (4, 4))
+    mat[..., :3, :3] = rotvec2mat(pose[..., 3:])
+    mat[..., :3, 3] = pose[..., :3]
+    mat[..., 3, 3] = 1
+    return mat
+
+
+def mat2pose(mat):
+    """Convert homogeneous transformation matrices to poses (x,y,z,axis-angle).
+
+    This is the vectorized form of
+    :py:func:`compute_transformations.mat2vector`.
+
+    Args:
+        mat (...x4x4 array): The transformation matrices
+
+    Returns: ...x6 np.ndarray of poses
+    """
+    mat = np.asarray(mat, dtype=float)
+    return np.concatenate((mat[..., :3, 3], mat2rotvec(mat[..., :3, :3])),
+                          axis=-1)
+
+
+def invert_transform(mat):
+    """Invert homogeneous transformation matrices without a general inverse.
+
+    Args:
+        mat (...x4x4 array): The transformation matrices
+
+    Returns: ...x4x4 np.ndarray of the inverted transformations
+    """
+    mat = np.asarray(mat, dtype=float)
+    rotation_t = np.swapaxes(mat[..., :3, :3], -1, -2)
+    inverse = np.zeros_like(mat)
+    inverse[..., :3, :3] = rotation_t
+    inverse[..., :3, 3] = -np.einsum('...ij,...j->...i', rotation_t,
+                                     mat[..., :3, 3])
+    inverse[..., 3, 3] = 1
+    return inverse
+
+
+def euler2mat(angles, degrees=False):
+    """Convert Z,Y,X euler angles to rotation matrices.
+
+    This is the convention KUKA uses for A,B,C: rotate about Z by A, then
+    about the new Y by B, then about the new X by C, so R = Rz(A)Ry(B)Rx(C).
+
+    Args:
+        angles (...x3 array): The Z,Y,X angles
+        degrees (bool): Whether the angles are in degrees rather than radians
+
+    Returns: ...x3x3 np.ndarray of rotation matrices
+    """
+    angles = np.asarray(angles, dtype=float)
+    if degrees:
+        angles = np.radians(angles)
+    cos = np.cos(angles)
+    sin = np.sin(angles)
+    ca, cb, cc = cos[..., 0], cos[..., 1], cos[..., 2]
+    sa, sb, sc = sin[..., 0], sin[..., 1], sin[..., 2]
+    mat = np.empty(angles.shape[:-1] + (3, 3))
+    mat[..., 0, 0] = ca * cb
+    mat[..., 0, 1] = ca * sb * sc - sa * cc
+    mat[..., 0, 2] = ca * sb * cc + sa * sc
+    mat[..., 1, 0] = sa * cb
+    mat[..., 1, 1] = sa * sb * sc + ca * cc
+    mat[..., 1, 2] = sa * sb * cc - ca * sc
+    mat[..., 2, 0] = -sb
+    mat[..., 2, 1] = cb * sc
+    mat[..., 2, 2] = cb * cc
+    return mat
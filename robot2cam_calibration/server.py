@@ -0,0 +1,638 @@
+"""A file to serve calibrations to other programs over local HTTP.
+
+Each command line calibration pays for starting python and importing numpy,
+scipy and opencv before it solves anything. The server keeps a few worker
+processes running with all of that already imported, takes jobs over HTTP
+on localhost, queues them until a worker is free and keeps the results.
+Several cells can then share one solver host.
+
+Jobs are sent as json, and every response is json:
+
+- ``POST /jobs`` queues a job, ``{"kind": "compute", "correspondences":
+  {...}, "options": {...}}`` computes a transformation from the
+  correspondences, given either as a dictionary or the name of a file, with
+  the options of ``robot2cam-compute`` (see :py:data:`batch.OPTIONS`).
+  ``{"kind": "check", "job": "1", "options": {...}}`` checks the result of
+  a compute job with the arguments of
+  :py:func:`check_transformation.check_transformation`. A check waits for
+  its compute job to be done, and fails if the compute job fails or is
+  cancelled. Answers with the job, whose `id` is used below.
+- ``GET /jobs`` lists the jobs and ``GET /jobs/<id>`` gives one job with its
+  result once it is done.
+- ``GET /jobs/<id>/output`` streams the output of the job as plain text
+  until it finishes.
+- ``DELETE /jobs/<id>`` cancels a job. A running job's worker is stopped and
+  replaced.
+
+The files of each job are kept in a folder named by its id. File names sent
+to the server are relative to the folder the server runs in.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import robot2cam_calibration.batch as batch
+
+KINDS = ['compute', 'check']
+
+# The states of a job, the last three are final
+STATES = ['queued', 'running', 'done', 'failed', 'cancelled']
+
+
+def main():
+    """
+    Exposes :py:class:`CalibrationServer` to the commandline. Run with arg
+    `-h` for more info.
+    """
+    parser = argparse.ArgumentParser(
+        description="Serve camera to robot calibrations over HTTP on "
+                    "localhost")
+
+    parser.add_argument("--port", type=int,
+                        help="The port to listen on",
+                        default=8750)
+
+    parser.add_argument("--workers", type=int,
+                        help="The number of worker processes. Defaults to "
+                             "the number of CPUs.",
+                        default=None)
+
+    parser.add_argument("--folder", type=str,
+                        help="The folder to keep the files of each job in",
+                        default="calibration_jobs")
+
+    args = parser.parse_args()
+
+    with CalibrationServer(port=args.port, workers=args.workers,
+                           folder=args.folder) as server:
+        print('serving on http://{}:{} with {} workers'.format(
+            server.address[0], server.address[1], len(server.workers)))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+class Job(object):
+    """A calibration job and its progress.
+
+    Attributes:
+        id (str): The id of the job
+        kind (str): What the job does, one of :py:data:`KINDS`
+        arguments (dict): The keyword arguments of the function the job runs
+        folder (str): The folder the files of the job are kept in
+        state (str): One of :py:data:`STATES`
+        output (list of str): The lines the job has printed
+        result: The result of the job once it is done
+        error (str): What went wrong once it failed
+        after (Job): The job which must be done before this one runs, or
+                     None
+    """
+    def __init__(self, id, kind, arguments, folder, after=None):
+        self.id = id
+        self.kind = kind
+        self.arguments = arguments
+        self.folder = folder
+        self.after = after
+        self.state = 'queued'
+        self.output = []
+        self.result = None
+        self.error = None
+        self.times = {'queued': time.time()}
+        self.cancelled = False
+        self._condition = threading.Condition()
+        self._callbacks = []
+
+    @property
+    def finished(self):
+        """bool: Whether the job is done, has failed or was cancelled"""
+        return self.state in STATES[2:]
+
+    def update(self, state=None, output=None, result=None, error=None):
+        """Record progress and wake anyone waiting on the job.
+
+        Args:
+            state (str): The new state, None to leave it
+            output (str): A line the job printed, None for none
+            result: The result of the job, None for none
+            error (str): What went wrong, None for nothing
+        """
+        with self._condition:
+            if state is not None:
+                self.state = state
+                self.times[state] = time.time()
+            if output is not None:
+                self.output.append(output)
+            if result is not None:
+                self.result = result
+            if error is not None:
+                self.error = error
+            self._condition.notify_all()
+            callbacks = self._callbacks if self.finished else []
+            if callbacks:
+                self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def when_finished(self, callback):
+        """Call a function once the job is done, has failed or was cancelled.
+
+        Args:
+            callback (function): Called with the job, right away if it has
+                                 already finished
+        """
+        with self._condition:
+            if not self.finished:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait_output(self, start, timeout=1.0):
+        """Wait for output after the lines already seen.
+
+        Args:
+            start (int): The number of lines already seen
+            timeout (float): The longest time (s) to wait
+
+        Returns: A tuple, (list of str, the new lines, bool, whether the job
+            had finished)
+        """
+        with self._condition:
+            if len(self.output) <= start and not self.finished:
+                self._condition.wait(timeout)
+            return self.output[start:], self.finished
+
+    def describe(self, result=True):
+        """Describe the job for a response.
+
+        Args:
+            result (bool): Whether to include the result
+
+        Returns: A dictionary of the job
+        """
+        with self._condition:
+            description = {'id': self.id, 'kind': self.kind,
+                           'state': self.state, 'folder': self.folder,
+                           'times': dict(self.times),
+                           'lines': len(self.output)}
+            if self.error is not None:
+                description['error'] = self.error
+            if self.after is not None:
+                description['after'] = self.after.id
+            if result and self.result is not None:
+                description['result'] = self.result
+            return description
+
+
+class Worker(object):
+    """A warm worker process and the thread which feeds it jobs.
+
+    Attributes:
+        process (multiprocessing.Process): The worker process
+        connection (multiprocessing.Connection): The server's end of the
+                                                 pipe to the process
+    """
+    def __init__(self, jobs, poll=0.05):
+        """Start the process and its thread.
+
+        Args:
+            jobs (queue.Queue): The queue of jobs to take from, a None stops
+                                the worker
+            poll (float): How often (s) to check whether the running job
+                          was cancelled
+        """
+        self.jobs = jobs
+        self.poll = poll
+        self.process = None
+        self.connection = None
+        self.start_process()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def start_process(self):
+        """Start a new worker process."""
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve_jobs,
+                                               args=(child,))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def stop_process(self):
+        """Stop the worker process, whatever it is doing."""
+        self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+    def run(self):
+        """Run jobs from the queue until a None is taken."""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            if job.cancelled:
+                continue
+            job.update(state='running')
+            try:
+                self.run_job(job)
+            except Exception as exception:
+                # keep serving, but with a fresh process
+                job.update(state='failed', error='{}: {}'.format(
+                    type(exception).__name__, exception))
+                self.stop_process()
+                self.start_process()
+        self.connection.send(None)
+        self.process.join()
+
+    def run_job(self, job):
+        """Run one job in the worker process, relaying its output.
+
+        Args:
+            job (Job): The job to run
+        """
+        self.connection.send((job.kind, job.arguments))
+        while True:
+            if job.cancelled:
+                self.stop_process()
+                self.start_process()
+                job.update(state='cancelled')
+                return
+            if not self.connection.poll(self.poll):
+                continue
+            try:
+                message, value = self.connection.recv()
+            except EOFError:
+                raise RuntimeError('the worker exited with code {}'.format(
+                    self.process.exitcode))
+            if message == 'output':
+                job.update(output=value)
+            elif message == 'done':
+                job.update(state='done', result=value)
+                return
+            else:
+                job.update(state='failed', error=value)
+                return
+
+
+class CalibrationServer(object):
+    """Serve calibration jobs over HTTP on localhost.
+
+    Attributes:
+        address (tuple): The host and port being served on
+        workers (list of Worker): The worker processes
+        jobs (dict): The jobs by id
+    """
+    def __init__(self, port=8750, workers=None, folder='calibration_jobs',
+                 host='127.0.0.1'):
+        """Start the workers and listen.
+
+        Args:
+            port (int): The port to listen on, 0 for any free port
+            workers (int): The number of worker processes, None for one per
+                           CPU
+            folder (str): The folder to keep the files of each job in
+            host (str): The address to listen on. Jobs can read and write
+                        files, so this should stay on the local machine.
+        """
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self.workers = [Worker(self._queue) for _ in
+                        range(workers or multiprocessing.cpu_count())]
+        self.http = _ThreadingHTTPServer((host, port), _Handler)
+        self.http.calibration_server = self
+        self.address = self.http.server_address
+        self._serving = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def serve_forever(self):
+        """Answer requests until :py:meth:`close` is called."""
+        self._serving.set()
+        self.http.serve_forever()
+
+    def close(self):
+        """Stop serving, cancel the unfinished jobs and stop the workers."""
+        if self._serving.is_set():
+            self.http.shutdown()
+        self.http.server_close()
+        for job in list(self.jobs.values()):
+            if not job.finished:
+                self.cancel(job.id)
+        for _ in self.workers:
+            self._queue.put(None)
+        for worker in self.workers:
+            worker.thread.join()
+
+    def submit(self, request):
+        """Queue a job.
+
+        Args:
+            request (dict): The job, see the module docstring
+
+        Returns: The new Job
+
+        Raises:
+            ValueError: The request is not a valid job
+        """
+        kind = request.get('kind')
+        if kind not in KINDS:
+            raise ValueError('kind must be one of {}'.format(KINDS))
+        options = request.get('options', {})
+        if not isinstance(options, dict):
+            raise ValueError('options must be a dictionary')
+        with self._lock:
+            id = str(next(self._ids))
+        folder = os.path.join(self.folder, id)
+        after = None
+        if kind == 'compute':
+            arguments = self._compute_arguments(request, options, folder, id)
+        else:
+            if 'job' in request:
+                after = self.jobs.get(str(request['job']))
+                if after is None or after.kind != 'compute':
+                    raise ValueError('there is no compute job {}'.format(
+                        request['job']))
+            arguments = self._check_arguments(options, folder, after)
+        job = Job(id, kind, arguments, folder, after)
+        with self._lock:
+            self.jobs[id] = job
+        if after is None:
+            self._queue.put(job)
+        else:
+            after.when_finished(lambda computed: self._release(job, computed))
+        return job
+
+    def _release(self, job, computed):
+        """Queue a job once the job it waits for has finished.
+
+        Args:
+            job (Job): The waiting job
+            computed (Job): The job it waits for, which has finished
+        """
+        if job.finished:
+            return
+        if computed.state == 'done':
+            self._queue.put(job)
+        else:
+            job.update(state='failed', error='compute job {} {}'.format(
+                computed.id, 'was cancelled' if computed.state == 'cancelled'
+                else 'failed'))
+
+    def _compute_arguments(self, request, options, folder, id):
+        """The arguments of a compute job, see :py:meth:`submit`"""
+        correspondences = request.get('correspondences')
+        if correspondences is None:
+            raise ValueError('a compute job needs correspondences')
+        arguments = batch.compute_arguments(options, id)
+        os.makedirs(folder)
+        if isinstance(correspondences, dict):
+            file_name = os.path.join(folder, 'correspondences.json')
+            with open(file_name, 'w') as correspondences_file:
+                json.dump(correspondences, correspondences_file)
+            correspondences = file_name
+        arguments['correspondences'] = correspondences
+        arguments['file_out'] = os.path.join(folder, 'transformation.json')
+        return arguments
+
+    def _check_arguments(self, options, folder, computed=None):
+        """The arguments of a check job, see :py:meth:`submit`"""
+        arguments = {'r2c_calibration': 'transformation.json',
+                     'robot_data': 'correspondences.json',
+                     'image_folder': 'input_images',
+                     'cam_calibration': 'calibration.json',
+                     'workers': 1,
+                     'report': os.path.join(folder, 'report.json'),
+                     'render': False}
+        if computed is not None:
+            arguments['r2c_calibration'] = computed.arguments['file_out']
+            arguments['robot_data'] = computed.arguments['correspondences']
+        arguments.update(options)
+        # check_transformation reads result_folder relative to the working
+        # directory
+        arguments.setdefault('result_folder',
+                             os.path.relpath(os.path.join(folder, 'images')))
+        os.makedirs(folder)
+        return arguments
+
+    def cancel(self, id):
+        """Cancel a job, stopping it if it is running.
+
+        Args:
+            id (str): The id of the job
+
+        Returns: The Job
+
+        Raises:
+            KeyError: There is no such job
+        """
+        job = self.jobs[id]
+        job.cancelled = True
+        if job.state == 'queued':
+            job.update(state='cancelled')
+        return job
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answer the requests of :py:class:`CalibrationServer`."""
+
+    def do_GET(self):
+        server = self.server.calibration_server
+        parts = self._parts()
+        if parts == ['jobs']:
+            return self._send_json(200, [
+                job.describe(result=False) for job in
+                sorted(server.jobs.values(), key=lambda job: int(job.id))])
+        job = self._job(parts)
+        if job is None:
+            return
+        if len(parts) == 2:
+            return self._send_json(200, job.describe())
+        if len(parts) == 3 and parts[2] == 'output':
+            return self._stream_output(job)
+        self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self._parts() != ['jobs']:
+            return self._send_json(404, {'error': 'not found'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError('the job must be a dictionary')
+            job = self.server.calibration_server.submit(request)
+        except (ValueError, OSError) as exception:
+            return self._send_json(400, {'error': str(exception)})
+        self._send_json(202, job.describe())
+
+    def do_DELETE(self):
+        parts = self._parts()
+        job = self._job(parts)
+        if job is None:
+            return
+        if len(parts) != 2:
+            return self._send_json(404, {'error': 'not found'})
+        self.server.calibration_server.cancel(job.id)
+        self._send_json(200, job.describe(result=False))
+
+    def _parts(self):
+        """The parts of the requested path"""
+        return [part for part in self.path.split('?')[0].split('/') if part]
+
+    def _job(self, parts):
+        """The job a path names, answering with an error if there is none"""
+        if len(parts) < 2 or parts[0] != 'jobs':
+            self._send_json(404, {'error': 'not found'})
+            return None
+        job = self.server.calibration_server.jobs.get(parts[1])
+        if job is None:
+            self._send_json(404, {'error': 'no job {}'.format(parts[1])})
+        return job
+
+    def _send_json(self, code, value):
+        body = json.dumps(value, indent=4).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream_output(self, job):
+        """Write the output of a job as it is printed until it finishes.
+
+        The response has no length and ends when the connection is closed.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        sent = 0
+        finished = False
+        try:
+            while not finished:
+                lines, finished = job.wait_output(sent)
+                sent += len(lines)
+                for line in lines:
+                    self.wfile.write((line + '\n').encode('utf-8'))
+                self.wfile.flush()
+        except socket.error:
+            # the client stopped listening
+            pass
+
+
+class _ConnectionWriter(object):
+    """A file which sends each line written to it over a connection."""
+    def __init__(self, connection):
+        self.connection = connection
+        self.buffer = ''
+
+    def write(self, text):
+        lines = (self.buffer + text).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self.connection.send(('output', line))
+
+    def flush(self):
+        if self.buffer:
+            self.connection.send(('output', self.buffer))
+            self.buffer = ''
+
+
+def _serve_jobs(connection):
+    """Run the jobs sent over a connection in a worker process.
+
+    The solvers and image handling are imported once, up front, so each job
+    starts right away. The output of each job is sent back line by line,
+    followed by its result.
+
+    Args:
+        connection (multiprocessing.Connection): The worker's end of the pipe,
+            which receives (kind, arguments) tuples, a None to stop, and sends
+            ('output', str), then ('done', result) or ('failed', str)
+    """
+    import robot2cam_calibration.compute_transformations as compute
+    from robot2cam_calibration import check_transformation
+    from scipy import optimize  # noqa: F401
+    functions = {'compute': compute.compute_transformation,
+                 'check': check_transformation}
+    writer = _ConnectionWriter(connection)
+    sys.stdout = sys.stderr = writer
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        kind, arguments = request
+        try:
+            result = functions[kind](**arguments)
+        except Exception as exception:
+            traceback.print_exc()
+            writer.flush()
+            connection.send(('failed', '{}: {}'.format(
+                type(exception).__name__, exception)))
+        else:
+            writer.flush()
+            connection.send(('done', result))
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,543 @@
+"""A file to record several polled network streams at once to a binary log.
+
+Each stream is a TCP server which answers a request string with one line of
+data, for example Edge Based Tracking (EBT) and the KUKA-RSI interface. All
+of the streams are requested at once and waited on together with select, and
+each stream is requested again as soon as its answer arrives, so every stream
+runs at its own rate rather than all of them running at the rate of the
+slowest. Data is read into a reusable buffer per stream and split into lines,
+each line is stamped with the time it arrived and parsed into numbers, and
+the samples are written to the log in blocks.
+
+The log starts with a magic line and a JSON header line describing the
+streams, followed by blocks of samples. Each block is a little-endian uint16
+stream index and uint32 sample count followed by that many rows of float64,
+the time of the sample followed by the stream's fields. A block cut short by
+a crash is ignored when reading.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import argparse
+import datetime
+import errno
+import json
+import select
+import socket
+import struct
+import time
+
+import numpy as np
+
+from robot2cam_calibration.synchronize import clock
+
+MAGIC = b'R2C-STREAM-LOG 1\n'
+BLOCK_HEADER = struct.Struct('<HI')
+
+EBT_FIELDS = (['tracking', 'tracking time'] +
+              ['T[{},{}]'.format(row, column)
+               for row in range(4) for column in range(4)] +
+              ['frame time'])
+KUKA_FIELDS = ['x', 'y', 'z', 'a', 'b', 'c']
+
+
+def main():
+    """
+    Exposes :py:func:`record` to the commandline. Run with arg `-h` for more
+    info.
+    """
+    parser = argparse.ArgumentParser(
+        description="Record the EBT tracker and KUKA-RSI robot streams "
+                    "together to a binary log")
+
+    parser.add_argument("--out", type=str,
+                        help="The log file to write. Defaults to the date "
+                             "and time.",
+                        default=None)
+
+    parser.add_argument("--host", type=str,
+                        help="The address of the EBT and KUKA-RSI servers",
+                        default="localhost")
+
+    parser.add_argument("--ebt_port", type=int,
+                        help="The port of the EBT server",
+                        default=1701)
+
+    parser.add_argument("--ebt_request", type=str,
+                        help="The request string sent to the EBT server",
+                        default="1004")
+
+    parser.add_argument("--robot_port", type=int,
+                        help="The port of the KUKA-RSI server",
+                        default=6009)
+
+    parser.add_argument("--robot_request", type=str,
+                        help="The request string sent to the KUKA-RSI "
+                             "server",
+                        default="ping")
+
+    parser.add_argument("--duration", type=float,
+                        help="How long to record for in seconds. Defaults to "
+                             "until interrupted with ctrl-c.",
+                        default=None)
+
+    parser.add_argument("--block", type=int,
+                        help="The number of samples to collect before "
+                             "writing them to the log",
+                        default=256)
+
+    args = parser.parse_args()
+
+    out = args.out
+    if out is None:
+        date = datetime.datetime.now()
+        out = "{}-{}-{}_{}-{}-{}.streams".format(
+            date.year, date.month, date.day, date.hour, date.minute,
+            date.second)
+
+    streams = [Stream('EBT', (args.host, args.ebt_port), args.ebt_request,
+                      EBT_FIELDS, parse_ebt),
+               Stream('KUKA', (args.host, args.robot_port),
+                      args.robot_request, KUKA_FIELDS, parse_kuka)]
+    record(streams, out, args.duration, args.block)
+
+
+def record(streams, file_out, duration=None, block=256):
+    """Connect to the streams and record them until the duration passes or
+    the user interrupts with ctrl-c.
+
+    Args:
+        streams (list of Stream): The streams to record
+        file_out (str): The log file to write
+        duration (float): How long to record for in seconds, None to record
+                          until interrupted
+        block (int): The number of samples to collect before writing them
+
+    Returns: A dict of the number of samples recorded from each stream
+    """
+    try:
+        for stream in streams:
+            stream.connect()
+        with StreamLog(file_out, streams, block) as log:
+            recorder = Recorder(streams, log)
+            try:
+                recorder.run(duration)
+            except KeyboardInterrupt:
+                print('stopping')
+    finally:
+        for stream in streams:
+            stream.close()
+    for name, rate in recorder.rates().items():
+        print('[{}] {} samples, {:.1f} Hz'.format(
+            name, recorder.counts[name], rate))
+    print('log written to {}'.format(file_out))
+    return recorder.counts
+
+
+def parse_ebt(line, received):
+    """Parse a line from the EBT server.
+
+    The line holds the tracking flag, the tracking time, the 16 elements of
+    the tracked transformation and the frame time, separated by spaces and
+    possibly wrapped in brackets.
+
+    Args:
+        line (bytes): One line, without the delimiter
+        received (float): The time the line arrived
+
+    Returns: A tuple, (float, the time of the sample, list of float, the
+        fields)
+
+    Raises:
+        ValueError: The line could not be parsed
+    """
+    values = [float(value) for value in
+              line.decode('ascii').strip(' \t\r[]').split()]
+    if len(values) != len(EBT_FIELDS):
+        raise ValueError('expected {} values, got {}'.format(
+            len(EBT_FIELDS), len(values)))
+    return received, values
+
+
+def parse_kuka(line, received):
+    """Parse a line from the KUKA-RSI server.
+
+    The line is a JSON object with the actual cartesian pose in
+    Rob/RIst/@X..@C and the age of the data in microseconds in
+    Time/differential, which is used to date the sample.
+
+    Args:
+        line (bytes): One line, without the delimiter
+        received (float): The time the line arrived
+
+    Returns: A tuple, (float, the time of the sample, list of float, the
+        fields)
+
+    Raises:
+        ValueError: The line could not be parsed
+    """
+    try:
+        data = json.loads(line.decode('utf-8'))
+        pose = [float(data['Rob']['RIst']['@' + axis])
+                for axis in ['X', 'Y', 'Z', 'A', 'B', 'C']]
+        age = 1e-6 * float(data['Time']['differential'])
+    except (KeyError, TypeError) as e:
+        raise ValueError('missing field {}'.format(e))
+    return received - age, pose
+
+
+class Stream(object):
+    """A line-based network stream which answers each request with a line.
+
+    Data is received straight into a preallocated chunk and collected in a
+    reusable buffer, which is only ever trimmed from the front, until whole
+    lines are available.
+
+    Attributes:
+        name: A string, the name of the stream
+        address: A tuple, (host, port) of the server
+        fields: A list of the names of the numbers parsed from each line
+        requests: An int, the number of requests sent
+        lines: An int, the number of complete lines received
+        errors: An int, the number of lines which could not be parsed
+    """
+    def __init__(self, name, address, request, fields, parse,
+                 buffer_size=4096, delimiter=b'\n'):
+        """Set up a stream, call :py:meth:`connect` to open it.
+
+        Args:
+            name (str): The name of the stream
+            address (tuple): (host, port) of the server
+            request (str): The string sent to ask for a line, a newline is
+                           appended. None if the server sends unprompted.
+            fields (list of str): The names of the numbers in each sample
+            parse (function): Called with a line and the time it arrived,
+                              returns (time, values) or raises ValueError
+            buffer_size (int): The most bytes to receive at once
+            delimiter (bytes): The end of each line
+        """
+        self.name = name
+        self.address = address
+        self.fields = list(fields)
+        self.parse = parse
+        self.delimiter = delimiter
+        self.requests = 0
+        self.lines = 0
+        self.errors = 0
+        self.__request = (None if request is None else
+                          '{}\n'.format(request).encode('ascii'))
+        self.__chunk = bytearray(buffer_size)
+        self.__view = memoryview(self.__chunk)
+        self.__buffer = bytearray()
+        self.__socket = None
+
+    def connect(self, timeout=5.0):
+        """Connect to the server.
+
+        Args:
+            timeout (float): How long to wait for the connection
+
+        Raises:
+            RuntimeError: The server could not be reached
+        """
+        try:
+            self.__socket = socket.create_connection(self.address, timeout)
+        except socket.error as e:
+            raise RuntimeError(
+                '[{}] unable to connect to {}:{} ({}), check that the server '
+                'is running'.format(self.name, self.address[0],
+                                    self.address[1], e))
+        self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.__socket.setblocking(False)
+        print('[{}] connected'.format(self.name))
+
+    def fileno(self):
+        """The file descriptor of the socket, so that streams can be passed
+        straight to select."""
+        return self.__socket.fileno()
+
+    def request(self):
+        """Ask the server for the next line."""
+        if self.__request is not None:
+            self.send(self.__request)
+            self.requests += 1
+
+    def send(self, data):
+        """Send data to the server, waiting for room to send it all.
+
+        Args:
+            data (bytes): The data to send
+        """
+        view = memoryview(data)
+        while len(view):
+            try:
+                view = view[self.__socket.send(view):]
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                select.select([], [self.__socket], [], 1.0)
+
+    def read(self):
+        """Receive whatever data is waiting and parse any complete lines.
+
+        Returns: A list of (time, values) tuples, one for each complete line
+            which could be parsed
+
+        Raises:
+            RuntimeError: The server closed the connection
+        """
+        received = clock()
+        try:
+            size = self.__socket.recv_into(self.__chunk)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise
+        if size == 0:
+            raise RuntimeError('[{}] the server closed the connection'.format(
+                self.name))
+        self.__buffer += self.__view[:size]
+
+        samples = []
+        start = 0
+        end = self.__buffer.find(self.delimiter)
+        while end != -1:
+            line = bytes(self.__buffer[start:end])
+            start = end + len(self.delimiter)
+            end = self.__buffer.find(self.delimiter, start)
+            if not line.strip():
+                continue
+            self.lines += 1
+            try:
+                samples.append(self.parse(line, received))
+            except ValueError as e:
+                self.errors += 1
+                print('[{}] could not parse {!r}: {}'.format(self.name, line,
+                                                              e))
+        del self.__buffer[:start]
+        return samples
+
+    def close(self):
+        """Close the connection."""
+        if self.__socket is not None:
+            try:
+                self.__socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.__socket.close()
+            self.__socket = None
+            print('[{}] closed'.format(self.name))
+
+
+class Recorder(object):
+    """Polls several streams concurrently and logs their samples.
+
+    Attributes:
+        streams: A list of the Streams being recorded
+        counts: A dict of the number of samples recorded from each stream
+        timeout: A float, the time in seconds after which an unanswered
+                 stream is asked again
+    """
+    def __init__(self, streams, log, timeout=1.0):
+        """Set up a recorder.
+
+        Args:
+            streams (list of Stream): The connected streams
+            log (StreamLog): The log to write samples to
+            timeout (float): The time in seconds after which an unanswered
+                             stream is asked again
+        """
+        self.streams = streams
+        self.timeout = timeout
+        self.counts = dict((stream.name, 0) for stream in streams)
+        self.__log = log
+        self.__started = None
+        self.__elapsed = 0
+
+    def run(self, duration=None):
+        """Record until the duration has passed.
+
+        Args:
+            duration (float): How long to record for in seconds, None for
+                              until interrupted
+        """
+        self.__started = clock()
+        end = None if duration is None else self.__started + duration
+        asked = {}
+        try:
+            for index, stream in enumerate(self.streams):
+                stream.request()
+                asked[index] = clock()
+            while end is None or clock() < end:
+                wait = self.timeout
+                if end is not None:
+                    wait = max(0, min(wait, end - clock()))
+                ready, _, _ = select.select(self.streams, [], [], wait)
+                for stream in ready:
+                    index = self.streams.index(stream)
+                    lines = stream.lines
+                    samples = stream.read()
+                    if stream.lines > lines:
+                        stream.request()
+                        asked[index] = clock()
+                    for sample_time, values in samples:
+                        self.__log.append(index, sample_time, values)
+                    self.counts[stream.name] += len(samples)
+                now = clock()
+                for index, stream in enumerate(self.streams):
+                    if now - asked[index] > self.timeout:
+                        print('[{}] no answer, asking again'.format(
+                            stream.name))
+                        stream.request()
+                        asked[index] = now
+        finally:
+            self.__elapsed = clock() - self.__started
+
+    def rates(self):
+        """The average sample rate of each stream over the last run.
+
+        Returns: A dict of the rate in Hz of each stream
+        """
+        return dict((name, count / self.__elapsed if self.__elapsed else 0.0)
+                    for name, count in self.counts.items())
+
+
+class StreamLog(object):
+    """A binary log of timestamped samples from several streams.
+
+    Samples are collected in memory and written a block at a time. The log
+    supports use by the with statement, ex::
+
+        with StreamLog('run.streams', streams) as log:
+            log.append(0, clock(), values)
+    """
+    def __init__(self, file_name, streams, block=256):
+        """Create a log and write its header.
+
+        Args:
+            file_name (str): The log file, replaced if it exists
+            streams (list of Stream): The streams which will be logged, only
+                                      their names and fields are used
+            block (int): The number of samples to collect before writing
+        """
+        self.file_name = file_name
+        self.block = block
+        self.__pending = [[] for _ in streams]
+        self.__count = 0
+        self.__file = open(file_name, 'wb')
+        header = {"time": str(datetime.datetime.now()),
+                  "wall clock": time.time(),
+                  "clock": clock(),
+                  "streams": [{"name": stream.name, "fields": stream.fields}
+                              for stream in streams]}
+        self.__file.write(MAGIC)
+        self.__file.write(json.dumps(header).encode('utf-8') + b'\n')
+        self.__file.flush()
+
+    def append(self, stream, sample_time, values):
+        """Add a sample, writing a block once enough are collected.
+
+        Args:
+            stream (int): The index of the stream the sample is from
+            sample_time (float): The time of the sample
+            values (list of float): The fields of the sample
+        """
+        self.__pending[stream].append([sample_time] + list(values))
+        self.__count += 1
+        if self.__count >= self.block:
+            self.flush()
+
+    def flush(self):
+        """Write every collected sample to the log."""
+        for index, rows in enumerate(self.__pending):
+            if rows:
+                self.__file.write(BLOCK_HEADER.pack(index, len(rows)))
+                self.__file.write(
+                    np.asarray(rows, dtype='<f8').tobytes())
+                self.__pending[index] = []
+        self.__file.flush()
+        self.__count = 0
+
+    def close(self):
+        """Write any remaining samples and close the log."""
+        if not self.__file.closed:
+            self.flush()
+            self.__file.close()
+
+    def __enter__(self):
+        """Enters the log from a with statement"""
+        return self
+
+    def __exit__(self, *_):
+        """Exits at the end of a context manager statement by closing."""
+        self.close()
+
+
+def read_log(file_name):
+    """Read a stream log.
+
+    Args:
+        file_name (str): The log file
+
+    Returns: A tuple, (dict, the header, dict, for each stream name a dict
+        with 'fields', the list of field names, 'time', the n array of sample
+        times, and 'values', the nxm array of samples)
+
+    Raises:
+        ValueError: The file is not a stream log
+    """
+    with open(file_name, 'rb') as log_file:
+        data = log_file.read()
+    if not data.startswith(MAGIC):
+        raise ValueError('{} is not a stream log'.format(file_name))
+    header_end = data.index(b'\n', len(MAGIC))
+    header = json.loads(data[len(MAGIC):header_end].decode('utf-8'))
+    widths = [len(stream['fields']) + 1 for stream in header['streams']]
+    blocks = [[] for _ in widths]
+
+    position = header_end + 1
+    while position + BLOCK_HEADER.size <= len(data):
+        index, rows = BLOCK_HEADER.unpack_from(data, position)
+        position += BLOCK_HEADER.size
+        size = rows * widths[index] * 8
+        if position + size > len(data):
+            print('ignoring a partially written block')
+            break
+        blocks[index].append(np.frombuffer(
+            data, dtype='<f8', count=rows * widths[index],
+            offset=position).reshape(rows, widths[index]))
+        position += size
+
+    streams = {}
+    for stream, width, parts in zip(header['streams'], widths, blocks):
+        samples = (np.concatenate(parts) if parts else
+                   np.empty((0, width)))
+        samples = samples[np.argsort(samples[:, 0], kind='mergesort')]
+        streams[stream['name']] = {"fields": stream['fields'],
+                                   "time": samples[:, 0],
+                                   "values": samples[:, 1:]}
+    return header, streams
+
+
+if __name__ == '__main__':
+    main()
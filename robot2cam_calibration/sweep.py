@@ -0,0 +1,275 @@
+"""A file to capture frames while a robot sweeps continuously through points.
+
+Instead of stopping and settling at every point, the robot is sent through all
+of the points, blending from one into the next, while frames are captured
+continuously. Each frame is paired with the robot pose at its capture time
+(see :py:mod:`synchronize`) and only frames taken while the tool was moving
+slowly (low motion blur) and with good timestamp alignment are kept. Each
+frame is assigned to the point nearest, in joint space, to where the robot
+was when it was captured, and the best frame is kept for every point.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import collections
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import robot2cam_calibration.rotations as rotations
+
+Candidate = collections.namedtuple('Candidate', ['frame', 'pose', 'skew',
+                                                 'speed', 'angular_speed'])
+
+
+def pose_velocity(pose_stream, at_time, step=0.008):
+    """Estimate the tool speed at a given time from a pose stream.
+
+    Args:
+        pose_stream (synchronize.PoseStream): The robot pose stream
+        at_time (float): The time at which to estimate the speed
+        step (float): Half of the time window (in seconds) over which to take
+            the central difference. Should be about the robot's sample period.
+
+    Returns: A tuple, (float, linear speed in pose units per second, float,
+        angular speed in radians per second)
+    """
+    poses, _ = pose_stream.pose_at([at_time - step, at_time + step])
+    speed = np.linalg.norm(poses[1, :3] - poses[0, :3]) / (2 * step)
+    start = rotations.rotvec2quat(poses[0, 3:])
+    start[1:] *= -1  # conjugate
+    delta = rotations.quat_multiply(start, rotations.rotvec2quat(poses[1, 3:]))
+    angular_speed = (np.linalg.norm(rotations.quat2rotvec(delta)) /
+                     (2 * step))
+    return float(speed), float(angular_speed)
+
+
+def sharpness(image):
+    """Measure the sharpness of an image as the variance of the laplacian.
+
+    Args:
+        image (numpy.ndarray): The image
+
+    Returns: Float, larger is sharper
+    """
+    return float(cv2.Laplacian(image, cv2.CV_64F).var())
+
+
+class SweepCollector(object):
+    """Captures frames on a background thread and keeps the best per point.
+
+    The robot driver sets `segment` to the index of the latest point the
+    robot was sent to. Every frame is paired with the robot pose and joint
+    positions at its capture time, frames captured too fast or with too much
+    timing skew are rejected, and each remaining frame is assigned to the
+    nearest point (the largest joint difference, as for the blend) of those
+    the robot has been sent to, or dropped if the robot was nearer to where
+    it started. The slowest frame is kept for each point. Only one frame per
+    point is held in memory.
+
+    Attributes:
+        cam: The camera.Camera to capture frames from
+        pose_stream: The synchronize.PoseStream of robot poses
+        joint_stream: The synchronize.PoseStream of robot joint positions
+        joint_points: An nx6 numpy.ndarray of the joint positions of the
+            points (rad)
+        start: A 6 element numpy.ndarray, the joint positions the robot
+            started from (rad), or None
+        segment: An int, the index of the latest point moved to, or None to
+            ignore frames
+        best: A dictionary of point index to the best :py:class:`Candidate`
+        rejected: An int, the number of frames which failed the thresholds
+        processed: A float, the capture time of the last frame considered
+    """
+    def __init__(self, cam, pose_stream, joint_stream, joint_points,
+                 start=None, max_skew=0.004, max_speed=0.005,
+                 max_angular_speed=0.02, min_sharpness=None):
+        """Start collecting frames.
+
+        Args:
+            cam (camera.Camera): The camera to capture frames from
+            pose_stream (synchronize.PoseStream): The robot pose stream
+            joint_stream (synchronize.PoseStream): The robot joint position
+                stream, see :py:meth:`robots.Robot.joint_stream`
+            joint_points (list of lists): The joint positions of the points
+                (rad)
+            start (6 member list): The joint positions the robot starts from
+                (rad), frames nearer to them than to any point are dropped
+            max_skew (float): The maximum time (s) between a frame and the
+                nearest robot sample while moving
+            max_speed (float): The maximum linear tool speed, in pose units
+                per second
+            max_angular_speed (float): The maximum angular tool speed in
+                radians per second
+            min_sharpness (float): If given, the minimum variance of the
+                laplacian of a frame, see :py:func:`sharpness`
+        """
+        self.cam = cam
+        self.pose_stream = pose_stream
+        self.joint_stream = joint_stream
+        self.joint_points = np.asarray(joint_points, dtype=float)
+        self.start = None if start is None else np.asarray(start, dtype=float)
+        self.max_skew = max_skew
+        self.max_speed = max_speed
+        self.max_angular_speed = max_angular_speed
+        self.min_sharpness = min_sharpness
+        self.segment = None
+        self.best = {}
+        self.rejected = 0
+        self.processed = None
+        self.lock = threading.Lock()
+
+        self.run = True
+        self.__collection_thread = threading.Thread(group=None,
+                                                    target=self.collect,
+                                                    name='sweep_thread',
+                                                    args=(),
+                                                    kwargs={})
+        self.__collection_thread.daemon = True
+        self.__collection_thread.start()
+
+    def nearest(self, joints, segment):
+        """Find the point nearest to joint positions.
+
+        Args:
+            joints (6 member list): The joint positions (rad)
+            segment (int): The index of the latest point moved to, only
+                points up to it are considered
+
+        Returns: int, the index of the nearest point, or None if the start is
+            nearer
+        """
+        joints = np.asarray(joints, dtype=float)
+        distances = np.max(np.abs(self.joint_points[:segment + 1] - joints),
+                           axis=1)
+        point = int(np.argmin(distances))
+        if (self.start is not None and
+                np.max(np.abs(self.start - joints)) < distances[point]):
+            return None
+        return point
+
+    def collect(self):
+        """Capture, pair and score frames until stopped."""
+        last_time = None
+        while self.run:
+            try:
+                frame = self.cam.capture_frame(after=last_time, rectify=False)
+            except RuntimeError:
+                continue
+            last_time = frame.time
+            segment = self.segment
+            if segment is None:
+                continue
+            try:
+                poses, skews = self.pose_stream.pose_at(frame.time)
+                joints, _ = self.joint_stream.pose_at(frame.time)
+                speed, angular_speed = pose_velocity(self.pose_stream,
+                                                     frame.time)
+            except (RuntimeError, ValueError):
+                self.rejected += 1
+                continue
+            finally:
+                self.processed = frame.time
+
+            if (skews[0] > self.max_skew or speed > self.max_speed or
+                    angular_speed > self.max_angular_speed):
+                self.rejected += 1
+                continue
+
+            point = self.nearest(joints[0], segment)
+            if point is None:
+                continue
+            with self.lock:
+                current = self.best.get(point)
+            if current is not None and current.speed <= speed:
+                continue
+            if (self.min_sharpness is not None and
+                    sharpness(frame.image) < self.min_sharpness):
+                self.rejected += 1
+                continue
+            with self.lock:
+                self.best[point] = Candidate(frame, poses[0].tolist(),
+                                             float(skews[0]), speed,
+                                             angular_speed)
+
+    def stop(self):
+        """Stop the collection thread."""
+        self.run = False
+        if self.__collection_thread.is_alive():
+            self.__collection_thread.join()
+
+    def __enter__(self):
+        """Enters the collector from a with statement"""
+        return self
+
+    def __exit__(self, *_):
+        """Exits at the end of a context manager statement by stopping."""
+        self.stop()
+
+
+def sweep(robot, cam, pose_stream, joint_points, velocity=0.2, blend=0.02,
+          **thresholds):
+    """Sweep a robot through points without stopping, capturing frames.
+
+    The robot is sent to each point in turn and is sent on to the next point
+    as soon as it is within `blend` of the current one, so it never comes to
+    a full stop until the end. Frames are collected by a
+    :py:class:`SweepCollector`, which keeps the best frame nearest to each
+    point in joint space.
+
+    Args:
+        robot (robots.Robot): The robot to move
+        cam (camera.Camera): The camera to capture frames from
+        pose_stream (synchronize.PoseStream): The robot pose stream
+        joint_points (list of lists): The joint positions to move through
+        velocity (float): The joint velocity in rad/s
+        blend (float): How close (rad) the robot must get to a point before
+            moving on to the next one
+        **thresholds: Passed on to :py:class:`SweepCollector`
+
+    Returns: A list with the best :py:class:`Candidate` for each point, or
+        None where no frame met the thresholds
+    """
+    if not joint_points:
+        return []
+    with robot.joint_stream() as joint_stream, \
+            SweepCollector(cam, pose_stream, joint_stream, joint_points,
+                           start=robot.joints(), **thresholds) as collector:
+        for index, joints in enumerate(joint_points):
+            robot.move_to_joint(joints, velocity, blend)
+            collector.segment = index
+            print('Sweeping toward point: {}'.format(index))
+
+        while not (robot.at_goal() and robot.is_stopped()):
+            time.sleep(.01)
+        # make sure a frame from after the final stop has been considered
+        stopped_time = pose_stream.latest().time
+        deadline = stopped_time + 1
+        while (collector.processed is None or
+               collector.processed < stopped_time) and \
+                pose_stream.latest().time < deadline:
+            time.sleep(.01)
+    print('rejected {} frames'.format(collector.rejected))
+    return [collector.best.get(index) for index in range(len(joint_points))]
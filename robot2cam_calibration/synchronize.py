@@ -0,0 +1,298 @@
+"""A file to timestamp robot poses and pair them with camera frames.
+
+Rather than waiting for the robot to settle and hoping that the pose read back
+from the robot matches the image, every robot pose sample is stamped with the
+time it was received and every frame is stamped with the time it was
+captured (see :py:class:`camera.Frame`). The pose at the time of the image is
+then interpolated (linear for position, SLERP for rotation) and the timing
+skew between the two streams is recorded.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import collections
+import threading
+import time
+
+import numpy as np
+
+import robot2cam_calibration.rotations as rotations
+
+# A monotonic clock shared by the camera and robot streams. Python 2 has no
+# monotonic clock, so fall back on wall time there.
+clock = getattr(time, 'monotonic', time.time)
+
+PoseSample = collections.namedtuple('PoseSample', ['pose', 'time'])
+
+
+def interpolate_poses(sample_times, sample_poses, times):
+    """Interpolate a timestamped pose stream at arbitrary times.
+
+    Position is linearly interpolated and rotation is interpolated with SLERP.
+    Times outside of the sampled range are clamped to the first or last pose.
+
+    Args:
+        sample_times (n array): Increasing times at which poses were sampled
+        sample_poses (nx6 array): The sampled poses, x,y,z,axis-angle
+        times (m array): The times at which to find the pose
+
+    Returns: mx6 np.ndarray of the interpolated poses
+    """
+    sample_times = np.asarray(sample_times, dtype=float)
+    sample_poses = np.asarray(sample_poses, dtype=float)
+    times = np.atleast_1d(np.asarray(times, dtype=float))
+    if len(sample_times) == 1:
+        return np.repeat(sample_poses, len(times), axis=0)
+
+    after = np.clip(np.searchsorted(sample_times, times, side='right'),
+                    1, len(sample_times) - 1)
+    before = after - 1
+    span = sample_times[after] - sample_times[before]
+    fraction = np.clip((times - sample_times[before]) /
+                       np.where(span > 0, span, 1), 0, 1)
+
+    result = np.empty((len(times), 6))
+    result[:, :3] = (sample_poses[before, :3] * (1 - fraction[:, None]) +
+                     sample_poses[after, :3] * fraction[:, None])
+    result[:, 3:] = rotations.quat2rotvec(rotations.slerp(
+        rotations.rotvec2quat(sample_poses[before, 3:]),
+        rotations.rotvec2quat(sample_poses[after, 3:]),
+        fraction))
+    return result
+
+
+def interpolate_joints(sample_times, sample_joints, times):
+    """Interpolate a timestamped joint position stream at arbitrary times.
+
+    Every joint is linearly interpolated. Times outside of the sampled range
+    are clamped to the first or last joint positions.
+
+    Args:
+        sample_times (n array): Increasing times at which joints were sampled
+        sample_joints (nx6 array): The sampled joint positions (rad)
+        times (m array): The times at which to find the joint positions
+
+    Returns: mx6 np.ndarray of the interpolated joint positions
+    """
+    sample_times = np.asarray(sample_times, dtype=float)
+    sample_joints = np.asarray(sample_joints, dtype=float)
+    times = np.atleast_1d(np.asarray(times, dtype=float))
+    return np.column_stack([np.interp(times, sample_times, joint)
+                            for joint in sample_joints.T])
+
+
+class PoseStream(object):
+    """Records robot poses on a background thread, stamping each on receipt.
+
+    A new sample is only stored when the pose changes. When the robot starts
+    moving after holding still for longer than `hold`, the held pose is stored
+    again at the last time it was confirmed so that interpolation does not
+    smear the start of the motion back over the time the robot was stopped.
+    Joint positions can be recorded the same way by passing
+    :py:func:`interpolate_joints` as `interpolate`.
+
+    Attributes:
+        read_pose: A callable returning the current robot pose as a 6 element
+            list, x,y,z,axis-angle
+        interpolate: A callable interpolating the samples at other times, see
+            :py:func:`interpolate_poses`
+        period: A float, the polling period in seconds
+        hold: A float, how long (s) the pose must be unchanged to be
+            considered held rather than between robot updates
+        samples: A collections.deque of :py:class:`PoseSample`
+        confirmed: A float, the latest time at which the most recent pose was
+            known to be current
+        lock: A threading.Lock protecting the samples
+    """
+    def __init__(self, read_pose, period=0.002, hold=0.05, history=60000,
+                 interpolate=interpolate_poses):
+        """Start recording poses.
+
+        Args:
+            read_pose (callable): Returns the current robot pose
+            period (float): The polling period in seconds. This should be
+                faster than the rate at which the robot publishes its pose.
+            hold (float): How long (s) the pose must be unchanged to be
+                considered held. This should be several times the period at
+                which the robot publishes its pose.
+            history (int): The maximum number of samples to keep
+            interpolate (callable): Interpolates the samples at other times,
+                taking the sample times, the sample poses and the times
+        """
+        self.read_pose = read_pose
+        self.interpolate = interpolate
+        self.period = period
+        self.hold = hold
+        self.samples = collections.deque(maxlen=history)
+        self.confirmed = None
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+
+        self.run = True
+        self.__recording_thread = threading.Thread(group=None,
+                                                   target=self.record,
+                                                   name='pose_stream_thread',
+                                                   args=(),
+                                                   kwargs={})
+        self.__recording_thread.daemon = True
+        self.__recording_thread.start()
+
+    def record(self):
+        """Poll the robot, storing samples whenever the pose changes."""
+        last_pose = None
+        while self.run:
+            pose = list(self.read_pose())
+            now = clock()
+            with self.condition:
+                if pose != last_pose:
+                    if (last_pose is not None and self.confirmed -
+                            self.samples[-1].time > self.hold):
+                        self.samples.append(PoseSample(last_pose,
+                                                       self.confirmed))
+                    self.samples.append(PoseSample(pose, now))
+                    last_pose = pose
+                self.confirmed = now
+                self.condition.notify_all()
+            time.sleep(self.period)
+
+    def stop(self):
+        """Stop the recording thread."""
+        self.run = False
+        if self.__recording_thread.is_alive():
+            self.__recording_thread.join()
+
+    def latest(self):
+        """Return the most recent pose sample.
+
+        Returns: :py:class:`PoseSample` of the latest pose, stamped with the
+            last time it was confirmed.
+
+        Raises:
+            RuntimeError: No poses have been received yet
+        """
+        with self.lock:
+            if not self.samples:
+                raise RuntimeError('no robot poses have been received')
+            return PoseSample(self.samples[-1].pose, self.confirmed)
+
+    def pose_at(self, times, timeout=1.0):
+        """Find the robot pose at the given times.
+
+        Blocks until the stream has been confirmed past the latest requested
+        time.
+
+        Args:
+            times (float or list of floats): The times at which to find poses,
+                using :py:data:`clock`
+            timeout (float): Maximum time to wait for the stream to catch up
+
+        Returns: A tuple, (mx6 np.ndarray of the interpolated poses, m element
+            np.ndarray of the skew: the time in seconds from each requested
+            time to the nearest actual sample while the robot was moving)
+
+        Raises:
+            RuntimeError: The stream did not cover the requested times before
+                the timeout
+            ValueError: A requested time is older than the recorded history
+        """
+        times = np.atleast_1d(np.asarray(times, dtype=float))
+        deadline = clock() + timeout
+        with self.condition:
+            while self.confirmed is None or self.confirmed < times.max():
+                remaining = deadline - clock()
+                if remaining <= 0:
+                    raise RuntimeError('robot pose stream is not keeping up')
+                self.condition.wait(remaining)
+            sample_times = np.array([s.time for s in self.samples] +
+                                    [self.confirmed])
+            sample_poses = np.array([s.pose for s in self.samples] +
+                                    [self.samples[-1].pose])
+        if times.min() < sample_times[0]:
+            raise ValueError('requested a pose older than the pose history')
+
+        # The skew is the time to the nearest sample, unless the robot was
+        # holding still across the bracketing samples, in which case the pose
+        # is known exactly.
+        after = np.clip(np.searchsorted(sample_times, times, side='right'),
+                        1, len(sample_times) - 1)
+        before = after - 1
+        skew = np.minimum(np.abs(times - sample_times[before]),
+                          np.abs(sample_times[after] - times))
+        held = np.all(sample_poses[before] == sample_poses[after], axis=1)
+        skew[held] = 0
+        return self.interpolate(sample_times, sample_poses, times), skew
+
+    def __enter__(self):
+        """Enters the pose stream from a with statement"""
+        return self
+
+    def __exit__(self, *_):
+        """Exits at the end of a context manager statement by stopping."""
+        self.stop()
+
+
+class Synchronizer(object):
+    """Pairs timestamped camera frames with the robot pose at the frame time.
+
+    Attributes:
+        pose_stream: The :py:class:`PoseStream` to draw poses from
+        camera_latency: A float, seconds between exposure and the frame
+            timestamp, which is removed before looking up the pose
+        skews: A list of the measured skew (seconds to the nearest robot
+            sample) for every pair produced
+    """
+    def __init__(self, pose_stream, camera_latency=0.0):
+        """Create a synchronizer.
+
+        Args:
+            pose_stream (PoseStream): The stream of robot poses
+            camera_latency (float): Seconds between exposure and timestamp
+        """
+        self.pose_stream = pose_stream
+        self.camera_latency = camera_latency
+        self.skews = []
+
+    def pair(self, frame_time):
+        """Find the robot pose at the time a frame was captured.
+
+        Args:
+            frame_time (float): The capture time of the frame
+
+        Returns: A tuple, (6 member list, the interpolated pose, float, the
+            skew in seconds to the nearest robot sample)
+        """
+        poses, skews = self.pose_stream.pose_at(
+            frame_time - self.camera_latency)
+        self.skews.append(float(skews[0]))
+        return poses[0].tolist(), float(skews[0])
+
+    def skew_statistics(self):
+        """Summarize the measured timing skew.
+
+        Returns: A dictionary with the number of pairs and the mean and max
+            skew in seconds
+        """
+        skews = np.array(self.skews)
+        return {"pairs": len(skews),
+                "mean skew": float(skews.mean()) if len(skews) else None,
+                "max skew": float(skews.max()) if len(skews) else None}
@@ -0,0 +1,532 @@
+"""Detectors for the calibration targets which can be attached to a robot.
+
+Every target implements the :py:class:`Target` interface: it finds the
+features of the target in an image and returns their image points along with
+the matching points in the target's own coordinate system (x and y in the
+plane of the target, z into it, in the same units as the target spacing).
+From these the pose of the target relative to the camera is found.
+
+Targets made of markers (:py:class:`Charuco` and :py:class:`MarkerGrid`) can
+be located when they are partially occluded or out of frame and are found
+much faster than a full chessboard. They require the OpenCV aruco module
+(part of opencv-contrib before OpenCV 4.7).
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import collections
+
+import cv2
+import numpy as np
+
+import robot2cam_calibration.calibrations as calibrations
+
+criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+Detection = collections.namedtuple('Detection', ['image_points',
+                                                 'object_points', 'pose'])
+
+
+class Target(object):
+    """The interface for calibration targets.
+
+    Subclasses implement :py:meth:`detect` and may override :py:meth:`draw`.
+
+    Attributes:
+        object_points: An nx3 numpy.ndarray of every feature of the target in
+            the target's coordinate system
+        min_points: An int, the fewest features needed to locate the target
+    """
+    min_points = 4
+
+    def detect(self, image, roi=None):
+        """Find the features of the target in an image.
+
+        Args:
+            image (numpy.ndarray): A rectified grayscale image
+            roi (tuple): The region of the image (x0, y0, x1, y1) to search
+                first, or None to only search the full image
+
+        Returns: A tuple, (mx1x2 numpy.ndarray of the image points, mx3
+            numpy.ndarray of the matching object points), or None if the
+            target was not found
+        """
+        raise NotImplementedError('detect must be implemented by a subclass')
+
+    def locate(self, image, intrinsic, distortion, roi=None):
+        """Find the target in an image and compute its pose.
+
+        Args:
+            image (numpy.ndarray): A rectified grayscale image
+            intrinsic (numpy.ndarray): The camera intrinsic matrix
+            distortion (numpy.ndarray): The camera distortion parameters
+            roi (tuple): The region of the image (x0, y0, x1, y1) to search
+                first, or None to only search the full image
+
+        Returns: :py:class:`Detection` with the pose of the target as a 6
+            member list, x,y,z,axis-angle
+
+        Raises:
+            RuntimeError: Could not find the target
+        """
+        found = self.detect(image, roi)
+        if found is None or len(found[0]) < self.min_points:
+            raise RuntimeError('unable to find grid')
+        image_points, object_points = found
+        # OpenCV 2 vs 3 (3 also returns whether it succeeded first)
+        pnp_result = cv2.solvePnPRansac(object_points, image_points,
+                                        intrinsic, distortion)
+        rvecs, tvecs = pnp_result[-3], pnp_result[-2]
+        return Detection(image_points, object_points,
+                         np.concatenate((tvecs, rvecs),
+                                        axis=0).ravel().tolist())
+
+    def draw(self, image, detection):
+        """Draw the features found on an image.
+
+        Args:
+            image (numpy.ndarray): A color image to draw on
+            detection (Detection): The detection to draw
+
+        Returns: numpy.ndarray of the image with the features drawn on it
+        """
+        for point in np.rint(detection.image_points).astype(int):
+            temp = cv2.circle(image, tuple(point.ravel()), 6, (0, 0, 255), 2)
+            # OpenCV 2 vs 3
+            if temp is not None:
+                image = temp
+        return image
+
+
+class Chessboard(Target):
+    """An asymmetric chessboard, found by its interior corners.
+
+    Attributes:
+        rows: An int, the number of rows of interior corners
+        cols: An int, the number of columns of interior corners
+        space: A float, the spacing of the corners
+        detection_size: An int, the largest image dimension (pixels) at which
+            to start searching for corners, see :py:func:`pyramid_corners`
+        refine_window: An int, the half size of the window in which corners
+            are refined at full resolution
+    """
+    def __init__(self, rows, cols, space, detection_size=1280,
+                 refine_window=11):
+        """Define the chessboard.
+
+        Args:
+            rows (int): The number of rows of interior corners on the grid
+            cols (int): The number of columns of interior corners on the grid
+            space (float): The spacing of corners on the grid
+            detection_size (int): The largest image dimension (pixels) at
+                which to start searching for corners, see
+                :py:func:`pyramid_corners`. None to only search at full
+                resolution.
+            refine_window (int): The half size of the window in which corners
+                are refined at full resolution. This must cover the error
+                from downsampling but should be less than half the size of a
+                grid square in the image.
+
+        Raises:
+            ValueError: The number of rows and cols was the same
+        """
+        if rows == cols:
+            raise ValueError('The grid mus be asymmetric. Rows cannot equal '
+                             'Columns')
+        self.rows = rows
+        self.cols = cols
+        self.space = space
+        self.detection_size = detection_size
+        self.refine_window = refine_window
+        self.object_points = calibrations.chessboard_points(rows, cols,
+                                                            space)
+
+    def detect(self, image, roi=None):
+        """Find the corners of the chessboard, see :py:meth:`Target.detect`"""
+        corners = find_corners(image, (self.rows, self.cols), roi,
+                               self.detection_size)
+        if corners is None:
+            return None
+        return (refine_corners(image, corners, self.refine_window),
+                self.object_points)
+
+    def draw(self, image, detection):
+        """Draw the corners found on an image, see :py:meth:`Target.draw`"""
+        temp = cv2.drawChessboardCorners(image, (self.cols, self.rows),
+                                         detection.image_points, True)
+        # OpenCV 2 vs 3
+        return image if temp is None else temp
+
+
+class CircleGrid(Target):
+    """A grid of circles.
+
+    In an asymmetric grid every other row is offset by half of the spacing of
+    the circles within a row, which removes the 180 degree ambiguity of a
+    symmetric grid.
+
+    Attributes:
+        rows: An int, the number of circles in each row
+        cols: An int, the number of rows of circles
+        space: A float, the spacing of the circles. In an asymmetric grid,
+            this is the distance between rows, and circles within a row are
+            twice this apart.
+        asymmetric: A boolean, whether the grid is asymmetric
+    """
+    def __init__(self, rows, cols, space, asymmetric=False):
+        """Define the circle grid.
+
+        Args:
+            rows (int): The number of circles in each row
+            cols (int): The number of rows of circles
+            space (float): The spacing of the circles
+            asymmetric (bool): Whether alternate rows are offset
+
+        Raises:
+            ValueError: A symmetric grid has the same number of rows and cols
+        """
+        if rows == cols and not asymmetric:
+            raise ValueError('A symmetric circle grid must have different '
+                             'numbers of rows and columns')
+        self.rows = rows
+        self.cols = cols
+        self.space = space
+        self.asymmetric = asymmetric
+        index = np.mgrid[0:rows, 0:cols].T.reshape(-1, 2)
+        self.object_points = np.zeros((cols * rows, 3), np.float32)
+        if asymmetric:
+            self.object_points[:, 0] = (2 * index[:, 0] +
+                                        index[:, 1] % 2) * space
+        else:
+            self.object_points[:, 0] = index[:, 0] * space
+        self.object_points[:, 1] = index[:, 1] * space
+
+    def detect(self, image, roi=None):
+        """Find the circle centers, see :py:meth:`Target.detect`"""
+        flags = (cv2.CALIB_CB_ASYMMETRIC_GRID if self.asymmetric
+                 else cv2.CALIB_CB_SYMMETRIC_GRID)
+        for x0, y0, x1, y1 in search_regions(image, roi):
+            found, centers = cv2.findCirclesGrid(image[y0:y1, x0:x1],
+                                                 (self.rows, self.cols),
+                                                 flags=flags)
+            if found:
+                return (centers.astype(np.float32) + np.float32([x0, y0]),
+                        self.object_points)
+        return None
+
+    def draw(self, image, detection):
+        """Draw the centers found on an image, see :py:meth:`Target.draw`"""
+        temp = cv2.drawChessboardCorners(image, (self.rows, self.cols),
+                                         detection.image_points, True)
+        # OpenCV 2 vs 3
+        return image if temp is None else temp
+
+
+class Charuco(Target):
+    """A ChArUco board: a chessboard with an ArUco marker in each white square.
+
+    The markers identify the corners, so any corners next to a visible marker
+    can be used even if the rest of the board is hidden.
+
+    Attributes:
+        squares_x: An int, the number of squares along x
+        squares_y: An int, the number of squares along y
+        space: A float, the side length of the squares
+        marker_length: A float, the side length of the markers
+        board: The cv2.aruco CharucoBoard
+    """
+    def __init__(self, squares_x, squares_y, space, marker_length,
+                 dictionary='DICT_4X4_50'):
+        """Define the board.
+
+        Args:
+            squares_x (int): The number of squares along x
+            squares_y (int): The number of squares along y
+            space (float): The side length of the squares
+            marker_length (float): The side length of the markers
+            dictionary (str): The name of the cv2.aruco marker dictionary
+        """
+        aruco = aruco_module()
+        self.squares_x = squares_x
+        self.squares_y = squares_y
+        self.space = space
+        self.marker_length = marker_length
+        self.dictionary = aruco.getPredefinedDictionary(
+            getattr(aruco, dictionary))
+        if hasattr(aruco, 'CharucoDetector'):  # OpenCV >= 4.7
+            self.board = aruco.CharucoBoard((squares_x, squares_y), space,
+                                            marker_length, self.dictionary)
+            self.object_points = np.float32(self.board.getChessboardCorners())
+            self.__detector = aruco.CharucoDetector(self.board)
+        else:
+            self.board = aruco.CharucoBoard_create(squares_x, squares_y,
+                                                   space, marker_length,
+                                                   self.dictionary)
+            self.object_points = np.float32(self.board.chessboardCorners)
+            self.__detector = None
+
+    def detect(self, image, roi=None):
+        """Find the chessboard corners of the board, see
+        :py:meth:`Target.detect`"""
+        for x0, y0, x1, y1 in search_regions(image, roi):
+            region = image[y0:y1, x0:x1]
+            if self.__detector is not None:
+                corners, ids, _, _ = self.__detector.detectBoard(region)
+            else:
+                aruco = aruco_module()
+                markers, marker_ids, _ = aruco.detectMarkers(region,
+                                                             self.dictionary)
+                corners = ids = None
+                if marker_ids is not None and len(marker_ids):
+                    _, corners, ids = aruco.interpolateCornersCharuco(
+                        markers, marker_ids, region, self.board)
+            if ids is not None and len(ids) >= self.min_points:
+                return (corners.astype(np.float32) + np.float32([x0, y0]),
+                        self.object_points[ids.ravel()])
+        return None
+
+
+class MarkerGrid(Target):
+    """A grid of fiducial markers, by default AprilTags.
+
+    Each marker contributes its four corners, so the target can be located
+    from a single visible marker. The markers are numbered from `first_id`
+    along each row (x) in turn.
+
+    Attributes:
+        rows: An int, the number of markers along x
+        cols: An int, the number of markers along y
+        space: A float, the distance between the corners of neighbouring
+            markers
+        marker_length: A float, the side length of the markers
+        first_id: An int, the id of the marker at the origin
+    """
+    def __init__(self, rows, cols, space, marker_length,
+                 dictionary='DICT_APRILTAG_36h11', first_id=0):
+        """Define the marker grid.
+
+        Args:
+            rows (int): The number of markers along x
+            cols (int): The number of markers along y
+            space (float): The distance between the corners of neighbouring
+                markers
+            marker_length (float): The side length of the markers
+            dictionary (str): The name of the cv2.aruco marker dictionary
+            first_id (int): The id of the marker at the origin
+        """
+        aruco = aruco_module()
+        self.rows = rows
+        self.cols = cols
+        self.space = space
+        self.marker_length = marker_length
+        self.first_id = first_id
+        self.dictionary = aruco.getPredefinedDictionary(
+            getattr(aruco, dictionary))
+        if hasattr(aruco, 'ArucoDetector'):  # OpenCV >= 4.7
+            parameters = aruco.DetectorParameters()
+            parameters.cornerRefinementMethod = aruco.CORNER_REFINE_SUBPIX
+            self.__detector = aruco.ArucoDetector(self.dictionary, parameters)
+        else:
+            self.__parameters = aruco.DetectorParameters_create()
+            self.__parameters.cornerRefinementMethod = \
+                aruco.CORNER_REFINE_SUBPIX
+            self.__detector = None
+
+        # The corners of each marker, clockwise from the top left as returned
+        # by the detector
+        index = np.mgrid[0:rows, 0:cols].T.reshape(-1, 2)
+        top_left = index * space
+        offsets = np.array([[0, 0], [1, 0], [1, 1], [0, 1]]) * marker_length
+        self.object_points = np.zeros((rows * cols, 4, 3), np.float32)
+        self.object_points[:, :, :2] = top_left[:, None, :] + offsets
+        self.object_points = self.object_points.reshape(-1, 3)
+
+    def detect(self, image, roi=None):
+        """Find the corners of the markers, see :py:meth:`Target.detect`"""
+        for x0, y0, x1, y1 in search_regions(image, roi):
+            region = image[y0:y1, x0:x1]
+            if self.__detector is not None:
+                markers, ids, _ = self.__detector.detectMarkers(region)
+            else:
+                markers, ids, _ = aruco_module().detectMarkers(
+                    region, self.dictionary, parameters=self.__parameters)
+            if ids is None:
+                continue
+            ids = ids.ravel() - self.first_id
+            keep = (ids >= 0) & (ids < self.rows * self.cols)
+            if not np.any(keep):
+                continue
+            image_points = np.concatenate(
+                [np.reshape(markers[i], (4, 2)) for i in np.flatnonzero(keep)])
+            object_points = self.object_points.reshape(-1, 4, 3)[ids[keep]]
+            return (image_points.reshape(-1, 1, 2).astype(np.float32) +
+                    np.float32([x0, y0]), object_points.reshape(-1, 3))
+        return None
+
+
+# The target names accepted by :py:func:`create`
+TARGETS = ['chessboard', 'circles', 'asymmetric_circles', 'charuco',
+           'apriltag']
+
+
+def create(name, rows, cols, space, marker_length=None, detection_size=1280,
+           refine_window=11):
+    """Create a target from a name and its dimensions.
+
+    Args:
+        name (str): One of :py:data:`TARGETS`
+        rows (int): The number of features along x (corners for a chessboard,
+            circles for a circle grid, squares for a ChArUco board and markers
+            for an AprilTag grid)
+        cols (int): The number of features along y
+        space (float): The spacing of the features
+        marker_length (float): The side length of the markers, required for
+            `charuco` and `apriltag`
+        detection_size (int): For a `chessboard`, the largest image dimension
+            (pixels) at which to start searching for corners, see
+            :py:class:`Chessboard`
+        refine_window (int): For a `chessboard`, the half size of the window
+            in which corners are refined at full resolution
+
+    Returns: :py:class:`Target`
+
+    Raises:
+        ValueError: The target name is unknown or a dimension is missing
+    """
+    if name in ['charuco', 'apriltag'] and marker_length is None:
+        raise ValueError('a marker length is needed for a {} target'.format(
+            name))
+    if name == 'chessboard':
+        return Chessboard(rows, cols, space, detection_size, refine_window)
+    elif name == 'circles':
+        return CircleGrid(rows, cols, space)
+    elif name == 'asymmetric_circles':
+        return CircleGrid(rows, cols, space, asymmetric=True)
+    elif name == 'charuco':
+        return Charuco(rows, cols, space, marker_length)
+    elif name == 'apriltag':
+        return MarkerGrid(rows, cols, space, marker_length)
+    raise ValueError('unknown target: {}, valid options are: {}'.format(
+        name, ', '.join(TARGETS)))
+
+
+def aruco_module():
+    """Get the OpenCV aruco module.
+
+    Returns: The cv2.aruco module
+
+    Raises:
+        ImportError: This OpenCV build does not include aruco
+    """
+    if not hasattr(cv2, 'aruco'):
+        raise ImportError('marker targets require the OpenCV aruco module '
+                          '(opencv-contrib-python)')
+    return cv2.aruco
+
+
+def search_regions(image, roi=None):
+    """The regions of an image to search, the region of interest first.
+
+    Args:
+        image (numpy.ndarray): The image
+        roi (tuple): The region of interest (x0, y0, x1, y1), or None
+
+    Returns: A list of (x0, y0, x1, y1) tuples
+    """
+    full = (0, 0, image.shape[1], image.shape[0])
+    return [full] if roi is None else [tuple(roi), full]
+
+
+def pyramid_corners(image, pattern_size, detection_size=1280):
+    """Find chessboard corners, searching downsampled copies of an image first.
+
+    The image is halved with :py:func:`cv2.pyrDown` until its largest
+    dimension is no more than `detection_size`. The corners are searched for
+    from the smallest image up, stopping at the first level they are found at,
+    and mapped back up to the full resolution image. Searching a small image
+    is much faster and failures there are cheap, but grids whose squares are
+    only a few pixels across at a level will not be found until a finer
+    level. The corners still need to be refined at full resolution (see
+    :py:func:`refine_corners`).
+
+    Args:
+        image (numpy.ndarray): A grayscale image
+        pattern_size (tuple): The number of interior corners (rows, cols)
+        detection_size (int): The largest image dimension at which to start
+            searching, or None to only search at full resolution
+
+    Returns: numpy.ndarray of the corners in full image coordinates, or None
+        if the grid could not be found
+    """
+    pyramid = [image]
+    if detection_size is not None:
+        while max(pyramid[-1].shape[:2]) > detection_size:
+            pyramid.append(cv2.pyrDown(pyramid[-1]))
+    for level in reversed(range(len(pyramid))):
+        found, corners = cv2.findChessboardCorners(
+            pyramid[level], pattern_size,
+            flags=cv2.CALIB_CB_FAST_CHECK + cv2.CALIB_CB_ADAPTIVE_THRESH)
+        if found:
+            # pyrDown keeps the even pixels, so coordinates simply scale
+            return corners * np.float32(2 ** level)
+    return None
+
+
+def find_corners(image, pattern_size, roi=None, detection_size=1280):
+    """Find chessboard corners, searching a region of interest first.
+
+    The region of interest and then the full image are searched with
+    :py:func:`pyramid_corners`.
+
+    Args:
+        image (numpy.ndarray): A grayscale image
+        pattern_size (tuple): The number of interior corners (rows, cols)
+        roi (tuple): The region of the image (x0, y0, x1, y1) to search
+            first, or None to only search the full image
+        detection_size (int): The largest image dimension at which to start
+            searching, or None to only search at full resolution
+
+    Returns: numpy.ndarray of the unrefined corners in full image coordinates,
+        or None if the grid could not be found
+    """
+    for x0, y0, x1, y1 in search_regions(image, roi):
+        corners = pyramid_corners(image[y0:y1, x0:x1], pattern_size,
+                                  detection_size)
+        if corners is not None:
+            return corners + np.float32([x0, y0])
+    return None
+
+
+def refine_corners(image, corners, window=11):
+    """Refine corners to sub-pixel accuracy on the full resolution image.
+
+    Args:
+        image (numpy.ndarray): The full resolution grayscale image
+        corners (numpy.ndarray): The approximate corners
+        window (int): The half size of the search window in pixels
+
+    Returns: numpy.ndarray of the refined corners
+    """
+    refined = cv2.cornerSubPix(image, corners, (window, window), (-1, -1),
+                               criteria)
+    # OpenCV 2 refines in place and returns None
+    return corners if refined is None else refined
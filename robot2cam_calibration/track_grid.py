@@ -24,17 +24,22 @@
 # SOFTWARE.
 
 
+import threading
+
 import cv2
 import numpy as np
-import camera
-import json
 
-criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+import robot2cam_calibration.calibrations as calibrations
+import robot2cam_calibration.rotations as rotations
+import robot2cam_calibration.targets as targets
 
 
 class GridLocation(object):
     """Gets the location of a grid in an image and builds display images.
 
+    The grid is an asymmetric chessboard unless another target (see
+    :py:mod:`targets`) is given.
+
     Attributes:
         space: A float describing the spacing of the grid in mm
         rows: An int describing the number of rows of interior corners on the
@@ -44,18 +49,26 @@ class GridLocation(object):
         opencv_windows_open: A boolean, whether the openCV display windows are
             open
         image: numpy.ndarray of the undistorted image
+        image_time: float, the capture time of `image` (see
+            :py:data:`synchronize.clock`)
         result_image: numpy.ndarray of the final image, which is undistorted,
             has grid corners drawn on it, and has the grid coordinates drawn on
             it.
+        target: The :py:class:`targets.Target` being located
         object_point: numpy.ndarray of the real world coordinates of the grid
             in the grid's own coordinate system.
         axis: numpy.ndarry of the axis line points to draw, relative to the
             grid origin in the grid's coordinate system.
+        calibration: The :py:class:`calibrations.CameraCalibration` of the
+            camera
         intrinsic: A numpy array of the camera intrinsic matrix
         distortion: A numpy array of the camera distortion parameters
+        roi_tracker: :py:class:`RoiTracker` predicting where the grid will be
+            found in the next image, or None to always search the full image
     """
 
-    def __init__(self, calibration, rows, cols, space, cam_name):
+    def __init__(self, calibration, rows, cols, space, cam_name,
+                 track_roi=True, target=None):
         """Initialize the GridLocation class.
 
         Reads in camera calibration info, sets up communications with the
@@ -70,40 +83,45 @@ class GridLocation(object):
             rows (int): The number of rows of interior corners on the grid
             cols (int): The number of columns of interior corners on the grid
             space (float): The spacing of corners on the grid
+            cam_name (str): Name of the camera to use
+            track_roi (bool): Whether to search for the grid near where it
+                was last found before searching the full image
+            target (targets.Target): The target to locate. Defaults to a
+                :py:class:`targets.Chessboard` of rows by cols.
 
         Raises:
-            ValueError: The number of rows and cols was the same
+            ValueError: The number of rows and cols was the same for a
+                chessboard
         """
         # From args:
         self.space = space
-        if rows == cols:
-            raise ValueError('The grid mus be asymmetric. Rows cannot equal '
-                             'Columns')
+        if target is None:
+            target = targets.Chessboard(rows, cols, space)
+        self.target = target
         self.rows = rows
         self.cols = cols
 
         self.opencv_windows_open = False
 
         self.image = None
+        self.image_time = None
         self.result_image = None
 
         # Grid Info:
-        self.object_point = np.zeros((self.cols * self.rows, 3), np.float32)
-        self.object_point[:, :2] = (np.mgrid[
-                                    0:(self.rows*self.space):self.space,
-                                    0:(self.cols*self.space):self.space]
-                                    .T.reshape(-1, 2))
+        self.object_point = self.target.object_points
         self.axis = np.float32([[3*self.space, 0, 0], [0, 3*self.space, 0],
                                 [0, 0, -3*self.space]]).reshape(-1, 3)
+        self.roi_tracker = RoiTracker() if track_roi else None
 
         # Calibration Data setup:
-        with open(calibration, 'r') as calibration_file:
-            calibration_dictionary = json.load(calibration_file)
-        self.intrinsic = np.asarray(calibration_dictionary['intrinsic'])
-        self.distortion = np.asarray(calibration_dictionary['distortion'])
-
-        # Camera
-        self.cam = camera.Camera(cam_name, self.intrinsic, self.distortion)
+        self.calibration = calibrations.load(calibration, cam_name)
+        self.intrinsic = self.calibration.intrinsic
+        self.distortion = self.calibration.distortion
+
+        # Camera, imported here so the drawing and prediction functions do not
+        # need the camera SDK
+        import robot2cam_calibration.camera as camera
+        self.cam = camera.Camera(cam_name, calibration=self.calibration)
         print("done with init")
 
     def __del__(self):
@@ -130,12 +148,19 @@ class GridLocation(object):
             cv2.imshow('result', self.result_image)
         cv2.waitKey(5)
 
-    def get_cam2grid(self):
+    def get_cam2grid(self, after=None, roi=None):
         """Extract grid information from image and generate result image.
 
         Extract translation and rotation of grid from camera. Draw grid corners
         on result image. Draw grid pose on result image. Return camera to grid
-        transformation matrix.
+        transformation matrix. The capture time of the image is stored in
+        `image_time`.
+
+        Args:
+            after (float): If given, only use an image captured after this
+                time.
+            roi (tuple): If given, the region of the image (x0, y0, x1, y1)
+                to search first, see :py:meth:`find_grid`
 
         Returns: 6 member list, translation matrix
 
@@ -143,47 +168,116 @@ class GridLocation(object):
             RuntimeError: Could not find a grid
         """
         # Get new image
-        self.image = self.cam.capture_image()
-
-        # Find chessboard corners.
-        re_projection_error, corners = cv2.findChessboardCorners(
-            self.image, (self. rows, self.cols),
-            flags=cv2.CALIB_CB_FAST_CHECK + cv2.CALIB_CB_ADAPTIVE_THRESH)
-
-        if not re_projection_error:
-            raise RuntimeError('unable to find grid')
-
-        corners2 = cv2.cornerSubPix(self.image, corners, (11, 11),
-                                    (-1, -1),
-                                    criteria)
-        if corners2 is None:
-            corners2 = corners
-
-        # Find the rotation and translation vectors.
-        rvecs, tvecs, inliers = cv2.solvePnPRansac(self.object_point,
-                                                   corners2,
-                                                   self.intrinsic,
-                                                   self.distortion)
-        # project 3D points to image plane
-        image_points, jac = cv2.projectPoints(self.axis, rvecs, tvecs,
-                                              self.intrinsic,
-                                              self.distortion)
-
-        self.result_image = cv2.cvtColor(self.image,
-                                         cv2.COLOR_GRAY2RGB)
-
-        temp_image = cv2.drawChessboardCorners(self.result_image,
-                                               (self.cols, self.rows),
-                                               corners2,
-                                               re_projection_error)
-        # OpenCV 2 vs 3
-        if temp_image is not None:
-            self.result_image = temp_image
-
-        self.result_image = draw_axes(self.result_image, corners2,
-                                      image_points)
-
-        return (np.concatenate((tvecs, rvecs), axis=0)).ravel().tolist()
+        image, self.image_time = self.cam.capture_frame(after)
+        return self.locate(image, roi)
+
+    def locate(self, image, roi=None):
+        """Extract grid information from a rectified image.
+
+        The image is stored as `image` and the result image is generated, as
+        with :py:meth:`get_cam2grid`.
+
+        Args:
+            image (numpy.ndarray): A rectified grayscale image
+            roi (tuple): If given, the region of the image (x0, y0, x1, y1)
+                to search first, see :py:meth:`find_grid`
+
+        Returns: 6 member list, translation matrix
+
+        Raises:
+            RuntimeError: Could not find a grid
+        """
+        self.image = image
+        cam2grid, self.result_image = self.find_grid(image, roi)
+        return cam2grid
+
+    def find_grid(self, image, roi=None):
+        """Extract grid information from a rectified image without storing it.
+
+        This does not modify the GridLocation (other than updating the ROI
+        tracker), so it may be called from several threads at once. The grid
+        is first searched for in the region of interest, falling back to the
+        full image.
+
+        Args:
+            image (numpy.ndarray): A rectified grayscale image
+            roi (tuple): The region of the image (x0, y0, x1, y1) to search
+                first, for example from :py:meth:`predict_roi`. Defaults to
+                the prediction of the ROI tracker.
+
+        Returns: A tuple, (6 member list, translation matrix, numpy.ndarray,
+            the result image)
+
+        Raises:
+            RuntimeError: Could not find a grid
+        """
+        detection, result_image = self.find_target(image, roi)
+        return detection.pose, result_image
+
+    def find_target(self, image, roi=None):
+        """Locate the target in a rectified image, keeping the features found.
+
+        This is :py:meth:`find_grid`, but returns the whole detection, which
+        includes the image and object points of every feature found.
+
+        Args:
+            image (numpy.ndarray): A rectified grayscale image
+            roi (tuple): The region of the image (x0, y0, x1, y1) to search
+                first. Defaults to the prediction of the ROI tracker.
+
+        Returns: A tuple, (:py:class:`targets.Detection`, numpy.ndarray, the
+            result image)
+
+        Raises:
+            RuntimeError: Could not find a grid
+        """
+        if roi is None and self.roi_tracker is not None:
+            roi = self.roi_tracker.predict()
+        try:
+            detection = self.target.locate(image, self.intrinsic,
+                                           self.distortion, roi)
+        except RuntimeError:
+            if self.roi_tracker is not None:
+                self.roi_tracker.reset()
+            raise
+        if self.roi_tracker is not None:
+            self.roi_tracker.update(detection.image_points, image.shape)
+
+        # project the origin and 3D axis points to image plane
+        pose = np.asarray(detection.pose)
+        image_points, jac = cv2.projectPoints(
+            np.concatenate((np.zeros((1, 3), np.float32), self.axis)),
+            pose[3:], pose[:3], self.intrinsic, self.distortion)
+
+        result_image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        result_image = self.target.draw(result_image, detection)
+        result_image = draw_axes(result_image, image_points[:1],
+                                 image_points[1:], copy=False)
+
+        return detection, result_image
+
+    def predict_roi(self, cam2grid, image_shape, margin=0.25):
+        """Predict where the grid will appear given an estimated pose.
+
+        Args:
+            cam2grid (6 member list): The estimated camera to grid
+                transformation, x,y,z,axis-angle, for example from a rough
+                camera to robot calibration and the robot pose (see
+                :py:func:`expected_cam2grid`)
+            image_shape (tuple): The shape of the image
+            margin (float): How much to grow the region by, as a fraction of
+                its size
+
+        Returns: A tuple (x0, y0, x1, y1) of the region of interest, or None
+            if the grid would not be in the image
+        """
+        cam2grid = np.asarray(cam2grid, dtype=float)
+        if cam2grid[2] <= 0:
+            return None
+        image_points, _ = cv2.projectPoints(self.object_point, cam2grid[3:],
+                                            cam2grid[:3], self.intrinsic,
+                                            self.distortion)
+        return points_roi(image_points, image_shape, margin)
 
     def __enter__(self):
         """Content manager entry point"""
@@ -194,7 +288,98 @@ class GridLocation(object):
         self.__del__()
 
 
-def draw_axes(image_raw, corners, image_points, label=''):
+class RoiTracker(object):
+    """Tracks the region of the image where the grid was last found.
+
+    The grid is mounted on the robot, so it usually appears close to where it
+    was last seen. Searching that region first is much faster than searching
+    the whole image on high resolution cameras.
+
+    Attributes:
+        margin: A float, how much to grow the region around the last
+            detection, as a fraction of its size
+        roi: A tuple (x0, y0, x1, y1) of the predicted region, or None
+    """
+    def __init__(self, margin=0.5):
+        """Create a tracker.
+
+        Args:
+            margin (float): How much to grow the region around the last
+                detection, as a fraction of its size
+        """
+        self.margin = margin
+        self.roi = None
+        self.lock = threading.Lock()
+
+    def update(self, corners, image_shape):
+        """Update the prediction from a detection.
+
+        Args:
+            corners (numpy.ndarray): The corners found, in image coordinates
+            image_shape (tuple): The shape of the image
+        """
+        with self.lock:
+            self.roi = points_roi(corners, image_shape, self.margin)
+
+    def reset(self):
+        """Forget the prediction, so that the full image is searched."""
+        with self.lock:
+            self.roi = None
+
+    def predict(self):
+        """Return the predicted region of interest.
+
+        Returns: A tuple (x0, y0, x1, y1), or None if there is no prediction
+        """
+        with self.lock:
+            return self.roi
+
+
+def points_roi(points, image_shape, margin=0.25, min_size=32):
+    """Find a region of interest around a set of image points.
+
+    Args:
+        points (numpy.ndarray): Image points, any shape ending in 2
+        image_shape (tuple): The shape of the image
+        margin (float): How much to grow the bounding box by, as a fraction
+            of its size
+        min_size (int): The smallest region to return
+
+    Returns: A tuple (x0, y0, x1, y1) of integers clipped to the image, or
+        None if the region is smaller than min_size
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    low = points.min(axis=0)
+    high = points.max(axis=0)
+    grow = (high - low) * margin
+    low = np.floor(low - grow).astype(int)
+    high = np.ceil(high + grow).astype(int)
+    x0, y0 = max(low[0], 0), max(low[1], 0)
+    x1, y1 = min(high[0], image_shape[1]), min(high[1], image_shape[0])
+    if x1 - x0 < min_size or y1 - y0 < min_size:
+        return None
+    return int(x0), int(y0), int(x1), int(y1)
+
+
+def expected_cam2grid(cam2robot, tcp2robot, tcp2target):
+    """Compute where the grid should be given a camera to robot estimate.
+
+    Args:
+        cam2robot (6 member list): The camera to robot transformation,
+            x,y,z,axis-angle
+        tcp2robot (6 member list): The robot pose, x,y,z,axis-angle
+        tcp2target (6 member list): The tcp to grid transformation,
+            x,y,z,axis-angle
+
+    Returns: 6 member list, the expected camera to grid transformation
+    """
+    cam2grid = np.matmul(np.matmul(rotations.pose2mat(cam2robot),
+                                   rotations.pose2mat(tcp2robot)),
+                         rotations.pose2mat(tcp2target))
+    return rotations.mat2pose(cam2grid).tolist()
+
+
+def draw_axes(image_raw, corners, image_points, label='', copy=True):
     """Draw axes on an image
 
     Draw axes which will be centered at the first corner and oriented by the
@@ -208,6 +393,9 @@ def draw_axes(image_raw, corners, image_points, label=''):
         image_points (np.array): 2D points on the image at the end of the three
             axes
         label (str): A string label to place near the coordinate frame
+        copy (bool): Whether to draw on a copy of the image. If False, the
+            axes are drawn on image_raw itself, which saves copying large
+            images that are drawn on several times.
 
     Returns: numpy.ndarray Image with the axes drawn on it.
 
@@ -215,7 +403,7 @@ def draw_axes(image_raw, corners, image_points, label=''):
     corners = np.rint(corners).astype('int')
     image_points = np.rint(image_points).astype('int')
     corner = tuple(corners[0].ravel())
-    image = image_raw.copy()
+    image = image_raw.copy() if copy else image_raw
     temp = cv2.arrowedLine(image, corner, tuple(image_points[0].ravel()),
                            (255, 0, 0), 5)
     if temp is not None:
@@ -0,0 +1,464 @@
+"""A file to estimate how well the calibration transformations are known.
+
+Two estimates are available:
+
+- covariance: the covariance of the solution, from the Jacobian of
+  :py:func:`compute_transformations.pose_residuals` at the solution. This
+  is nearly free, but assumes the errors are independent.
+- bootstrap: the correspondences are resampled with replacement and the
+  transformations are solved again for every resample. Each solve is a local
+  solve started from the main solution, and the resamples are spread over a
+  process pool, so hundreds of resamples take about as long as a single
+  basin hopping run.
+
+Both use the objective the solution was found with. A single camera is
+solved by minimizing the mean error of the inliers
+(:py:func:`compute_transformations.error`), so each resample is solved the
+same way and the covariance is the sandwich estimate of that minimum.
+Several cameras are solved by least squares, so each resample is a least
+squares solve and the covariance is that of the least squares solution.
+
+Both report the standard deviation of each axis of every transformation:
+x,y,z in the units of the correspondences (mm) and rotations in radians about
+the axes of the solution itself. Observations which the solve rejected as
+outliers are left out.
+"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 GTRC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import division
+import argparse
+import json
+import multiprocessing
+
+import numpy as np
+
+import robot2cam_calibration.compute_transformations as compute
+import robot2cam_calibration.rotations as rotations
+
+METHODS = ['covariance', 'bootstrap']
+
+# The data shared by the bootstrap worker processes, see _init_worker
+_worker_data = None
+
+
+def main():
+    """
+    Exposes :py:func:`add_uncertainty` to the commandline. Run with arg `-h`
+    for more info.
+    """
+    parser = argparse.ArgumentParser(
+        description="Estimate the uncertainty of a computed camera to robot "
+                    "transformation and add it to the transformation file")
+
+    parser.add_argument("--correspondences", type=str,
+                        help='The correspondences the transformation was '
+                             'computed from.',
+                        default="correspondences.json")
+
+    parser.add_argument("--transformation", type=str,
+                        help='The transformation file, as written by '
+                             'robot2cam-compute. It is updated in place.',
+                        default="transformation.json")
+
+    parser.add_argument("--method", type=str, choices=METHODS,
+                        help="How to estimate the uncertainty",
+                        default="covariance")
+
+    parser.add_argument("--resamples", type=int,
+                        help="The number of bootstrap resamples",
+                        default=200)
+
+    parser.add_argument("--workers", type=int,
+                        help="The number of bootstrap processes. Defaults to "
+                             "the number of CPUs.",
+                        default=None)
+
+    args = parser.parse_args()
+
+    result = add_uncertainty(
+        correspondences=args.correspondences,
+        transformation=args.transformation,
+        method=args.method,
+        resamples=args.resamples,
+        workers=args.workers
+    )
+
+    print('Uncertainty:\n{}'.format(result))
+
+
+def add_uncertainty(correspondences, transformation, method='covariance',
+                    resamples=200, workers=None):
+    """Estimate the uncertainty of a transformation file and write it into
+    the file as `uncertainty`.
+
+    Args:
+        correspondences (str): The correspondences file
+        transformation (str): The transformation file, updated in place
+        method (str): One of :py:data:`METHODS`
+        resamples (int): The number of bootstrap resamples
+        workers (int): The number of bootstrap processes, None for one per CPU
+
+    Returns: The uncertainty as a dictionary
+    """
+    with open(correspondences, 'r') as correspondences_file:
+        correspondences_dictionary = json.load(correspondences_file)
+    with open(transformation, 'r') as transformation_file:
+        transformation_dictionary = json.load(transformation_file)
+    result = estimate(correspondences_dictionary, transformation_dictionary,
+                      method, resamples, workers)
+    transformation_dictionary["uncertainty"] = result
+    with open(transformation, 'w') as transformation_file:
+        json.dump(transformation_dictionary, transformation_file, indent=4)
+    return result
+
+
+def estimate(correspondences, transformation, method='covariance',
+             resamples=200, workers=None, ratio=0.25):
+    """Estimate the uncertainty of a solved transformation.
+
+    Args:
+        correspondences (dict): The correspondences, as loaded from json
+        transformation (dict): The solution, as written by
+            :py:func:`compute_transformations.compute_transformation`
+        method (str): One of :py:data:`METHODS`
+        resamples (int): The number of bootstrap resamples
+        workers (int): The number of bootstrap processes, None for one per CPU
+        ratio (float): The weight of position vs angular error, see
+            :py:func:`compute_transformations.error`
+
+    Returns: A dictionary with the standard deviation (`std`) of each axis of
+        `cam2robot` (a list by camera with several cameras) and `tcp2target`.
+        The covariance method also includes the full `covariance` matrix and
+        the bootstrap method the 95% interval of the deviation from the
+        solution (`interval`).
+
+    Raises:
+        ValueError: The method is not known
+    """
+    if method not in METHODS:
+        raise ValueError('unknown method {}, must be one of {}'.format(
+            method, METHODS))
+    data = observations(correspondences, transformation.get('outliers'))
+    solution = solution_parameters(transformation)
+    minimizer = solution_minimizer(transformation)
+
+    result = {"method": method,
+              "units": "x,y,z as the correspondences, rotations in radians "
+                       "about the solution axes"}
+    if method == 'covariance':
+        matrix = covariance(solution, data, ratio)
+        deviation = np.sqrt(np.diag(matrix))
+        result["covariance"] = matrix.tolist()
+    else:
+        deviations = bootstrap(solution, data, resamples, workers, ratio,
+                               minimizer=minimizer)
+        deviation = deviations.std(axis=0)
+        interval = np.percentile(deviations, [2.5, 97.5], axis=0)
+        result["resamples"] = len(deviations)
+
+    poses = []
+    for pose in range(len(solution) // 6):
+        axes = slice(6 * pose, 6 * pose + 6)
+        poses.append({"std": deviation[axes].tolist()})
+        if method == 'bootstrap':
+            poses[-1]["interval"] = interval[:, axes].tolist()
+    cameras = correspondences.get('cameras', [None])
+    if len(cameras) > 1:
+        for name, pose in zip(cameras, poses):
+            pose["camera"] = name
+        result["cam2robot"] = poses[:-1]
+    else:
+        result["cam2robot"] = poses[0]
+    result["tcp2target"] = poses[-1]
+    return result
+
+
+def observations(correspondences, outliers=None):
+    """Flatten correspondences into one row per camera observation.
+
+    Args:
+        correspondences (dict): The correspondences, as loaded from json
+        outliers (list): Observations to leave out, as reported by
+            :py:func:`compute_transformations.compute_transformation`: sample
+            indices, or [sample, camera] pairs with several cameras
+
+    Returns: A tuple, (kx6 np.ndarray of robot poses, kx6 np.ndarray of
+        camera to grid transformations, k np.ndarray of the camera of each
+        observation, k np.ndarray of the robot sample of each observation,
+        int, the number of cameras)
+    """
+    cameras = len(correspondences.get('cameras', [None]))
+    camera2grid = correspondences['camera2grid']
+    if cameras == 1:
+        camera2grid = [[grid] for grid in camera2grid]
+    data = compute.flatten_cameras(correspondences['tcp2robot'], camera2grid)
+    if outliers:
+        outliers = set(tuple(outlier) if isinstance(outlier, list) else
+                       (outlier, 0) for outlier in outliers)
+        keep = np.array([(sample, camera) not in outliers
+                         for camera, sample in zip(data[2], data[3])],
+                        dtype=bool)
+        data = tuple(values[keep] for values in data)
+    return data + (cameras,)
+
+
+def solution_parameters(transformation):
+    """Read the parameter vector of a transformation.
+
+    Args:
+        transformation (dict): The solution, as written by
+            :py:func:`compute_transformations.compute_transformation`
+
+    Returns: np.ndarray, the camera to robot transformation of each camera
+        followed by the tcp to target transformation
+    """
+    cam2robot = transformation['cam2robot']
+    if not isinstance(cam2robot, list):
+        cam2robot = [cam2robot]
+    return np.concatenate([pose['xyz-angle'] for pose in cam2robot] +
+                          [transformation['tcp2target']['xyz-angle']])
+
+
+def solution_minimizer(transformation):
+    """Find the scipy.optimize.minimize method a transformation was solved
+    with.
+
+    Args:
+        transformation (dict): The solution, as written by
+            :py:func:`compute_transformations.compute_transformation`
+
+    Returns: str, the method, 'SLSQP' if it is not recorded
+    """
+    minimization = transformation.get('minimization', {})
+    method = minimization.get('method')
+    if method == 'consensus':
+        method = minimization.get('refinement', {}).get('method')
+    if method in (None, 'least_squares'):
+        return 'SLSQP'
+    return method
+
+
+def perturb(parameters, delta):
+    """Apply small changes to every transformation of a parameter vector.
+
+    Positions are offset directly and rotations are rotated about the axes of
+    the transformation they change, which keeps the change well behaved for
+    any rotation.
+
+    Args:
+        parameters (6m array): The transformations, x,y,z,axis-angle
+        delta (6m array): The change of each transformation
+
+    Returns: 6m np.ndarray, the changed transformations
+    """
+    poses = np.reshape(parameters, (-1, 6))
+    delta = np.reshape(delta, (-1, 6))
+    rotation = np.matmul(rotations.rotvec2mat(poses[:, 3:]),
+                         rotations.rotvec2mat(delta[:, 3:]))
+    return np.concatenate((poses[:, :3] + delta[:, :3],
+                           rotations.mat2rotvec(rotation)), axis=1).ravel()
+
+
+def difference(parameters, reference):
+    """The change from one parameter vector to another, the inverse of
+    :py:func:`perturb`.
+
+    Args:
+        parameters (6m array): The changed transformations
+        reference (6m array): The reference transformations
+
+    Returns: 6m np.ndarray, the change of each transformation
+    """
+    poses = np.reshape(parameters, (-1, 6))
+    reference = np.reshape(reference, (-1, 6))
+    rotation = np.matmul(
+        np.swapaxes(rotations.rotvec2mat(reference[:, 3:]), -1, -2),
+        rotations.rotvec2mat(poses[:, 3:]))
+    return np.concatenate((poses[:, :3] - reference[:, :3],
+                           rotations.mat2rotvec(rotation)), axis=1).ravel()
+
+
+def covariance(solution, data, ratio=0.25, step=1e-6):
+    """The covariance of a solution from the Jacobian of its residuals.
+
+    With several cameras the solution is a least squares solution, and the
+    position and rotation residuals are weighted by their own variance at
+    the solution, so the result does not depend on their relative weighting.
+    With one camera the solution minimizes the sum of the norms of the
+    position and rotation residuals (:py:func:`compute_transformations.error`)
+    and the covariance is the sandwich estimate H^-1 B H^-1, with H the
+    Hessian of that sum and B the spread of the gradients of each
+    observation.
+
+    Args:
+        solution (6m array): The solved transformations
+        data (tuple): The observations, see :py:func:`observations`
+        ratio (float): The weight of position vs angular error
+        step (float): The central difference step
+
+    Returns: 6m x 6m np.ndarray, the covariance of the change of each
+        transformation from the solution (see :py:func:`perturb`)
+    """
+    tcp2robot, camera2grid, camera_index = data[:3]
+    cameras = data[4]
+
+    def residuals(delta):
+        return compute.pose_residuals(
+            perturb(solution, delta), tcp2robot, camera2grid, camera_index,
+            ratio).reshape(-1, 2, 3)
+
+    size = len(solution)
+    jacobian = np.empty((len(camera_index), 2, 3, size))
+    for column in range(size):
+        delta = np.zeros(size)
+        delta[column] = step
+        jacobian[..., column] = (residuals(delta) -
+                                 residuals(-delta)) / (2 * step)
+
+    fit = residuals(np.zeros(size))
+    if cameras == 1:
+        return _error_covariance(fit, jacobian)
+
+    # position and rotation errors have their own variance
+    degrees = max(fit.size - size, 1)
+    variance = np.sum(fit ** 2, axis=(0, 2)) * 2 / degrees
+    weights = 1 / np.sqrt(np.maximum(variance, np.finfo(float).tiny))
+    jacobian = (jacobian * weights[None, :, None, None]).reshape(-1, size)
+    return np.linalg.pinv(np.dot(jacobian.T, jacobian))
+
+
+def _error_covariance(fit, jacobian):
+    """The sandwich covariance of the minimum of the summed residual norms.
+
+    Args:
+        fit (kx2x3 array): The position and rotation residuals of each
+                           observation at the solution
+        jacobian (kx2x3xm array): Their derivatives
+
+    Returns: m x m np.ndarray, the covariance
+    """
+    observations_count, size = len(fit), jacobian.shape[-1]
+    norms = np.maximum(np.linalg.norm(fit, axis=2), np.finfo(float).tiny)
+    unit = fit / norms[..., None]
+    # the derivative of each norm, and of the error of each observation
+    along = np.einsum('kij,kijp->kip', unit, jacobian)
+    gradients = along.sum(axis=1)
+    # a norm only curves across its residual: J'(I - uu')J / |r|
+    across = jacobian - unit[..., None] * along[:, :, None, :]
+    hessian = np.einsum('kijp,kijq,ki->pq', across, across, 1 / norms)
+    spread = (np.dot(gradients.T, gradients) * observations_count /
+              max(observations_count - size, 1))
+    inverse = np.linalg.pinv(hessian)
+    return np.dot(np.dot(inverse, spread), inverse)
+
+
+def bootstrap(solution, data, resamples=200, workers=None, ratio=0.25,
+              seed=0, minimizer='SLSQP'):
+    """Solve for the transformations on resampled correspondences.
+
+    Robot samples are drawn with replacement, keeping all of the observations
+    of a sample together. Every resample is solved with a local solve from
+    the main solution on a pool of processes, using the objective the
+    solution was found with: the mean error of
+    :py:func:`compute_transformations.error` for one camera and least squares
+    for several.
+
+    Args:
+        solution (6m array): The solved transformations
+        data (tuple): The observations, see :py:func:`observations`
+        resamples (int): The number of resamples
+        workers (int): The number of processes, None for one per CPU
+        ratio (float): The weight of position vs angular error
+        seed (int): The seed of the resampling
+        minimizer (str): The scipy.optimize.minimize method which solves a
+                         single camera
+
+    Returns: resamples x 6m np.ndarray, the change of each resolved
+        transformation from the solution (see :py:func:`difference`)
+    """
+    seeds = np.random.RandomState(seed).randint(
+        0, 2 ** 31 - 1, size=resamples)
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(solution, data, ratio, minimizer))
+    try:
+        deviations = pool.map(_resample, seeds,
+                              chunksize=max(1, resamples // (4 * (
+                                  workers or multiprocessing.cpu_count()))))
+    finally:
+        pool.close()
+        pool.join()
+    return np.array(deviations)
+
+
+def _init_worker(solution, data, ratio, minimizer):
+    """Store the data shared by every resample in a worker process.
+
+    Args:
+        solution (6m array): The solved transformations
+        data (tuple): The observations, see :py:func:`observations`
+        ratio (float): The weight of position vs angular error
+        minimizer (str): The scipy.optimize.minimize method for one camera
+    """
+    global _worker_data
+    tcp2robot, camera2grid, camera_index, sample_index, cameras = data
+    # number the samples which are left after removing outliers
+    sample_index = np.unique(sample_index, return_inverse=True)[1]
+    _worker_data = (solution, tcp2robot, camera2grid, camera_index,
+                    sample_index, cameras, ratio, minimizer)
+
+
+def _resample(seed):
+    """Solve one bootstrap resample in a worker process.
+
+    Args:
+        seed (int): The seed of this resample
+
+    Returns: 6m np.ndarray, the change of the solution, see
+        :py:func:`difference`
+    """
+    (solution, tcp2robot, camera2grid, camera_index, sample_index, cameras,
+     ratio, minimizer) = _worker_data
+    samples = sample_index.max() + 1
+    drawn = np.bincount(np.random.RandomState(seed).randint(
+        0, samples, size=samples), minlength=samples)
+    # an observation is used as often as its robot sample was drawn
+    rows = np.repeat(np.arange(len(sample_index)), drawn[sample_index])
+    from scipy import optimize
+    if cameras == 1:
+        # the outliers are already left out, so every row is an inlier
+        result = optimize.minimize(
+            compute.error, solution,
+            args=(tcp2robot[rows], camera2grid[rows], ratio,
+                  np.ones(len(rows), dtype=bool)),
+            method=minimizer, options={"maxiter": 25000})
+        return difference(result.x, solution)
+    result = optimize.least_squares(
+        compute.pose_residuals, solution,
+        jac_sparsity=compute.jacobian_sparsity(camera_index[rows], cameras),
+        x_scale='jac', loss='soft_l1', method='trf',
+        args=(tcp2robot[rows], camera2grid[rows], camera_index[rows], ratio))
+    return difference(result.x, solution)
+
+
+if __name__ == "__main__":
+    main()
@@ -40,7 +40,16 @@ setup(name='robot2cam_calibration',
             'robot2cam-record-ur=robot2cam_calibration.get_correspondences:main',
             'robot2cam-images-ur=robot2cam_calibration.get_images:main',
             'robot2cam-compute=robot2cam_calibration.compute_transformations:main',
-            'robot2cam-check=robot2cam_calibration.check_transformation:main'
+            'robot2cam-check=robot2cam_calibration.check_transformation:main',
+            'robot2cam-refine=robot2cam_calibration.bundle_adjustment:main',
+            'robot2cam-uncertainty=robot2cam_calibration.uncertainty:main',
+            'robot2cam-record-stream=robot2cam_calibration.stream_recorder:main',
+            'robot2cam-align=robot2cam_calibration.align_streams:main',
+            'robot2cam-kuka-convert=robot2cam_calibration.kuka_convert:main',
+            'robot2cam-simulate-robot=robot2cam_calibration.robots:main',
+            'robot2cam-batch=robot2cam_calibration.batch:main',
+            'robot2cam-server=robot2cam_calibration.server:main',
+            'robot2cam-plan=robot2cam_calibration.planning:main'
         ]
       },
       zip_safe=False)